@@ -56,13 +56,24 @@ setup(name='TracHours',
           'Trac',
           'FeedParser',
       ],
-      extras_require=dict(lxml=['lxml']),
+      extras_require=dict(lxml=['lxml'], numpy=['numpy']),
       entry_points={
           'trac.plugins': [
               'trachours.trachours = trachours.hours',
+              'trachours.admin = trachours.admin',
+              'trachours.archive = trachours.archive',
+              'trachours.delta = trachours.delta',
+              'trachours.metrics = trachours.metrics',
               'trachours.multiproject = trachours.multiproject',
+              'trachours.pivot = trachours.pivot',
+              'trachours.profiling = trachours.profiling',
+              'trachours.querylog = trachours.querylog',
+              'trachours.search = trachours.search',
               'trachours.setup = trachours.db',
+              'trachours.snapshot = trachours.snapshot',
               'trachours.ticket = trachours.ticket',
+              'trachours.timeline = trachours.timeline',
+              'trachours.timesheet = trachours.timesheet',
               'trachours.web_ui = trachours.web_ui',
           ],
       },
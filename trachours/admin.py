@@ -0,0 +1,357 @@
+# -*- coding: utf-8 -*-
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+import csv
+import json
+import sys
+import time
+
+from trac.admin.api import AdminCommandError, IAdminCommandProvider
+from trac.config import IntOption
+from trac.core import Component, implements
+from trac.util.datefmt import format_datetime
+from trac.util.text import printout
+
+from archive import TracHoursArchive
+from hours import TracHoursPlugin, _
+from snapshot import TracHoursSnapshot
+from sqlhelper import (
+    execute_non_query, get_all, get_scalar, get_system_value,
+    set_system_value
+)
+
+
+class TracHoursAdmin(Component):
+    """trac-admin commands for maintaining the hours data."""
+
+    implements(IAdminCommandProvider)
+
+    chunk_size = IntOption('trachours', 'admin_chunk_size', 500,
+        """Number of tickets or time records processed in each
+        transaction by the `hours` trac-admin commands.""")
+
+    recalc_checkpoint = 'trachours.recalc_checkpoint'
+
+    formats = ('csv', 'ndjson')
+    columns = ('id', 'ticket', 'time_submitted', 'worker', 'submitter',
+               'time_started', 'seconds_worked', 'comments')
+    int_columns = ('id', 'ticket', 'time_submitted', 'time_started',
+                   'seconds_worked')
+
+    # rows per INSERT statement, keeping below the 999 parameters
+    # allowed by SQLite
+    insert_rows = 100
+
+    # IAdminCommandProvider methods
+
+    def get_admin_commands(self):
+        yield ('hours recalc', '[resume|<ticket>...]',
+               """Recompute the total hours of tickets
+
+               Without arguments the total hours of all tickets are
+               recomputed from the time records, and their estimated
+               hours are copied to the table summed by the views. The
+               tickets are processed in chunks of `[trachours]
+               admin_chunk_size` tickets that are each committed
+               separately, so the command can run alongside live
+               traffic. The last ticket of each committed chunk is
+               recorded, and an interrupted run can be continued with
+               `resume`.
+               """,
+               self._complete_recalc, self._do_recalc)
+        yield ('hours export', '<csv|ndjson> [file]',
+               """Export the time records
+
+               The records are written to `file`, or to the standard
+               output, ordered by id. They are read in chunks of
+               `[trachours] admin_chunk_size` records, so the export runs
+               in constant memory.
+               """,
+               self._complete_format, self._do_export)
+        yield ('hours import', '<csv|ndjson> <file>',
+               """Import time records
+
+               Reads time records as written by `hours export` from
+               `file`, or from the standard input if `file` is `-`. The
+               records are inserted as new entries, ignoring their `id`,
+               and committed every `[trachours] admin_chunk_size` records.
+               Only `ticket`, `worker` and `seconds_worked` are required.
+               The records of tickets that do not exist are skipped and
+               reported. The total hours of the affected tickets are recomputed once
+               all the records are imported.
+               """,
+               self._complete_format, self._do_import)
+        yield ('hours prune', '',
+               """Prune the changes of the time records
+
+               Deletes the changes of the time records older than
+               `[trachours] changes_retention_days` from the log read by
+               the changes feed. The changes are also pruned every hour
+               while hours are logged.
+               """,
+               None, self._do_prune)
+        yield ('hours digest', '',
+               """Post the digests of the hours comments
+
+               Posts the comments of the hours logged on each ticket,
+               queued when `[trachours] comment_digest` is enabled, as a
+               single comment per ticket and author, however recent they
+               are. The digests older than `comment_digest_interval` are
+               also posted while hours are logged.
+               """,
+               None, self._do_digest)
+        yield ('hours snapshot', '',
+               """Write the columnar snapshot of the time records
+
+               Writes the ticket, worker, start and seconds of all the
+               time records as arrays under the `cache/trachours/snapshot`
+               directory of the environment, replacing the previous
+               snapshot. The snapshot is then kept up to date after each
+               write when `[trachours] snapshot` is enabled.
+               """,
+               None, self._do_snapshot)
+        yield ('hours archive', '[days]',
+               """Archive the old time records
+
+               Moves the time records started and submitted more than
+               `days` ago, by default `[trachours] archive_days`, to the
+               `ticket_time_archive` table, and adds their hours to the
+               summary of their ticket and worker. The records are moved
+               in chunks of `[trachours] admin_chunk_size` records, each
+               committed separately. The archived records are still
+               shown and summed by the views, but can no longer be
+               edited.
+               """,
+               None, self._do_archive)
+
+    def _complete_recalc(self, args):
+        if len(args) == 1:
+            return ['resume']
+
+    def _complete_format(self, args):
+        if len(args) == 1:
+            return list(self.formats)
+
+    def _do_recalc(self, *args):
+        if args and args[0] == 'resume':
+            start = int(get_system_value(self.env, self.recalc_checkpoint, 0))
+            self._recalc_all(start)
+        elif args:
+            try:
+                ids = sorted(set(int(arg) for arg in args))
+            except ValueError:
+                raise AdminCommandError(_("Invalid ticket id"))
+            for idx in xrange(0, len(ids), self.chunk_size):
+                self.recalc_tickets(ids[idx:idx + self.chunk_size])
+            printout(_("Recomputed total hours for {count} tickets").format(
+                count=len(ids)))
+        else:
+            self._recalc_all(0)
+
+    def _do_export(self, format, filename=None):
+        if format not in self.formats:
+            raise AdminCommandError(_("Unknown format {format}").format(
+                format=format))
+        out = open(filename, 'wb') if filename else sys.stdout
+        try:
+            if format == 'csv':
+                writer = csv.writer(out)
+                writer.writerow(self.columns)
+                write = lambda row: writer.writerow(
+                    [unicode(value).encode('utf-8') if value is not None
+                     else '' for value in row])
+            else:
+                write = lambda row: out.write(
+                    json.dumps(dict(zip(self.columns, row))) + '\n')
+            for row in self.iter_records():
+                write(row)
+        finally:
+            if filename:
+                out.close()
+
+    def _do_import(self, format, filename):
+        if format not in self.formats:
+            raise AdminCommandError(_("Unknown format {format}").format(
+                format=format))
+        in_ = sys.stdin if filename == '-' else open(filename, 'rb')
+        tickets = set()
+        rejected = []
+        try:
+            if format == 'csv':
+                records = (dict((key, value.decode('utf-8'))
+                                for key, value in record.iteritems()
+                                if value is not None)
+                           for record in csv.DictReader(in_))
+            else:
+                records = (json.loads(line) for line in in_ if line.strip())
+            count = self.import_records(records, tickets, rejected)
+            printout(_("Imported {count} time records").format(count=count))
+        finally:
+            if filename != '-':
+                in_.close()
+            for number, ticket in rejected:
+                printout(_("Skipped time record {number}: ticket "
+                           "#{ticket} does not exist").format(
+                    number=number, ticket=ticket))
+            # the records committed before an error are also recomputed
+            tickets = sorted(tickets)
+            for idx in xrange(0, len(tickets), self.chunk_size):
+                self.recalc_tickets(tickets[idx:idx + self.chunk_size])
+            printout(_("Recomputed total hours for {count} tickets")
+                     .format(count=len(tickets)))
+
+    def _do_prune(self):
+        count = TracHoursPlugin(self.env).prune_changes()
+        printout(_("Pruned {count} changes").format(count=count))
+
+    def _do_digest(self):
+        count = TracHoursPlugin(self.env).post_digests()
+        printout(_("Posted {count} digests").format(count=count))
+
+    def _do_snapshot(self):
+        count = TracHoursSnapshot(self.env).build()
+        printout(_("Wrote the snapshot of {count} time records").format(
+            count=count))
+
+    def _do_archive(self, days=None):
+        archive = TracHoursArchive(self.env)
+        if days is not None:
+            try:
+                days = int(days)
+            except ValueError:
+                raise AdminCommandError(_("Invalid number of days: "
+                                          "{days}").format(days=days))
+        cutoff, count = archive.archive(archive.get_cutoff(days),
+                                        self.chunk_size)
+        printout(_("Archived {count} time records started before "
+                   "{date}").format(count=count,
+                                    date=format_datetime(cutoff)))
+
+    # Internal methods
+
+    def iter_records(self):
+        """Generate all the time records as tuples of `columns`, ordered
+        by id and fetched in chunks.
+        """
+        last_id = 0
+        # the archived records are included
+        table = TracHoursPlugin(self.env).time_records_table()
+        while True:
+            rows = get_all(self.env, """
+                SELECT %s FROM %s WHERE id > %%s
+                ORDER BY id LIMIT %%s
+                """ % (','.join(self.columns), table),
+                last_id, self.chunk_size)
+            for row in rows:
+                yield row
+            if len(rows) < self.chunk_size:
+                break
+            last_id = rows[-1][0]
+
+    def import_records(self, records, tickets, rejected):
+        """Insert time records given as dictionaries, committing every
+        `chunk_size` records, and return their number. The tickets of
+        the inserted records are added to the set `tickets`, and the
+        `(number, ticket)` of the records of tickets that do not exist,
+        numbered from 1 in `records`, to the list `rejected`. An invalid
+        record raises an `AdminCommandError` telling how many records
+        were committed before it.
+        """
+        now = int(time.time())
+        count = 0
+        batch = []
+        for number, record in enumerate(records, 1):
+            record = dict((key, None if record.get(key) == ''
+                                else record.get(key))
+                          for key in self.columns)
+            try:
+                for key in self.int_columns:
+                    if record[key] is not None:
+                        record[key] = int(record[key])
+                if record['ticket'] is None or record['worker'] is None or \
+                        record['seconds_worked'] is None:
+                    raise ValueError
+            except ValueError:
+                raise AdminCommandError(
+                    _("Invalid time record {number}: {record} ({count} "
+                      "time records imported before it)").format(
+                        number=number, record=record, count=count))
+            time_submitted = record['time_submitted'] or now
+            batch.append((number, (record['ticket'], time_submitted,
+                                   record['worker'],
+                                   record['submitter'] or record['worker'],
+                                   record['time_started'] or time_submitted,
+                                   record['seconds_worked'],
+                                   record['comments'] or '')))
+            if len(batch) >= self.chunk_size:
+                count += self._import_batch(batch, tickets, rejected)
+                batch = []
+        if batch:
+            count += self._import_batch(batch, tickets, rejected)
+        return count
+
+    def _import_batch(self, batch, tickets, rejected):
+        # the tickets found are added to `tickets`, and the records of
+        # the missing ones to `rejected`
+        ids = set(row[0] for number, row in batch) - tickets
+        if ids:
+            tickets.update(id_ for id_, in get_all(self.env, """
+                SELECT id FROM ticket WHERE id IN (%s)
+                """ % ','.join(map(str, ids))))
+        rows = []
+        for number, row in batch:
+            if row[0] in tickets:
+                rows.append(row)
+            else:
+                rejected.append((number, row[0]))
+        if rows:
+            self._insert_records(rows)
+        return len(rows)
+
+    def _insert_records(self, rows):
+        hours = TracHoursPlugin(self.env)
+        with self.env.db_transaction:
+            hours.log_inserts(hours.insert_records(rows, self.insert_rows),
+                              rows)
+        hours.time_records_changed([row[0] for row in rows],
+                                   [row[2] for row in rows])
+
+    def recalc_tickets(self, ids):
+        """Recompute the total hours and copy the estimated hours of the
+        tickets `ids` in a single transaction.
+        """
+        with self.env.db_transaction:
+            execute_non_query(self.env, """
+                INSERT INTO ticket_custom (ticket, name, value)
+                SELECT id, 'totalhours', '0' FROM ticket
+                WHERE id IN (%s) AND id NOT IN (
+                  SELECT ticket FROM ticket_custom WHERE name='totalhours')
+                """ % ",".join(map(str, ids)))
+            hours = TracHoursPlugin(self.env)
+            hours.update_ticket_hours(ids)
+            hours.update_estimated_hours(ids)
+        hours.bump_generation()
+
+    def _recalc_all(self, start):
+        total = get_scalar(self.env, """
+            SELECT COUNT(*) FROM ticket WHERE id > %s
+            """, 0, start)
+        done = 0
+        while True:
+            ids = [id_ for id_, in get_all(self.env, """
+                SELECT id FROM ticket WHERE id > %s ORDER BY id LIMIT %s
+                """, start, self.chunk_size)]
+            if not ids:
+                break
+            with self.env.db_transaction:
+                self.recalc_tickets(ids)
+                set_system_value(self.env, self.recalc_checkpoint, ids[-1])
+            start = ids[-1]
+            done += len(ids)
+            printout(_("Recomputed total hours for {done}/{total} tickets "
+                       "(up to #{id})").format(done=done, total=total,
+                                               id=start))
+        set_system_value(self.env, self.recalc_checkpoint, None)
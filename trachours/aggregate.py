@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+"""Group-by sums of the hours reports.
+
+The reports sum the seconds worked of the time records by one or more
+key columns, such as the worker or the ticket. The keys are factorized
+into integer codes numbered by first occurrence, and the values are
+summed by code into a list, with `numpy.bincount` when numpy is
+installed, or with a single loop over `array` columns otherwise. The
+backends are looked up by name in `backends`, so that another one can
+be registered.
+"""
+
+import array
+from itertools import izip
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class ArrayBackend(object):
+    """Sum the columns with the standard library."""
+
+    name = 'array'
+
+    def floor_divide(self, column, divisor):
+        """Return the column of the values of `column` divided by
+        `divisor`, rounded down.
+        """
+        return array.array('l', [value // divisor for value in column])
+
+    def factorize(self, column):
+        """Return the codes of the values of `column`, numbered by first
+        occurrence, and the sequence of the distinct values.
+        """
+        index = {}
+        # the code is the number of distinct values met before
+        codes = array.array('l', [index.setdefault(value, len(index))
+                                  for value in column])
+        uniques = [None] * len(index)
+        for value, code in index.iteritems():
+            uniques[code] = value
+        return codes, uniques
+
+    def bincount(self, codes, values, size):
+        """Return the list of the sums of `values` by code of `codes`,
+        which are from 0 to `size` excluded.
+        """
+        totals = [0] * size
+        for code, value in izip(codes, values):
+            totals[code] += value
+        return totals
+
+    def group_sum(self, values, keys):
+        """Return the `(key, total)` of the sums of `values` by the
+        tuples of the values of the columns `keys`, or by the values of
+        the single column, in the order of the first occurrence.
+        """
+        # the tuples of the keys are factorized at once
+        codes, uniques = self.factorize(keys[0] if len(keys) == 1
+                                        else izip(*keys))
+        return zip(uniques, self.bincount(codes, values, len(uniques)))
+
+
+class NumpyBackend(ArrayBackend):
+    """Sum the columns with numpy."""
+
+    name = 'numpy'
+
+    def floor_divide(self, column, divisor):
+        return numpy.floor_divide(numpy.asarray(column), divisor)
+
+    def factorize(self, column):
+        codes, uniques, first = self._factorize(column)
+        return codes, uniques
+
+    def _factorize(self, column):
+        """Return the codes and the distinct values of `column`, as by
+        `factorize`, and the index of the first occurrence of each value.
+        """
+        count = len(column)
+        if count and not isinstance(column, numpy.ndarray) and \
+                isinstance(column[0], (int, long)):
+            column = numpy.asarray(column)
+        if not isinstance(column, numpy.ndarray) or not count or \
+                column.dtype.kind not in 'biu':
+            # strings and mixed values, such as `None`, are factorized
+            # with a dictionary, which is faster than sorting them
+            if isinstance(column, numpy.ndarray):
+                column = column.tolist()
+            codes, uniques = ArrayBackend.factorize(self, column)
+            codes = numpy.array(codes, dtype='int64')
+            # the trailing `None` keeps the array flat for tuples
+            uniques = numpy.array(uniques + [None], dtype=object)[:-1]
+            return codes, uniques, self._first(codes, len(uniques))
+        values = column.astype('int64')
+        if values.min() >= 0 and values.max() < 4 * count + 1024:
+            # small integers, such as ids or codes, are numbered without
+            # sorting them
+            keys = None
+            first = self._first(values, values.max() + 1)
+            order = numpy.flatnonzero(first < count)
+        else:
+            keys, values = numpy.unique(values, return_inverse=True)
+            first = self._first(values, len(keys))
+            order = numpy.arange(len(keys))
+        # the first occurrences are distinct
+        order = order[numpy.argsort(first[order])]
+        ranks = numpy.zeros(len(first), dtype='int64')
+        ranks[order] = numpy.arange(len(order))
+        uniques = order if keys is None else keys[order]
+        return ranks[values], uniques.astype(column.dtype), first[order]
+
+    def _first(self, codes, size):
+        """Return the index of the first occurrence of each code of
+        `codes`, or `len(codes)` for the codes which do not occur.
+        """
+        first = numpy.empty(size, dtype='int64')
+        first.fill(len(codes))
+        # the last assignment of a repeated index wins
+        first[codes[::-1]] = numpy.arange(len(codes) - 1, -1, -1)
+        return first
+
+    def bincount(self, codes, values, size):
+        values = numpy.asarray(values)
+        totals = numpy.bincount(codes, weights=values, minlength=size)
+        if values.dtype.kind in 'biu':
+            # the sums of integers below 2**53 are exact
+            totals = totals.round().astype('int64')
+        return totals.tolist()
+
+    def group_sum(self, values, keys):
+        if len(keys) == 1:
+            codes, uniques = self.factorize(keys[0])
+            return zip(uniques.tolist(),
+                       self.bincount(codes, values, len(uniques)))
+        # the codes of the columns are combined into a single code
+        columns = [self.factorize(key) for key in keys]
+        codes = numpy.zeros(len(columns[0][0]), dtype='int64')
+        for column, uniques in columns:
+            codes = codes * len(uniques) + column
+        codes, combined, first = self._factorize(codes)
+        totals = self.bincount(codes, values, len(combined))
+        # the key of a group is the key of its first record
+        return zip(zip(*[uniques[column[first]].tolist()
+                         for column, uniques in columns]), totals)
+
+
+backends = {'array': ArrayBackend()}
+if numpy is not None:
+    backends['numpy'] = NumpyBackend()
+
+
+def get_backend(name=None):
+    """Return the backend `name`, or the fastest one available if `name`
+    is empty or not available.
+    """
+    if name in backends:
+        return backends[name]
+    return backends.get('numpy') or backends['array']
+
+
+def group_sum(values, *keys, **kwargs):
+    """Return the `(key, total)` of the sums of the column `values`
+    grouped by the key columns `keys`, in the order of the first
+    occurrence of each key. The key is the value of the key column, or
+    the tuple of the values of the key columns if there are several.
+
+    The backend is given by name with the `backend` keyword argument.
+    """
+    if not keys:
+        raise ValueError("No key columns")
+    return get_backend(kwargs.get('backend')).group_sum(values, keys)
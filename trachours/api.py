@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+from trac.core import Interface, TracError
+
+
+class ITimeRecordChangeListener(Interface):
+    """Extension point interface for components that should get notified
+    when time records are added, changed or deleted.
+    """
+
+    def time_records_changed(tickets, workers):
+        """Called after time records of the tickets `tickets`, worked by
+        `workers`, have been added, changed or deleted.
+        """
+
+
+class ChangesPrunedError(TracError):
+    """The changes of the time records after a position have been
+    pruned from the `ticket_time_changes` table.
+    """
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+"""Archive of the old time records.
+
+The records started and submitted before a cutoff are moved from
+`ticket_time` to `ticket_time_archive`, keeping their id, and their
+seconds are added to the summary rows of their ticket and worker in
+`ticket_time_archive_summary`. The highest archived id is stored in the
+`system` table, so that the new records are numbered after it. The
+cutoff is also stored in the `system` table: the queries of a range
+starting after it only read `ticket_time`, the others read the union of
+both tables, and the total hours of the tickets are summed from the
+summary rows.
+
+The archived records are read-only: they are shown without the inputs
+to change them, and their changes are rejected with a warning.
+"""
+
+import time
+
+from trac.config import IntOption
+from trac.core import Component
+
+from hours import TracHoursPlugin
+from model import TimeRecord
+from sqlhelper import (
+    execute_many, execute_non_query, get_all, get_system_value,
+    set_system_value
+)
+
+
+class TracHoursArchive(Component):
+    """Move the old time records to `ticket_time_archive`."""
+
+    archive_days = IntOption('trachours', 'archive_days', 365,
+        """Number of days after which the time records are moved to the
+        archive by `trac-admin hours archive`.""")
+
+    def archive(self, cutoff, chunk_size=500):
+        """Move the time records started and submitted before the
+        timestamp `cutoff`, or before the current cutoff if it is later,
+        to the archive, committing every `chunk_size` records. Return the
+        cutoff and the number of the archived records.
+        """
+        hours = TracHoursPlugin(self.env)
+        with self.env.db_transaction:
+            # the records are read from both tables from now on
+            cutoff = max(int(cutoff), hours.archived_before)
+            if cutoff != hours.archived_before:
+                set_system_value(self.env, hours.archive_cutoff, cutoff)
+                del hours.archived_before
+        count = 0
+        while True:
+            with self.env.db_transaction:
+                ids = [id_ for id_, in get_all(self.env, """
+                    SELECT id FROM ticket_time
+                    WHERE time_started < %s AND time_submitted < %s
+                    ORDER BY id LIMIT %s
+                    """, cutoff, cutoff, chunk_size)]
+                if not ids:
+                    break
+                self._move(ids)
+                last_id = int(get_system_value(self.env,
+                                               hours.archive_last_id, 0))
+                if ids[-1] > last_id:
+                    set_system_value(self.env, hours.archive_last_id,
+                                     ids[-1])
+            count += len(ids)
+        return cutoff, count
+
+    def _move(self, ids):
+        where = "id IN (%s)" % ','.join(map(str, ids))
+        columns = ','.join(TimeRecord.columns)
+        with self.env.db_transaction:
+            execute_non_query(self.env, """
+                INSERT INTO ticket_time_archive (%s)
+                SELECT %s FROM ticket_time WHERE %s
+                """ % (columns, columns, where))
+            sums = get_all(self.env, """
+                SELECT ticket, worker, SUM(seconds_worked), COUNT(*)
+                FROM ticket_time WHERE %s GROUP BY ticket, worker
+                """ % where)
+            existing = set()
+            for ticket, worker in get_all(self.env, """
+                    SELECT ticket, worker FROM ticket_time_archive_summary
+                    WHERE ticket IN (%s)
+                    """ % ','.join(map(str, set(row[0] for row in sums)))):
+                existing.add((ticket, worker))
+            execute_many(self.env, """
+                UPDATE ticket_time_archive_summary
+                SET seconds=seconds+%s, entries=entries+%s
+                WHERE ticket=%s AND worker=%s
+                """, [(seconds or 0, entries, ticket, worker)
+                      for ticket, worker, seconds, entries in sums
+                      if (ticket, worker) in existing])
+            execute_many(self.env, """
+                INSERT INTO ticket_time_archive_summary
+                  (ticket, worker, seconds, entries)
+                VALUES (%s, %s, %s, %s)
+                """, [(ticket, worker, seconds or 0, entries)
+                      for ticket, worker, seconds, entries in sums
+                      if (ticket, worker) not in existing])
+            execute_non_query(self.env, """
+                DELETE FROM ticket_time WHERE %s""" % where)
+
+    def get_cutoff(self, days=None):
+        """Return the timestamp `days` ago, by default `archive_days`."""
+        if days is None:
+            days = self.archive_days
+        return int(time.time()) - days * 86400
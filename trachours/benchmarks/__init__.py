@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+"""Benchmarks of the hours plugin hot paths.
+
+Run with `python -m trachours.benchmarks --help`.
+"""
+
+import json
+import platform
+import sys
+import time
+from datetime import datetime, timedelta
+from itertools import izip
+
+from genshi.core import Stream
+from trac import __version__ as TRAC_VERSION
+from trac.test import MockRequest
+from trac.ticket.model import Milestone
+from trac.util.datefmt import format_date
+from trac.util.text import exception_to_unicode
+from trac.web.api import RequestDone
+
+from trachours import aggregate
+from trachours.benchmarks.dataset import Dataset
+from trachours.hours import TracHoursPlugin
+from trachours.web_ui import TracHoursRoadmapFilter, TracUserHours
+
+benchmarks = []
+
+
+def benchmark(func):
+    """Register `func(dataset)` as a benchmark. It must return the
+    callable to time, so that its own setup is not measured.
+    """
+    benchmarks.append(func)
+    return func
+
+
+def _request(dataset, path_info, **args):
+    from_date = datetime.now() - timedelta(days=dataset.days)
+    args.setdefault('from_date', format_date(from_date))
+    args.setdefault('to_date', format_date(datetime.now()))
+    return MockRequest(dataset.env, path_info=path_info, args=args)
+
+
+def _send(func, req, *args):
+    """Call a handler that sends its response itself."""
+    try:
+        func(req, *args)
+    except RequestDone:
+        pass
+
+
+def _busiest_ticket(env):
+    for ticket, in env.db_query("""
+            SELECT ticket FROM ticket_time GROUP BY ticket
+            ORDER BY COUNT(*) DESC LIMIT 1
+            """):
+        return ticket
+    return 1
+
+
+@benchmark
+def display_html(dataset):
+    hours = TracHoursPlugin(dataset.env)
+    return lambda: hours.process_timeline(
+        _request(dataset, '/hours', worker_filter='*any'))
+
+
+@benchmark
+def display_html_group_by_worker(dataset):
+    hours = TracHoursPlugin(dataset.env)
+    return lambda: hours.process_timeline(
+        _request(dataset, '/hours', worker_filter='*any', group='worker'))
+
+
+@benchmark
+def hours_csv(dataset):
+    hours = TracHoursPlugin(dataset.env)
+    return lambda: _send(hours.process_timeline,
+                         _request(dataset, '/hours', worker_filter='*any',
+                                  format='csv'))
+
+
+@benchmark
+def hours_rss(dataset):
+    hours = TracHoursPlugin(dataset.env)
+    return lambda: hours.process_timeline(
+        _request(dataset, '/hours', worker_filter='*any', format='rss'))
+
+
+@benchmark
+def process_ticket(dataset):
+    hours = TracHoursPlugin(dataset.env)
+    path_info = '/hours/%s' % _busiest_ticket(dataset.env)
+    return lambda: hours.process_ticket(MockRequest(dataset.env,
+                                                    path_info=path_info))
+
+
+@benchmark
+def ticket_rss(dataset):
+    hours = TracHoursPlugin(dataset.env)
+    path_info = '/hours/%s' % _busiest_ticket(dataset.env)
+    return lambda: hours.process_ticket(
+        MockRequest(dataset.env, path_info=path_info, args={'format': 'rss'}))
+
+
+@benchmark
+def roadmap_filter_stream(dataset):
+    roadmap = TracHoursRoadmapFilter(dataset.env)
+
+    def run():
+        req = MockRequest(dataset.env, path_info='/roadmap')
+        data = {'milestones': list(Milestone.select(dataset.env))}
+        roadmap.filter_stream(req, 'GET', 'roadmap.html', Stream([]), data)
+    return run
+
+
+@benchmark
+def user_hours(dataset):
+    user_hours = TracUserHours(dataset.env)
+    return lambda: user_hours.users(_request(dataset, '/hours/user'))
+
+
+@benchmark
+def user_hours_by_date(dataset):
+    user_hours = TracUserHours(dataset.env)
+    return lambda: user_hours.users(_request(dataset, '/hours/user',
+                                             details='date'))
+
+
+@benchmark
+def user_hours_csv(dataset):
+    user_hours = TracUserHours(dataset.env)
+    return lambda: _send(user_hours.users,
+                         _request(dataset, '/hours/user', format='csv'))
+
+
+@benchmark
+def user_by_date(dataset):
+    user_hours = TracUserHours(dataset.env)
+    worker = dataset.workers[0]
+    return lambda: user_hours.user_by_date(
+        _request(dataset, '/hours/user/dates/' + worker), worker)
+
+
+@benchmark
+def user_by_ticket(dataset):
+    user_hours = TracUserHours(dataset.env)
+    worker = dataset.workers[0]
+    return lambda: user_hours.user_by_ticket(
+        _request(dataset, '/hours/user/tickets/' + worker), worker)
+
+
+def _columns(env):
+    rows = env.db_query("""
+        SELECT worker, ticket, seconds_worked FROM ticket_time""")
+    return zip(*rows) or ([], [], [])
+
+
+@benchmark
+def group_sum_loop(dataset):
+    """The sums by worker and ticket with a dictionary, as the reports
+    did before `trachours.aggregate`, to compare with `group_sum`.
+    """
+    workers, tickets, seconds = _columns(dataset.env)
+
+    def run():
+        totals = {}
+        for key, value in izip(izip(workers, tickets), seconds):
+            if key not in totals:
+                totals[key] = 0
+            totals[key] += value
+        return totals
+    return run
+
+
+@benchmark
+def group_sum(dataset):
+    workers, tickets, seconds = _columns(dataset.env)
+    backend = TracHoursPlugin(dataset.env).aggregate_backend
+    return lambda: aggregate.group_sum(seconds, workers, tickets,
+                                       backend=backend)
+
+
+@benchmark
+def add_ticket_hours(dataset):
+    hours = TracHoursPlugin(dataset.env)
+    worker = dataset.workers[0]
+    ticket = _busiest_ticket(dataset.env)
+    return lambda: hours.add_ticket_hours(ticket, worker, 900,
+                                          comments='benchmark')
+
+
+def run(dataset, repeat=3, names=None):
+    """Run the benchmarks named `names`, or all of them, `repeat` times
+    each against `dataset` and return the timings in seconds. A failing
+    benchmark is reported with its error instead.
+    """
+    results = {}
+    for func in benchmarks:
+        if names and func.__name__ not in names:
+            continue
+        target = func(dataset)
+        timings = []
+        try:
+            for i in xrange(repeat):
+                start = time.time()
+                target()
+                timings.append(time.time() - start)
+        except Exception, e:
+            results[func.__name__] = {'error': exception_to_unicode(e)}
+            continue
+        timings.sort()
+        results[func.__name__] = {
+            'min': timings[0],
+            'median': timings[len(timings) // 2],
+            'max': timings[-1],
+            'repeat': repeat,
+        }
+    return results
+
+
+def version():
+    try:
+        from pkg_resources import get_distribution
+        return get_distribution('TracHours').version
+    except Exception:
+        return None
+
+
+def main(args=None):
+    from optparse import OptionParser
+
+    parser = OptionParser(usage='%prog [options] [benchmark ...]')
+    parser.add_option('--tickets', type='int', default=1000)
+    parser.add_option('--workers', type='int', default=20)
+    parser.add_option('--milestones', type='int', default=10)
+    parser.add_option('--entries', type='int', default=10000,
+                      help='number of ticket_time rows')
+    parser.add_option('--days', type='int', default=365,
+                      help='period over which the hours are logged')
+    parser.add_option('--seed', type='int', default=0)
+    parser.add_option('--backend', choices=['auto', 'numpy', 'array'],
+                      default='auto', help='backend of the group-by sums')
+    parser.add_option('--repeat', type='int', default=3)
+    parser.add_option('--output', '-o', help='write the JSON results to a '
+                                             'file instead of stdout')
+    parser.add_option('--list', action='store_true',
+                      help='list the benchmarks and exit')
+    options, names = parser.parse_args(args)
+
+    if options.list:
+        for func in benchmarks:
+            print func.__name__
+        return
+
+    dataset = Dataset(tickets=options.tickets, workers=options.workers,
+                      milestones=options.milestones, entries=options.entries,
+                      days=options.days, seed=options.seed)
+    start = time.time()
+    dataset.create()
+    setup_time = time.time() - start
+    dataset.env.config.set('trachours', 'aggregate_backend',
+                           options.backend)
+    try:
+        results = run(dataset, options.repeat, names)
+    finally:
+        dataset.destroy()
+
+    output = {
+        'trachours': version(),
+        'trac': TRAC_VERSION,
+        'python': platform.python_version(),
+        'date': datetime.now().isoformat(),
+        'dataset': dataset.params,
+        'setup_time': setup_time,
+        'aggregate_backend': aggregate.get_backend(options.backend).name,
+        'results': results,
+    }
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+    else:
+        json.dump(output, sys.stdout, indent=2, sort_keys=True)
+        print
@@ -0,0 +1,9 @@
+# -*- coding: utf-8 -*-
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+from trachours.benchmarks import main
+
+main()
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+"""Synthetic hours data for benchmarking."""
+
+import random
+import shutil
+import tempfile
+import time
+from datetime import datetime
+
+from trac.test import EnvironmentStub
+from trac.util.datefmt import to_utimestamp, utc
+
+from trachours.admin import TracHoursAdmin
+from trachours.db import SetupTracHours
+
+DAY = 24 * 3600
+
+
+class Dataset(object):
+    """An `EnvironmentStub` populated with `tickets` tickets spread over
+    `milestones` milestones, and `entries` time records logged by
+    `workers` workers over the last `days` days.
+
+    The data is generated from `seed`, so that two datasets built with
+    the same parameters are identical.
+    """
+
+    def __init__(self, tickets=100, workers=10, milestones=5, entries=1000,
+                 days=365, seed=0, chunk_size=10000):
+        self.tickets = tickets
+        self.workers = ['worker%d' % i for i in range(workers)]
+        self.milestones = ['release%d' % i for i in range(milestones)]
+        self.entries = entries
+        self.days = days
+        self.seed = seed
+        self.chunk_size = chunk_size
+        self.now = int(time.time())
+        self.env = None
+
+    @property
+    def params(self):
+        return dict(tickets=self.tickets, workers=len(self.workers),
+                    milestones=len(self.milestones), entries=self.entries,
+                    days=self.days, seed=self.seed)
+
+    def create(self):
+        self.env = EnvironmentStub(default_data=True,
+                                   enable=['trac.*', 'trachours.*'])
+        self.env.path = tempfile.mkdtemp()
+        with self.env.db_transaction as db:
+            SetupTracHours(self.env).upgrade_environment(db)
+        rand = random.Random(self.seed)
+        self._insert_users()
+        self._insert_milestones()
+        self._insert_tickets(rand)
+        self._insert_entries(rand)
+        admin = TracHoursAdmin(self.env)
+        ids = range(1, self.tickets + 1)
+        for idx in xrange(0, len(ids), self.chunk_size):
+            admin.recalc_tickets(ids[idx:idx + self.chunk_size])
+        return self.env
+
+    def destroy(self):
+        if self.env is not None:
+            self.env.reset_db()
+            with self.env.db_transaction as db:
+                for table in db.get_table_names():
+                    if table.startswith('ticket_time'):
+                        # the shadow tables go with their full-text table
+                        db("DROP TABLE IF EXISTS %s" % db.quote(table))
+                db("DELETE FROM system WHERE name LIKE 'trachours.%'")
+            shutil.rmtree(self.env.path)
+            self.env = None
+
+    def _insert_users(self):
+        with self.env.db_transaction as db:
+            db.executemany("""
+                INSERT INTO session (sid, authenticated, last_visit)
+                VALUES (%s, 1, %s)
+                """, [(worker, self.now) for worker in self.workers])
+            db.executemany("""
+                INSERT INTO session_attribute (sid, authenticated, name, value)
+                VALUES (%s, 1, 'email', %s)
+                """, [(worker, worker + '@example.org')
+                      for worker in self.workers])
+
+    def _insert_milestones(self):
+        with self.env.db_transaction as db:
+            db.executemany("""
+                INSERT INTO milestone (name, due, completed, description)
+                VALUES (%s, 0, 0, '')
+                """, [(name,) for name in self.milestones])
+
+    def _insert_tickets(self, rand):
+        created = to_utimestamp(datetime.fromtimestamp(
+            self.now - self.days * DAY, utc))
+        for start in xrange(1, self.tickets + 1, self.chunk_size):
+            stop = min(start + self.chunk_size, self.tickets + 1)
+            tickets = []
+            custom = []
+            for id_ in xrange(start, stop):
+                tickets.append((id_, created, created,
+                                rand.choice(self.workers),
+                                rand.choice(self.workers),
+                                rand.choice(self.milestones),
+                                'Ticket %d' % id_,
+                                'Description of ticket %d. ' % id_ * 20))
+                custom.append((id_, 'estimatedhours',
+                               str(rand.randint(0, 40))))
+                custom.append((id_, 'totalhours', '0'))
+            with self.env.db_transaction as db:
+                db.executemany("""
+                    INSERT INTO ticket (id, type, time, changetime,
+                      component, severity, priority, owner, reporter, cc,
+                      version, milestone, status, resolution, summary,
+                      description, keywords)
+                    VALUES (%s, 'task', %s, %s, 'component1', '', 'major',
+                      %s, %s, '', '', %s, 'new', '', %s, %s, '')
+                    """, tickets)
+                db.executemany("""
+                    INSERT INTO ticket_custom (ticket, name, value)
+                    VALUES (%s, %s, %s)
+                    """, custom)
+
+    def _insert_entries(self, rand):
+        for start in xrange(0, self.entries, self.chunk_size):
+            rows = []
+            for i in xrange(start, min(start + self.chunk_size,
+                                       self.entries)):
+                worker = rand.choice(self.workers)
+                started = self.now - rand.randint(0, self.days * DAY)
+                rows.append((rand.randint(1, self.tickets), started + 60,
+                             worker, worker, started,
+                             rand.randint(1, 16) * 900,
+                             'Work on item %d' % i))
+            with self.env.db_transaction as db:
+                db.executemany("""
+                    INSERT INTO ticket_time (ticket, time_submitted, worker,
+                      submitter, time_started, seconds_worked, comments)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s)
+                    """, rows)
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+"""Caches of the results computed by the hours views."""
+
+import cPickle as pickle
+import hashlib
+import os
+import tempfile
+import time
+
+from metrics import cache_requests
+
+
+class SharedCache(object):
+    """A bounded cache of results, shared by the processes serving an
+    environment.
+
+    The results are pickled in files under the `cache/trachours/<name>`
+    directory of the environment, along with the write generation of the
+    time records they were computed from: they are valid until they
+    expire `ttl` seconds after they are stored, or until the generation
+    is bumped by a write in any process. Beyond `size` files, the oldest
+    are removed. Lookups are counted in the
+    `trachours_cache_requests_total` metric, labeled with `name`.
+    """
+
+    def __init__(self, env, name, size=1000):
+        self.env = env
+        self.name = name
+        self.size = size
+        self.directory = os.path.join(env.path, 'cache', 'trachours', name)
+        self._writes = 0
+
+    def get(self, key, compute, ttl):
+        """Return the result cached for `key`, or the result of `compute()`
+        which is cached for `ttl` seconds.
+        """
+        return self.get_many([key], lambda keys: {key: compute()},
+                             ttl)[key]
+
+    def get_many(self, keys, compute, ttl):
+        """Return a dictionary of the results cached for `keys`, where
+        the missing results are computed together by `compute(missing)`,
+        which returns a dictionary of the results of the keys `missing`.
+        """
+        if ttl <= 0:
+            return compute(list(keys))
+        from hours import TracHoursPlugin
+        # read before the results, so that results computed from records
+        # written meanwhile are not stored under the new generation
+        generation = TracHoursPlugin(self.env).get_generation()
+        now = time.time()
+        results = {}
+        missing = []
+        for key in keys:
+            entry = self._read(key)
+            if entry is not None and entry[0] == generation and \
+                    entry[1] > now:
+                results[key] = entry[3]
+            else:
+                missing.append(key)
+        cache_requests.inc(len(results), cache=self.name, result='hit')
+        cache_requests.inc(len(missing), cache=self.name, result='miss')
+        if missing:
+            computed = compute(missing)
+            results.update(computed)
+            for key in missing:
+                self._write(key, (generation, now + ttl, key, computed[key]))
+        return results
+
+    def invalidate(self):
+        """Drop all the results."""
+        for filename in self._filenames():
+            self._remove(filename)
+
+    def __len__(self):
+        return len(self._filenames())
+
+    # Internal methods
+
+    def _path(self, key):
+        return os.path.join(self.directory,
+                            hashlib.sha1(repr(key)).hexdigest())
+
+    def _read(self, key):
+        """Return the `(generation, expires, key, value)` stored for
+        `key`, or `None`.
+        """
+        try:
+            with open(self._path(key), 'rb') as f:
+                entry = pickle.load(f)
+        except (IOError, OSError):
+            return None
+        except Exception as e:
+            # a file truncated or written by another version
+            self.env.log.debug("Invalid %s cache entry: %s", self.name, e)
+            return None
+        if entry[2] != key:
+            return None  # digest collision
+        return entry
+
+    def _write(self, key, entry):
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            fd, tmp = tempfile.mkstemp(dir=self.directory, prefix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+            path = self._path(key)
+            if os.name == 'nt' and os.path.exists(path):
+                os.remove(path)
+            os.rename(tmp, path)
+        except (IOError, OSError) as e:
+            self.env.log.warning("Cannot write the %s cache: %s",
+                                 self.name, e)
+            return
+        self._writes += 1
+        if self._writes % max(1, self.size // 10) == 0:
+            self._evict()
+
+    def _filenames(self):
+        try:
+            return os.listdir(self.directory)
+        except OSError:
+            return []
+
+    def _remove(self, filename):
+        try:
+            os.remove(os.path.join(self.directory, filename))
+        except OSError:
+            pass  # removed by another process
+
+    def _evict(self):
+        """Remove the oldest files beyond `size`, and the temporary files
+        left by interrupted writes.
+        """
+        now = time.time()
+        entries = []
+        for filename in self._filenames():
+            try:
+                mtime = os.path.getmtime(os.path.join(self.directory,
+                                                      filename))
+            except OSError:
+                continue
+            if filename.startswith('.tmp'):
+                if mtime < now - 3600:
+                    self._remove(filename)
+            else:
+                entries.append((mtime, filename))
+        entries.sort()
+        for mtime, filename in entries[:max(0, len(entries) - self.size)]:
+            self._remove(filename)
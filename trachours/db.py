@@ -11,9 +11,11 @@
 from datetime import datetime
 
 from trac.core import Component, implements
+from trac.db.api import DatabaseManager
 from trac.db.schema import Column, Index, Table
 from trac.env import IEnvironmentSetupParticipant
 from trac.util.datefmt import to_utimestamp, utc
+from trac.util.text import exception_to_unicode
 
 from hours import _
 from sqlhelper import *
@@ -41,7 +43,7 @@ class SetupTracHours(Component):
     # IEnvironmentSetupParticipant methods
 
     db_installed_version = None
-    db_version = 4
+    db_version = 11
 
     def __init__(self):
         self.db_installed_version = self.version()
@@ -51,6 +53,8 @@ class SetupTracHours(Component):
             self.upgrade_environment()
 
     def environment_needs_upgrade(self, db=None):
+        # the writes to ticket_time fail once the index is unusable
+        self.get_comments_index()
         return self._system_needs_upgrade()
 
     def _system_needs_upgrade(self):
@@ -158,10 +162,177 @@ class SetupTracHours(Component):
         if self._needs_user_manual():
             self._do_user_man_update()
 
+    def add_estimate_table(self):
+        ticket_time_estimate_table = Table('ticket_time_estimate',
+                                           key='ticket')[
+            Column('ticket', type='int'),
+            Column('seconds', type='int')]
+
+        create_table(self.env, ticket_time_estimate_table)
+
+        # copy the estimated hours of the existing tickets
+        from hours import TracHoursPlugin
+        hours = TracHoursPlugin(self.env)
+        ids = get_column(self.env, 'ticket', 'id')
+        for idx in xrange(0, len(ids), 1000):
+            hours.update_estimated_hours(ids[idx:idx + 1000])
+
+    def add_changes_table(self):
+        ticket_time_changes_table = Table('ticket_time_changes',
+                                          key='seq')[
+            Column('seq', auto_increment=True),
+            Column('operation'),
+            Column('entry', type='int'),
+            Column('ticket', type='int'),
+            Column('worker'),
+            Column('old_seconds', type='int'),
+            Column('new_seconds', type='int'),
+            Column('time', type='int'),
+            Index(['time'])]
+
+        create_table(self.env, ticket_time_changes_table)
+
+    def add_digest_table(self):
+        ticket_time_digest_table = Table('ticket_time_digest', key='id')[
+            Column('id', auto_increment=True),
+            Column('ticket', type='int'),
+            Column('author'),
+            Column('time', type='int'),
+            Column('comment'),
+            Index(['ticket'])]
+
+        create_table(self.env, ticket_time_digest_table)
+
+    def add_comments_index(self):
+        # full-text index of the comments, on SQLite only, kept in sync
+        # with ticket_time by triggers
+        if not DatabaseManager(self.env).connection_uri.startswith('sqlite:'):
+            return
+        for module in ('fts5', 'fts4'):
+            try:
+                execute_non_query(self.env, """
+                    CREATE VIRTUAL TABLE IF NOT EXISTS ticket_time_fts
+                    USING %s(comments, content='ticket_time')
+                    """ % module)
+            except self.env.db_exc.OperationalError:
+                continue  # the module is not available
+            break
+        else:
+            return
+        execute_non_query(self.env, """
+            CREATE TRIGGER IF NOT EXISTS ticket_time_fts_insert
+            AFTER INSERT ON ticket_time BEGIN
+              INSERT INTO ticket_time_fts (rowid, comments)
+              VALUES (new.id, new.comments);
+            END""")
+        execute_non_query(self.env, """
+            CREATE TRIGGER IF NOT EXISTS ticket_time_fts_delete
+            AFTER DELETE ON ticket_time BEGIN
+              INSERT INTO ticket_time_fts (ticket_time_fts, rowid, comments)
+              VALUES ('delete', old.id, old.comments);
+            END""")
+        execute_non_query(self.env, """
+            CREATE TRIGGER IF NOT EXISTS ticket_time_fts_update
+            AFTER UPDATE OF comments ON ticket_time BEGIN
+              INSERT INTO ticket_time_fts (ticket_time_fts, rowid, comments)
+              VALUES ('delete', old.id, old.comments);
+              INSERT INTO ticket_time_fts (rowid, comments)
+              VALUES (new.id, new.comments);
+            END""")
+        execute_non_query(self.env, """
+            INSERT INTO ticket_time_fts (ticket_time_fts) VALUES ('rebuild')
+            """)
+
+    def get_comments_index(self):
+        """Return the module of the full-text index of the comments,
+        `fts5` or `fts4`, or `''` if the comments are not indexed.
+
+        If SQLite no longer provides the module of the index, the
+        triggers keeping it in sync are dropped, as they would make every
+        write to `ticket_time` fail, and the comments are not indexed
+        anymore.
+        """
+        if not DatabaseManager(self.env).connection_uri.startswith('sqlite:'):
+            return ''
+        with self.env.db_transaction:
+            sql = get_scalar(self.env, """
+                SELECT sql FROM sqlite_master
+                WHERE type='table' AND name='ticket_time_fts'
+                """)
+            triggers = get_scalar(self.env, """
+                SELECT COUNT(*) FROM sqlite_master
+                WHERE type='trigger' AND name IN ('ticket_time_fts_insert',
+                  'ticket_time_fts_delete', 'ticket_time_fts_update')
+                """)
+            if not sql or triggers != 3:
+                return ''
+            try:
+                get_scalar(self.env, """
+                    SELECT rowid FROM ticket_time_fts LIMIT 0""")
+            except self.env.db_exc.OperationalError as e:
+                if 'no such module' not in exception_to_unicode(e):
+                    raise
+                self.log.warning("Searching the comments of the hours "
+                                 "without the full-text index: %s",
+                                 exception_to_unicode(e))
+                for operation in ('insert', 'delete', 'update'):
+                    execute_non_query(self.env, """
+                        DROP TRIGGER IF EXISTS ticket_time_fts_%s
+                        """ % operation)
+                return ''
+        return 'fts5' if 'fts5' in sql.lower() else 'fts4'
+
+    def add_time_submitted_index(self):
+        # the range queried by the timeline
+        execute_non_query(self.env, """
+            CREATE INDEX ticket_time_time_submitted_idx
+            ON ticket_time (time_submitted)
+            """)
+
+    def add_archive_tables(self):
+        # the old time records, moved from ticket_time with their id
+        ticket_time_archive_table = Table('ticket_time_archive', key='id')[
+            Column('id', type='int'),
+            Column('ticket', type='int'),
+            Column('time_submitted', type='int'),
+            Column('worker'),
+            Column('submitter'),
+            Column('time_started', type='int'),
+            Column('seconds_worked', type='int'),
+            Column('comments'),
+            Index(['ticket']),
+            Index(['worker']),
+            Index(['time_started']),
+            Index(['time_submitted'])]
+
+        # the seconds of the archived records by ticket and worker
+        ticket_time_archive_summary_table = Table(
+                'ticket_time_archive_summary', key=('ticket', 'worker'))[
+            Column('ticket', type='int'),
+            Column('worker'),
+            Column('seconds', type='int'),
+            Column('entries', type='int'),
+            Index(['worker'])]
+
+        create_table(self.env, ticket_time_archive_table)
+        create_table(self.env, ticket_time_archive_summary_table)
+
+    def add_write_generation(self):
+        # the row bumped in place by each write, see bump_generation
+        if get_system_value(self.env, 'trachours.write_generation') is None:
+            set_system_value(self.env, 'trachours.write_generation', 0)
+
     # ordered steps for upgrading
     steps = [
         [create_db, update_custom_fields],  # version 1
         [add_query_table],  # version 2
         [initialize_old_tickets],  # version 3
         [install_manual],  # version 4
+        [add_estimate_table],  # version 5
+        [add_changes_table],  # version 6
+        [add_digest_table],  # version 7
+        [add_comments_index],  # version 8
+        [add_time_submitted_index],  # version 9
+        [add_archive_tables],  # version 10
+        [add_write_generation],  # version 11
     ]
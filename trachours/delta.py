@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+"""Incremental feed of the changes of the time records.
+
+`/hours/changes?since=<cursor>` returns, as JSON, the time records
+added or changed after the position `cursor` of a previous response,
+and the entries deleted since then. Every addition, edit and deletion
+of a record is numbered in the `ticket_time_changes` table, and the
+position is the number of the last change read: the ids of the records
+are not a position, as SQLite reuses the highest id once deleted.
+
+Without `since`, all the records are returned first, by pages ordered
+by id, and then the changes made since the first page was read. The changes
+are pruned after `[trachours] changes_retention_days`: a position older
+than the pruned changes is answered with `410 Gone`, and the records
+are to be read again from the start.
+
+The position does not move past the changes of the last
+`settle_seconds`, as the transactions still open when they were read
+may log changes numbered before them: these changes are returned again
+by the next request.
+"""
+
+import json
+import time
+
+from trac.config import IntOption
+from trac.core import Component, TracError, implements
+from trac.web.api import IRequestHandler
+
+from api import ChangesPrunedError
+from hours import TracHoursPlugin, _
+from metrics import request_seconds
+from sqlhelper import get_all, get_scalar, get_system_value
+
+columns = ('id', 'ticket', 'time_submitted', 'worker', 'submitter',
+           'time_started', 'seconds_worked', 'comments')
+
+
+def parse_cursor(cursor):
+    """Return the `(seq, entry)` of the position `cursor`, where `entry`
+    is the last record of the initial pages, or `None` once all the
+    records have been read.
+    """
+    try:
+        seq, sep, entry = cursor.partition('.')
+        return int(seq), int(entry) if sep else None
+    except (AttributeError, ValueError):
+        raise TracError(_("Invalid cursor: {cursor}").format(cursor=cursor))
+
+
+def format_cursor(seq, entry=None):
+    if entry is None:
+        return '%d' % seq
+    return '%d.%d' % (seq, entry)
+
+
+class TracHoursDeltaFeed(Component):
+    """Serve the changes of the time records since a position at
+    `/hours/changes`.
+    """
+
+    implements(IRequestHandler)
+
+    page_size = IntOption('trachours', 'changes_page_size', 1000,
+        """Maximum number of records, or of changes, returned by a
+        request to `/hours/changes`.""")
+
+    # number of seconds after which the changes are assumed committed
+    settle_seconds = 60
+
+    # IRequestHandler methods
+
+    def match_request(self, req):
+        return req.path_info.rstrip('/') == '/hours/changes'
+
+    @request_seconds.timed(handler='changes')
+    def process_request(self, req):
+        req.perm.require('TICKET_VIEW_HOURS')
+        try:
+            limit = int(req.args.get('limit', self.page_size))
+        except ValueError:
+            raise TracError(_("Invalid limit: {limit}").format(
+                limit=req.args.get('limit')))
+        limit = max(1, min(limit, self.page_size))
+        since = req.args.get('since')
+        if not since:
+            position = (self.get_last_seq(), 0)
+        elif since == 'now':
+            position = (self.get_last_seq(), None)
+        else:
+            position = parse_cursor(since)
+        try:
+            delta = self.get_delta(position, limit)
+        except ChangesPrunedError:
+            # the consumer has to read all the records again
+            req.send(json.dumps({'reset': True}), 'application/json', 410)
+        req.send(json.dumps(delta), 'application/json')
+
+    # Internal methods
+
+    def get_last_seq(self):
+        """Return the number of the last change older than
+        `settle_seconds`, before which all the changes are committed.
+        """
+        hours = TracHoursPlugin(self.env)
+        return max(get_scalar(self.env, """
+                       SELECT MAX(seq) FROM ticket_time_changes
+                       WHERE time < %s
+                       """, 0, int(time.time()) - self.settle_seconds) or 0,
+                   int(get_system_value(self.env, hours.changes_pruned, 0)))
+
+    def get_delta(self, position, limit):
+        """Return the records added or changed and the entries deleted
+        after `position`, as a dictionary of
+         * `records`: the current values of the records,
+         * `deleted`: the `id`, `ticket` and `worker` of the deleted
+           entries, which are to be applied before the records, as the id
+           of a deleted record can be reused,
+         * `cursor`: the position after these changes, or before the
+           changes of the last `settle_seconds`,
+         * `more`: whether there are more changes to read from the new
+           position.
+        """
+        seq, entry = position
+        # the archived records are included
+        table = TracHoursPlugin(self.env).time_records_table()
+        if entry is not None:
+            records = get_all(self.env, """
+                SELECT %s FROM %s WHERE id > %%s
+                ORDER BY id LIMIT %%s
+                """ % (','.join(columns), table), entry, limit)
+            if len(records) == limit:
+                cursor = format_cursor(seq, records[-1][0])
+                more = True
+            else:
+                cursor = format_cursor(seq)
+                more = self.get_last_seq() > seq
+            return {'cursor': cursor, 'more': more,
+                    'records': [dict(zip(columns, record))
+                                for record in records],
+                    'deleted': []}
+
+        with self.env.db_transaction:
+            changes = TracHoursPlugin(self.env).get_changes(seq, limit)
+            # the recent changes are returned again by the next request
+            horizon = time.time() - self.settle_seconds
+            seq = max([seq] + [change['seq'] for change in changes
+                               if change['time'] < horizon])
+            deleted = {}
+            changed = set()
+            for change in changes:
+                if change['operation'] == 'delete':
+                    deleted[change['entry']] = {'id': change['entry'],
+                                                'ticket': change['ticket'],
+                                                'worker': change['worker']}
+                else:
+                    changed.add(change['entry'])
+            changed = sorted(changed)
+            records = []
+            for idx in xrange(0, len(changed), 1000):
+                records.extend(get_all(self.env, """
+                    SELECT %s FROM %s WHERE id IN (%s)
+                    ORDER BY id
+                    """ % (','.join(columns), table,
+                           ','.join(map(str, changed[idx:idx + 1000])))))
+        return {
+            'cursor': format_cursor(seq),
+            'more': len(changes) == limit and seq == changes[-1]['seq'],
+            'records': [dict(zip(columns, record)) for record in records],
+            'deleted': [deleted[id_] for id_ in sorted(deleted)],
+        }
@@ -8,17 +8,17 @@
 #
 
 
-def total_hours(feed):
-    """return a dictionary in the form of {worker: hours_worked}"""
-    hours_dict = {}
+from trachours.aggregate import group_sum
+
 
+def total_hours(feed, backend=None):
+    """return a dictionary in the form of {worker: hours_worked}"""
+    workers = []
+    hours = []
     for entry in feed.entries:
         # the feed titles are formulated to permit easy extraction of hours
-        title = entry.title
-        split = title.split()
-        hours, minutes = split[0].split(':')
-        time_worked = float(hours) + float(minutes) / 60.  # in hours
-        worker = split[-1]
-        hours_dict.setdefault(worker, 0)
-        hours_dict[worker] += time_worked
-    return hours_dict
+        split = entry.title.split()
+        hours_, minutes = split[0].split(':')
+        hours.append(float(hours_) + float(minutes) / 60.)  # in hours
+        workers.append(split[-1])
+    return dict(group_sum(hours, workers, backend=backend))
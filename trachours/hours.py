@@ -13,17 +13,26 @@ import re
 import time
 from StringIO import StringIO
 from datetime import datetime, timedelta
+from itertools import groupby
+from operator import attrgetter, itemgetter
 from urllib import urlencode
 
 from genshi.filters import Transformer
+from trac.config import BoolOption, ChoiceOption, IntOption
+from trac.cache import cached
 from trac.core import *
+from trac.db.api import DatabaseManager
 from trac.perm import IPermissionRequestor
-from trac.ticket.api import ITicketManipulator, TicketSystem
+from trac.ticket.api import (
+    ITicketChangeListener, ITicketManipulator, TicketSystem
+)
+from trac.resource import ResourceNotFound
 from trac.ticket.model import Ticket
 from trac.ticket.query import Query
 from trac.util.datefmt import (
-    format_date, parse_date, user_time, to_timestamp, utc
+    format_date, http_date, parse_date, user_time, to_timestamp, utc
 )
+from trac.util.text import exception_to_unicode
 from trac.util.html import html as tag
 from trac.util.translation import domain_functions
 from trac.web.api import IRequestHandler, ITemplateStreamFilter
@@ -33,8 +42,18 @@ from trac.web.chrome import (
     web_context
 )
 
+from aggregate import group_sum
+from api import ChangesPrunedError, ITimeRecordChangeListener
+from metrics import (
+    digest_comments, entries_written, request_seconds, write_seconds
+)
+from model import TimeRecord
+from profiling import memory_phase
 from sqlhelper import *
-from utils import get_all_users
+from utils import (
+    HoursFormatter, format_hours, format_hours_and_minutes, get_all_users,
+    parse_estimated_hours
+)
 
 _, tag_, N_, ngettext, add_domain = \
     domain_functions('trachours', '_', 'tag_', 'N_', 'ngettext', 'add_domain')
@@ -46,6 +65,7 @@ class TracHoursPlugin(Component):
                IRequestHandler,
                ITemplateProvider,
                ITemplateStreamFilter,
+               ITicketChangeListener,
                ITicketManipulator)
 
     date_format = '%B %d, %Y'  # XXX should go to api ?
@@ -57,6 +77,55 @@ class TracHoursPlugin(Component):
               dict(name='time_started', label=_('Work done on')),
               dict(name='time_submitted', label=_('Work recorded on'))]
 
+    change_listeners = ExtensionPoint(ITimeRecordChangeListener)
+
+    aggregate_backend = ChoiceOption('trachours', 'aggregate_backend',
+        ['auto', 'numpy', 'array'],
+        """Backend summing the hours of the reports by group: `numpy`,
+        `array` for the standard library, or `auto` for numpy when it is
+        installed. `numpy` falls back to `array` when numpy is not
+        installed.""")
+
+    changes_retention = IntOption('trachours', 'changes_retention_days', 90,
+        """Number of days the changes of the time records are kept in
+        the `ticket_time_changes` table. `0` keeps them forever.""")
+
+    comment_digest = BoolOption('trachours', 'comment_digest', False,
+        """Post the comments of the hours logged on a ticket as a single
+        digest comment per ticket, every `comment_digest_interval`
+        seconds, rather than as one ticket change per time record.""")
+
+    comment_digest_interval = IntOption('trachours',
+        'comment_digest_interval', 3600,
+        """Number of seconds the comments of the hours logged on a ticket
+        are collected before their digest is posted, when
+        `comment_digest` is enabled. The digests are posted while hours
+        are logged, or with `trac-admin hours digest`.""")
+
+    comment_digest_notify = BoolOption('trachours',
+        'comment_digest_notify', False,
+        """Send the ticket notifications of the digest comments, like for
+        any other change of the ticket. The notifications are sent by the
+        notification system of Trac 1.2 and later, and are not sent by
+        default, as the comments of the hours logged without a digest do
+        not send any either.""")
+
+    # the number of the writes of the hours, read by the shared caches
+    write_generation = 'trachours.write_generation'
+
+    # the time before which the time records may have been archived
+    archive_cutoff = 'trachours.archive_cutoff'
+
+    # the highest id of the archived time records
+    archive_last_id = 'trachours.archive_last_id'
+
+    # the number of the last pruned change
+    changes_pruned = 'trachours.changes_pruned'
+
+    # minimum number of seconds between two prunings of the changes
+    prune_interval = 3600
+    _last_prune = 0
+
     def __init__(self):
         from pkg_resources import resource_filename
 
@@ -64,34 +133,63 @@ class TracHoursPlugin(Component):
 
     def tickets_with_hours(self):
         """return all ticket.ids with hours"""
-        return set(get_column(self.env, 'ticket_time', 'ticket'))
+        return set(ticket for ticket, in get_all(self.env, """
+            SELECT DISTINCT ticket FROM %s""" % self.ticket_seconds_table()))
 
     def update_ticket_hours(self, ids):
         """
         update the totalhours ticket field from the tracked hours information
         * ids: ticket ids (list)
         """
-        results = get_all_dict(self.env, """
-            SELECT SUM(seconds_worked) AS t, ticket
-            FROM ticket_time WHERE ticket IN (%s) GROUP BY ticket
-            """ % ",".join(map(str, ids)))
-
-        # If no work has been logged for a ticket id, nothing will be
-        # returned for that id, but we want it to return 0
-        for id in ids:
-            id_ismember = False
-            for result in results:
-                if id == result['ticket']:
-                    id_ismember = True
-            if not id_ismember:
-                results.append({'ticket': id, 't': 0})
-
-        for result in results:
-            formatted = '%8.2f' % (float(result['t']) / 3600.0)
-            execute_non_query(self.env, """
+        ids = set(ids)
+        if not ids:
+            return
+        totals = dict((id_, 0) for id_ in ids)
+        with self.env.db_transaction:
+            for ticket, total in get_all(self.env, """
+                    SELECT ticket, SUM(seconds_worked) FROM %s
+                    WHERE ticket IN (%s) GROUP BY ticket
+                    """ % (self.ticket_seconds_table(),
+                           ",".join(map(str, ids)))):
+                totals[ticket] = total or 0
+
+            execute_many(self.env, """
                 UPDATE ticket_custom SET value=%s
                 WHERE name='totalhours' AND ticket=%s
-                """, formatted, result['ticket'])
+                """, [('%8.2f' % (float(total) / 3600.0), ticket)
+                      for ticket, total in totals.iteritems()])
+
+    def update_estimated_hours(self, ids):
+        """Copy the `estimatedhours` field of the tickets `ids` to the
+        `ticket_time_estimate` table, in seconds, so that the estimated
+        hours can be summed by the database.
+        """
+        ids = set(ids)
+        if not ids:
+            return
+        where = "ticket IN (%s)" % ",".join(map(str, ids))
+        with self.env.db_transaction:
+            rows = [(ticket, parse_estimated_hours(value))
+                    for ticket, value in get_all(self.env, """
+                        SELECT ticket, value FROM ticket_custom
+                        WHERE name='estimatedhours' AND %s
+                        """ % where)]
+            execute_non_query(self.env, """
+                DELETE FROM ticket_time_estimate WHERE %s""" % where)
+            execute_many(self.env, """
+                INSERT INTO ticket_time_estimate (ticket, seconds)
+                VALUES (%s, %s)""", [row for row in rows if row[1]])
+
+    def get_estimated_hours(self, ids):
+        """Return the estimated seconds of the tickets `ids` which have
+        an estimate.
+        """
+        if not ids:
+            return {}
+        return dict(get_all(self.env, """
+            SELECT ticket, seconds FROM ticket_time_estimate
+            WHERE ticket IN (%s)
+            """ % ",".join(map(str, ids))))
 
     def get_ticket_hours(self, ticket_id, from_date=None, to_date=None,
                          worker_filter=None):
@@ -99,6 +197,67 @@ class TracHoursPlugin(Component):
         if not ticket_id:
             return []
 
+        where, args = self._ticket_hours_where(ticket_id, from_date, to_date,
+                                               worker_filter)
+        return get_all_dict(self.env, """
+            SELECT * FROM %s WHERE %s
+            """ % (self._ticket_hours_table(from_date), where), *args)
+
+    def get_time_records(self, ticket_id, from_date=None, to_date=None,
+                         worker_filter=None, order_by=None):
+        """Return the records of `get_ticket_hours` as `TimeRecord`s,
+        sorted by the columns of `order_by`.
+        """
+        if not ticket_id:
+            return []
+
+        where, args = self._ticket_hours_where(ticket_id, from_date, to_date,
+                                               worker_filter)
+        if order_by:
+            where += " ORDER BY " + ", ".join(order_by)
+        return [TimeRecord(*row) for row in get_all(self.env, """
+            SELECT %s FROM %s WHERE %s
+            """ % (','.join(TimeRecord.columns),
+                   self._ticket_hours_table(from_date), where), *args)]
+
+    def get_ticket_hours_totals(self, ticket_id, group, from_date=None,
+                                to_date=None, worker_filter=None):
+        """Return the seconds worked of the records of `get_ticket_hours`
+        by value of their `group` column.
+        """
+        if not ticket_id:
+            return {}
+
+        where, args = self._ticket_hours_where(ticket_id, from_date, to_date,
+                                               worker_filter)
+        return dict(get_all(self.env, """
+            SELECT %s, SUM(seconds_worked) FROM %s WHERE %s
+            GROUP BY %s
+            """ % (group, self._ticket_hours_table(from_date), where, group),
+            *args))
+
+    def get_estimated_hours_totals(self, ticket_id, group, from_date=None,
+                                   to_date=None, worker_filter=None):
+        """Return the estimated seconds of the tickets of the records of
+        `get_ticket_hours` by value of their `group` column, each ticket
+        being counted once per group.
+        """
+        if not ticket_id:
+            return {}
+
+        where, args = self._ticket_hours_where(ticket_id, from_date, to_date,
+                                               worker_filter)
+        # the group column is aliased, as it may be the ticket itself
+        return dict(get_all(self.env, """
+            SELECT t.grp, SUM(e.seconds)
+            FROM (SELECT DISTINCT %s AS grp, ticket FROM %s WHERE %s) t
+            JOIN ticket_time_estimate e ON e.ticket = t.ticket
+            GROUP BY t.grp
+            """ % (group, self._ticket_hours_table(from_date), where),
+            *args))
+
+    def _ticket_hours_where(self, ticket_id, from_date, to_date,
+                            worker_filter):
         args = []
         if isinstance(ticket_id, int):
             where = "ticket = %s"
@@ -120,14 +279,76 @@ class TracHoursPlugin(Component):
             where += " AND worker = %s"
             args.append(worker_filter)
 
-        return get_all_dict(self.env, """
-            SELECT * FROM ticket_time WHERE %s
-            """ % where, *args)
+        return where, args
+
+    def _ticket_hours_table(self, from_date):
+        start = None
+        if from_date:
+            start = int(time.mktime(from_date.timetuple()))
+        return self.time_records_table(start)
+
+    @cached
+    def archived_before(self):
+        """The timestamp before which the time records may have been
+        moved to `ticket_time_archive`, or 0 if none were. It is read
+        again by all the processes once it is deleted.
+        """
+        return int(get_system_value(self.env, self.archive_cutoff, 0))
+
+    def get_archived_ids(self, ids):
+        """Return the set of the ids among `ids` of the time records moved
+        to `ticket_time_archive`, which cannot be changed.
+        """
+        archived = set()
+        if not self.archived_before:
+            return archived
+        ids = sorted(set(ids))
+        for idx in xrange(0, len(ids), 1000):
+            archived.update(id_ for id_, in get_all(self.env, """
+                SELECT id FROM ticket_time_archive WHERE id IN (%s)
+                """ % ','.join(map(str, ids[idx:idx + 1000]))))
+        return archived
+
+    def time_records_table(self, start=None, alias='ticket_time'):
+        """Return the SQL table expression of the time records, named
+        `alias`, for a query of the records started or submitted from the
+        timestamp `start`: `ticket_time`, or its union with
+        `ticket_time_archive` if the query reaches into archived time.
+        """
+        cutoff = self.archived_before
+        if not cutoff or start is not None and start >= cutoff:
+            table = 'ticket_time'
+        else:
+            table = """(SELECT %(columns)s FROM ticket_time
+                        UNION ALL
+                        SELECT %(columns)s FROM ticket_time_archive)""" \
+                    % {'columns': ','.join(TimeRecord.columns)}
+        if table == alias:
+            return table
+        return '%s %s' % (table, alias)
+
+    def ticket_seconds_table(self, alias='ticket_time'):
+        """Return the SQL table expression of the `ticket`, `worker` and
+        `seconds_worked` of the time records, named `alias`, where the
+        archived records are summed by ticket and worker.
+        """
+        if not self.archived_before:
+            table = 'ticket_time'
+        else:
+            table = """(SELECT ticket, worker, seconds_worked
+                        FROM ticket_time
+                        UNION ALL
+                        SELECT ticket, worker, seconds
+                        FROM ticket_time_archive_summary)"""
+        if table == alias:
+            return table
+        return '%s %s' % (table, alias)
 
     def get_total_hours(self, ticket_id):
         """return total SECONDS associated with ticket_id"""
-        return sum([hour['seconds_worked'] for hour in
-                    self.get_ticket_hours(int(ticket_id))])
+        return get_scalar(self.env, """
+            SELECT SUM(seconds_worked) FROM %s WHERE ticket=%%s
+            """ % self.ticket_seconds_table(), 0, int(ticket_id)) or 0
 
     def add_ticket_hours(self, tid, worker, seconds_worked, submitter=None,
                          time_started=None, comments=''):
@@ -141,6 +362,20 @@ class TracHoursPlugin(Component):
                          than now
         * comments : comments to record
         """
+        self.add_many_ticket_hours(tid, worker, [(seconds_worked, comments)],
+                                   submitter, time_started)
+
+    def add_many_ticket_hours(self, tid, worker, entries, submitter=None,
+                              time_started=None):
+        """
+        add several hours entries to a ticket in a single transaction:
+        * tid : id of the ticket
+        * worker : who did the work on the ticket
+        * entries : iterable of (seconds_worked, comments) pairs
+        * submitter : who recorded the work, if different from the worker
+        * time_started : when the work was begun (a Datetime object) if other
+                         than now
+        """
 
         # prepare the data
         if submitter is None:
@@ -151,31 +386,330 @@ class TracHoursPlugin(Component):
             # time_started = datetime.now(utc)
         # time_started = to_utimestamp(time_started)
         time_started = int(time.mktime(time_started.timetuple()))
-        comments = comments.strip()
+        time_submitted = int(time.time())
+        rows = [(tid, time_submitted, worker, submitter, time_started,
+                 int(seconds_worked), (comments or '').strip())
+                for seconds_worked, comments in entries]
+        if not rows:
+            return
 
         # execute the SQL
-        sql = """INSERT INTO ticket_time(ticket,
-                                         time_submitted,
-                                         worker,
-                                         submitter,
-                                         time_started,
-                                         seconds_worked,
-                                         comments) VALUES
-(%s, %s, %s, %s, %s, %s, %s)"""
-        execute_non_query(self.env, sql, tid, int(time.time()),
-                          worker, submitter, time_started,
-                          seconds_worked, comments)
-
-        # update the hours on the ticket
-        self.update_ticket_hours([tid])
+        with write_seconds.time(operation='add'):
+            with self.env.db_transaction:
+                self.log_inserts(self.insert_records(rows), rows)
+
+                # update the hours on the ticket
+                self.update_ticket_hours([tid])
+        entries_written.inc(len(rows), operation='add')
+        self.time_records_changed([tid], [worker])
+
+    def update_time_records(self, worker, inserts=(), updates=(),
+                            deletes=(), submitter=None):
+        """Apply changes to the time records of `worker` in a single
+        transaction, and update the total hours of the changed tickets:
+        * inserts : `(ticket, time_started, seconds_worked, comments)` of
+                    the records to add, `time_started` being a timestamp
+        * updates : `(id, seconds_worked, comments)` of the records to
+                    change, `comments` being `None` to keep the comments
+        * deletes : ids of the records to delete
+        * submitter : who recorded the work, if different from the worker
+        Return the set of changed tickets.
+        """
+        if submitter is None:
+            submitter = worker
+        time_submitted = int(time.time())
+        inserts = [(ticket, time_submitted, worker, submitter,
+                    int(time_started), int(seconds_worked),
+                    (comments or '').strip())
+                   for ticket, time_started, seconds_worked, comments
+                   in inserts]
+        updates = dict((id_, (int(seconds_worked), comments))
+                       for id_, seconds_worked, comments in updates)
+        deletes = set(deletes)
+        if not (inserts or updates or deletes):
+            return set()
+
+        with write_seconds.time(operation='update_many'):
+            with self.env.db_transaction:
+                # the current values, for the log of the changes
+                old = {}
+                ids = sorted(set(updates) | deletes)
+                for idx in xrange(0, len(ids), 1000):
+                    for id_, ticket, seconds_worked in get_all(self.env, """
+                            SELECT id, ticket, seconds_worked FROM ticket_time
+                            WHERE worker=%%s AND id IN (%s)
+                            """ % ','.join(map(str, ids[idx:idx + 1000])),
+                            worker):
+                        old[id_] = (ticket, seconds_worked)
+                updated = [(id_, old[id_][0], worker, old[id_][1],
+                            updates[id_][0])
+                           for id_ in sorted(updates) if id_ in old]
+                deleted = [(id_, old[id_][0], worker, old[id_][1], None)
+                           for id_ in sorted(deletes) if id_ in old]
+
+                self.log_inserts(self.insert_records(inserts), inserts)
+                execute_many(self.env, """
+                    UPDATE ticket_time SET seconds_worked=%s WHERE id=%s
+                    """, [(change[4], change[0]) for change in updated])
+                execute_many(self.env, """
+                    UPDATE ticket_time SET comments=%s WHERE id=%s
+                    """, [(updates[change[0]][1].strip(), change[0])
+                          for change in updated
+                          if updates[change[0]][1] is not None])
+                execute_many(self.env, """
+                    DELETE FROM ticket_time WHERE id=%s
+                    """, [(change[0],) for change in deleted])
+                self.log_changes('update', updated)
+                self.log_changes('delete', deleted)
+
+                tickets = set(row[0] for row in inserts)
+                tickets.update(change[1] for change in updated + deleted)
+                self.update_ticket_hours(tickets)
+        entries_written.inc(len(inserts), operation='add')
+        entries_written.inc(len(updated), operation='update')
+        entries_written.inc(len(deleted), operation='delete')
+        if tickets:
+            self.time_records_changed(tickets, [worker])
+        return tickets
 
     def delete_ticket_hours(self, tid):
         """Delete hours for a ticket.
 
         :param tid: id of the ticket
         """
+        with write_seconds.time(operation='delete_ticket'):
+            with self.env.db_transaction:
+                deleted = get_all(self.env, """
+                    SELECT id, worker, seconds_worked FROM %s
+                    WHERE ticket=%%s""" % self.time_records_table(), tid)
+                execute_non_query(self.env, """
+                    DELETE FROM ticket_time WHERE ticket=%s""", tid)
+                if self.archived_before:
+                    execute_non_query(self.env, """
+                        DELETE FROM ticket_time_archive WHERE ticket=%s
+                        """, tid)
+                    execute_non_query(self.env, """
+                        DELETE FROM ticket_time_archive_summary
+                        WHERE ticket=%s""", tid)
+                self.log_changes('delete', [(id_, tid, worker, seconds, None)
+                                            for id_, worker, seconds
+                                            in deleted])
+        if deleted:
+            self.time_records_changed([tid], [row[1] for row in deleted])
+
+    def get_last_id(self):
+        """Return the highest id of the time records."""
+        return get_scalar(self.env, """
+            SELECT MAX(id) FROM ticket_time""") or 0
+
+    def insert_records(self, rows, chunk_size=100):
+        """Add the time records `rows`, tuples of `(ticket,
+        time_submitted, worker, submitter, time_started, seconds_worked,
+        comments)`, `chunk_size` at a time, and return their ids.
+        """
+        columns = TimeRecord.columns[1:]
+        uri = DatabaseManager(self.env).connection_uri
+        ids = []
+        if rows and self.archived_before and not uri.startswith('postgres:'):
+            # SQLite, and MySQL before 8.0 once restarted, number a new
+            # record after the highest id of ticket_time, which may be
+            # below the archived ids once the last records are deleted
+            last_id = int(get_system_value(self.env, self.archive_last_id,
+                                           0))
+            if self.get_last_id() < last_id:
+                execute_non_query(self.env, """
+                    INSERT INTO ticket_time (id, %s) VALUES (%%s%s)
+                    """ % (','.join(columns), ',%s' * len(columns)),
+                    last_id + 1, *rows[0])
+                ids.append(last_id + 1)
+                rows = rows[1:]
+        return ids + insert_rows(self.env, 'ticket_time', columns, rows,
+                                 chunk_size)
+
+    def log_inserts(self, ids, rows):
+        """Record the time records `rows` added by `insert_records` with
+        the `ids` in `ticket_time_changes`.
+        """
+        self.log_changes('insert', [(id_, row[0], row[2], None, row[5])
+                                    for id_, row in zip(ids, rows)])
+
+    def log_changes(self, operation, changes):
+        """Record the changes of time records in `ticket_time_changes`,
+        where `changes` lists the `(entry, ticket, worker, old_seconds,
+        new_seconds)` of the records changed by `operation`: `insert`,
+        `update` or `delete`. The changes are recorded in the transaction
+        of the caller, if any.
+        """
+        now = int(time.time())
+        execute_many(self.env, """
+            INSERT INTO ticket_time_changes (operation, entry, ticket,
+              worker, old_seconds, new_seconds, time)
+            VALUES (%s, %s, %s, %s, %s, %s, %s)
+            """, [(operation,) + tuple(change) + (now,)
+                  for change in changes])
+
+    def get_changes(self, since=0, limit=None):
+        """Return the changes of the time records numbered after
+        `since`, ordered by number, as dictionaries of the columns of
+        `ticket_time_changes`: `seq`, `operation` (`insert`, `update` or
+        `delete`), `entry`, `ticket`, `worker`, `old_seconds`,
+        `new_seconds` and `time`. At most `limit` changes are returned.
+        Raise `ChangesPrunedError` if changes after `since` have been
+        pruned.
+        """
+        with self.env.db_transaction:
+            if since < int(get_system_value(self.env, self.changes_pruned,
+                                            0)):
+                raise ChangesPrunedError(_("The changes after {seq} have "
+                                           "been pruned").format(seq=since))
+            return get_all_dict(self.env, """
+                SELECT seq, operation, entry, ticket, worker, old_seconds,
+                       new_seconds, time
+                FROM ticket_time_changes WHERE seq > %%s ORDER BY seq%s
+                """ % (' LIMIT %d' % limit if limit else ''), since)
+
+    def prune_changes(self):
+        """Delete the changes older than `[trachours]
+        changes_retention_days`, and return their number. The last change
+        is kept, so that its number is not reused.
+        """
+        TracHoursPlugin._last_prune = time.time()
+        if self.changes_retention <= 0:
+            return 0
+        horizon = int(time.time()) - self.changes_retention * 24 * 3600
+        with self.env.db_transaction:
+            last = get_scalar(self.env, """
+                SELECT MAX(seq) FROM ticket_time_changes WHERE time < %s
+                """, 0, horizon)
+            if last is None:
+                return 0
+            if last == get_scalar(self.env, """
+                    SELECT MAX(seq) FROM ticket_time_changes"""):
+                last -= 1
+            count = get_scalar(self.env, """
+                SELECT COUNT(*) FROM ticket_time_changes WHERE seq <= %s
+                """, 0, last)
+            if count:
+                execute_non_query(self.env, """
+                    DELETE FROM ticket_time_changes WHERE seq <= %s""",
+                    last)
+                set_system_value(self.env, self.changes_pruned, last)
+        return count
+
+    def get_generation(self):
+        """Return the write generation of the hours, which is bumped after
+        each write of the time records or of the tickets.
+        """
+        return int(get_system_value(self.env, self.write_generation, 0))
+
+    def bump_generation(self):
+        """Bump the write generation of the hours, invalidating the results
+        of the shared caches in all the processes. It is bumped after the
+        write is committed, so that no result computed before the write is
+        cached under the new generation.
+        """
+        with self.env.db_transaction as db:
+            # incremented in place, so that concurrent bumps are
+            # serialized on the row added by the upgrade of the database
+            execute_non_query(self.env, """
+                UPDATE system SET value=%s WHERE name=%%s
+                """ % db.cast(db.cast('value', 'int') + '+1', 'text'),
+                self.write_generation)
+
+    def time_records_changed(self, tickets, workers):
+        """Notify the `ITimeRecordChangeListener`s that time records of
+        `tickets` worked by `workers` have been added, changed or deleted,
+        and prune the changes of the time records regularly.
+        """
+        tickets = set(tickets)
+        workers = set(workers)
+        self.bump_generation()
+        for listener in self.change_listeners:
+            listener.time_records_changed(tickets, workers)
+        if time.time() - self._last_prune >= self.prune_interval:
+            self.prune_changes()
+
+    def queue_comment(self, tid, author, comment):
+        """Queue the `comment` of `author` for the digest of the ticket
+        `tid`.
+        """
         execute_non_query(self.env, """
-            DELETE FROM ticket_time WHERE ticket=%s""", tid)
+            INSERT INTO ticket_time_digest (ticket, author, time, comment)
+            VALUES (%s, %s, %s, %s)
+            """, tid, author, int(time.time()), comment)
+        digest_comments.inc(operation='queued')
+
+    def post_digests(self, age=0):
+        """Post the digests of the queued comments of each ticket whose
+        oldest queued comment is at least `age` seconds old, one digest
+        per author, and return the number of digests posted.
+        """
+        horizon = int(time.time()) - age
+        tickets = get_all(self.env, """
+            SELECT ticket FROM ticket_time_digest GROUP BY ticket
+            HAVING MIN(time) <= %s ORDER BY ticket
+            """, horizon)
+        digests = []
+        for tid, in tickets:
+            with self.env.db_transaction:
+                comments = get_all(self.env, """
+                    SELECT id, author, comment FROM ticket_time_digest
+                    WHERE ticket=%s ORDER BY id
+                    """, tid)
+                if not comments:
+                    continue  # posted by another process
+                execute_non_query(self.env, """
+                    DELETE FROM ticket_time_digest
+                    WHERE ticket=%%s AND id IN (%s)
+                    """ % ','.join(str(row[0]) for row in comments), tid)
+                try:
+                    ticket = Ticket(self.env, tid)
+                except ResourceNotFound:
+                    continue
+                now = datetime.now(utc)
+                for idx, (author, rows) in enumerate(groupby(
+                        sorted(comments, key=itemgetter(1)), itemgetter(1))):
+                    comment = '\n'.join(' * ' + row[2] for row in rows)
+                    # the changes of a ticket are keyed by their time
+                    when = now + timedelta(microseconds=idx)
+                    ticket.save_changes(author, comment, when)
+                    digests.append((ticket, when, author, comment))
+        if digests and self.comment_digest_notify:
+            from trac.notification.api import NotificationSystem
+            from trac.ticket.notification import TicketChangeEvent
+            for ticket, when, author, comment in digests:
+                event = TicketChangeEvent('changed', ticket, when, author,
+                                          comment)
+                try:
+                    NotificationSystem(self.env).notify(event)
+                except Exception as e:
+                    self.log.error("Failure sending notification on change "
+                                   "to ticket #%s: %s", ticket.id,
+                                   exception_to_unicode(e))
+        digest_comments.inc(len(digests), operation='posted')
+        return len(digests)
+
+    # ITicketChangeListener methods
+
+    # the hours are summed by ticket fields, so any change of a ticket
+    # bumps the write generation
+
+    def ticket_created(self, ticket):
+        self.update_estimated_hours([ticket.id])
+        self.bump_generation()
+
+    def ticket_changed(self, ticket, comment, author, old_values):
+        if 'estimatedhours' in old_values:
+            self.update_estimated_hours([ticket.id])
+        if old_values:
+            self.bump_generation()
+
+    def ticket_deleted(self, ticket):
+        execute_non_query(self.env, """
+            DELETE FROM ticket_time_estimate WHERE ticket=%s""", ticket.id)
+        execute_non_query(self.env, """
+            DELETE FROM ticket_time_digest WHERE ticket=%s""", ticket.id)
+        self.bump_generation()
 
     # IPermissionRequestor methods
     def get_permission_actions(self):
@@ -254,6 +788,8 @@ class TracHoursPlugin(Component):
 
         # Check that user entered a positive number
         if ticket['estimatedhours']:
+            # the estimate of the ticket_time_estimate table is updated
+            # when the ticket is saved
             try:
                 float(ticket['estimatedhours'])
             except ValueError:
@@ -293,10 +829,10 @@ class TracHoursPlugin(Component):
                         def _get_children_hours(parent_id):
                             hours = 0
                             children = []
-                            for parent, child in self.env.db_query("""
+                            for parent, child in get_all(self.env, """
                                     SELECT oneself, ticket from ticketrels
                                     WHERE oneself=%s AND relations='child'
-                                    """, (parent_id, )):
+                                    """, parent_id):
                                 children.append(child)
                                 hours += self.get_total_hours(child)
 
@@ -322,13 +858,11 @@ class TracHoursPlugin(Component):
 
     def format_hours(self, seconds):
         """returns a formatted string of the number of hours"""
-        precision = 2
-        return str(round(seconds / 3600., precision))
+        return format_hours(seconds)
 
     def format_hours_and_minutes(self, seconds):
         """returns a formatted string of the number of hours"""
-        return '{hours:02}:{minutes:02}'.format(hours=seconds / 3600,
-                                                minutes=(seconds % 3600) / 60)
+        return format_hours_and_minutes(seconds)
 
     # Methods for the query interface
 
@@ -417,6 +951,7 @@ class TracHoursPlugin(Component):
                 del req.args['query_id']
             return False
 
+    @request_seconds.timed(handler='timeline')
     def process_timeline(self, req):
         """/hours view"""
 
@@ -551,6 +1086,7 @@ class TracHoursPlugin(Component):
 
     def display_html(self, req, query):
         """returns the HTML according to a query for /hours view"""
+        memory_phase('fetch')
 
         # The most recent query is stored in the user session;
         orig_list = None
@@ -650,12 +1186,6 @@ class TracHoursPlugin(Component):
 
         ticket_ids = [t['id'] for t in tickets]
 
-        # generate data for ticket_times
-        time_records = self.get_ticket_hours(ticket_ids, from_date=from_date,
-                                             to_date=to_date,
-                                             worker_filter=data[
-                                                 'cur_worker_filter'])
-
         data['query'] = ticket_data['query']
         data['context'] = ticket_data['context']
         data['row'] = ticket_data['row']
@@ -691,93 +1221,111 @@ class TracHoursPlugin(Component):
         data['fields'] = ticket_data['fields']
         data['modes'] = ticket_data['modes']
 
-        # group time records
-        time_records_by_ticket = {}
-        for record in time_records:
-            id_ = record['ticket']
-            if id_ not in time_records_by_ticket:
-                time_records_by_ticket[id_] = []
-
-            time_records_by_ticket[id_].append(record)
-
         data['extra_group_fields'] = dict(
             ticket=dict(name='ticket', type='select', label='Ticket'),
             worker=dict(name='worker', type='select', label='Worker'))
 
-        num_items = 0
+        # group by ticket id or other time_ticket fields if necessary
+        group = req.args.get('group')
+        if group not in data['extra_group_fields']:
+            group = None
+
+        # generate data for ticket_times, ordered by the database
+        order_by = [group] if group else []
+        if order in our_labels:
+            # the id column is the ticket id
+            order_by.append('%s%s' % ('ticket' if order == 'id' else order,
+                                      ' DESC' if desc else ''))
+        hours_args = dict(from_date=from_date, to_date=to_date,
+                          worker_filter=data['cur_worker_filter'])
+        time_records = self.get_time_records(ticket_ids, order_by=order_by,
+                                             **hours_args)
+
+        memory_phase('merge')
+
+        num_items = len(time_records)
         data['groups'] = []
-
-        # merge ticket data into ticket_time records
-        for key, tickets in ticket_data['groups']:
-            ticket_times = []
-            for ticket in tickets:
-                records = time_records_by_ticket.get(ticket['id'], [])
-                [rec.update(ticket) for rec in records]
-                ticket_times += records
-
-            # sort ticket_times, if needed
-            if order in our_labels:
-                ticket_times.sort(key=lambda x: x[order], reverse=desc)
-            if ticket_times:
-                data['groups'].append((key, ticket_times))
-                num_items += len(ticket_times)
-
         data['double_count_warning'] = ''
 
-        # group by ticket id or other time_ticket fields if necessary
-        if req.args.get('group') in data['extra_group_fields']:
-            query.group = req.args.get('group')
+        if group:
+            query.group = group
             if not query.group == "id":
                 data['double_count_warning'] = \
                     _("Warning: estimated hours may be counted more than " \
                     "once if a ticket appears in multiple groups")
 
-            tickets = data['groups'][0][1]
-            groups = {}
-            for time_rec in tickets:
-                key = time_rec[query.group]
-                if key not in groups:
-                    groups[key] = []
-                groups[key].append(time_rec)
-            data['groups'] = sorted(groups.items())
-
-        total_times = dict(
-            (k, self.format_hours(sum(rec['seconds_worked'] for rec in v)))
-            for k, v in data['groups'])
-        total_estimated_times = {}
-        for key, records in data['groups']:
-            seen_tickets = set()
-            est = 0
-            for record in records:
-                # do not double-count tickets
+            # position of each ticket in the query results
+            rows = {}
+            for key, tickets in ticket_data['groups']:
+                for ticket in tickets:
+                    rows[ticket['id']] = (len(rows), ticket)
+
+            memory_phase('group')
+            # the records are sorted by group, a single pass groups them
+            for key, records in groupby(time_records, attrgetter(group)):
+                records = list(records)
+                for record in records:
+                    record.row = rows[record.ticket][1]
+                if order not in our_labels:
+                    records.sort(key=lambda record: rows[record.ticket][0])
+                data['groups'].append((key, records))
+
+            total_times = self.get_ticket_hours_totals(ticket_ids, group,
+                                                       **hours_args)
+            estimated_times = self.get_estimated_hours_totals(
+                ticket_ids, group, **hours_args)
+        else:
+            # group time records
+            time_records_by_ticket = {}
+            for record in time_records:
                 id_ = record['ticket']
-                if id_ in seen_tickets:
-                    continue
-                seen_tickets.add(id_)
-                estimatedhours = record.get('estimatedhours') or 0
-                try:
-                    estimatedhours = float(estimatedhours)
-                except ValueError:
-                    estimatedhours = 0
-                est += estimatedhours * 3600
-            total_estimated_times[key] = self.format_hours(est)
+                if id_ not in time_records_by_ticket:
+                    time_records_by_ticket[id_] = []
+
+                time_records_by_ticket[id_].append(record)
+
+            memory_phase('group')
+            estimates = self.get_estimated_hours(time_records_by_ticket)
+            estimated_times = {}
+            # the index of the group and the seconds of each record
+            indexes = []
+            seconds = []
+            # link the ticket_time records to the ticket data
+            for key, tickets in ticket_data['groups']:
+                ticket_times = []
+                for ticket in tickets:
+                    records = time_records_by_ticket.get(ticket['id'], [])
+                    for record in records:
+                        record.row = ticket
+                    ticket_times += records
+
+                # sort ticket_times across the tickets, if needed
+                if order in our_labels:
+                    ticket_times.sort(key=lambda x: x[order], reverse=desc)
+                if ticket_times:
+                    indexes.extend([len(data['groups'])] * len(ticket_times))
+                    seconds.extend(record.seconds_worked
+                                   for record in ticket_times)
+                    data['groups'].append((key, ticket_times))
+                    estimated_times[key] = sum(
+                        estimates.get(ticket['id'], 0) for ticket in tickets
+                        if ticket['id'] in time_records_by_ticket)
+            total_times = dict(
+                (data['groups'][idx][0], total)
+                for idx, total in group_sum(seconds, indexes,
+                                            backend=self.aggregate_backend))
+
+        total_times = dict((key, self.format_hours(seconds))
+                           for key, seconds in total_times.iteritems())
+        total_estimated_times = dict(
+            (key, self.format_hours(estimated_times.get(key) or 0))
+            for key, records in data['groups'])
 
         data['total_times'] = total_times
         data['total_estimated_times'] = total_estimated_times
 
-        # format records
-        for record in time_records:
-            if 'seconds_worked' in record:
-                record['seconds_worked'] = self.format_hours(
-                    record['seconds_worked'])  # XXX misleading name
-            if 'time_started' in record:
-                record['time_started'] = user_time(req,
-                                                   format_date,
-                                                   record['time_started'])
-            if 'time_submitted' in record:
-                record['time_submitted'] = user_time(req,
-                                                     format_date,
-                                                     record['time_submitted'])
+        # the records are formatted by the templates
+        data['hours_formatter'] = HoursFormatter(req)
 
         data['query'].num_items = num_items
         data['labels'] = TicketSystem(self.env).get_ticket_field_labels()
@@ -842,6 +1390,7 @@ class TracHoursPlugin(Component):
 
         return 'hours_timeline.html', data, 'text/html'
 
+    @request_seconds.timed(handler='ticket')
     def process_ticket(self, req):
         """process a request to /hours/<ticket number>"""
 
@@ -866,25 +1415,21 @@ class TracHoursPlugin(Component):
         time_records = self.get_ticket_hours(ticket.id)
         time_records.sort(key=lambda x: x['time_started'], reverse=True)
 
-        # add additional data for the template
-        total = 0
-        for record in time_records:
-            record['date_started'] = user_time(req,
-                                               format_date,
-                                               record['time_started'])
-            record['hours_worked'] = self.format_hours_and_minutes(
-                record['seconds_worked'])
-            total += record['seconds_worked']
-        total = self.format_hours(total)
+        total = self.format_hours(sum(record['seconds_worked']
+                                      for record in time_records))
 
         data = {
+            'hours_formatter': HoursFormatter(req),
             'can_add_hours': req.perm.has_permission('TICKET_ADD_HOURS'),
             'can_add_others_hours': req.perm.has_permission('TRAC_ADMIN'),
             'now': now,
             'users': get_all_users(self.env),
             'total': total,
             'ticket': ticket,
-            'time_records': time_records
+            'time_records': time_records,
+            # the archived records are read-only
+            'archived': self.get_archived_ids(record['id']
+                                              for record in time_records),
         }
 
         # return the rss, if requested
@@ -916,9 +1461,7 @@ class TracHoursPlugin(Component):
         for group in data['groups']:
             for entry in group[1]:
                 item = {}
-                hours = float(entry['seconds_worked'])
-                minutes = int(60 * (hours - int(hours)))
-                hours = int(hours)
+                hours, minutes = divmod(entry['seconds_worked'] // 60, 60)
                 title = _('{hours}:{mins:02} hours worked by {worker}').format(
                     hours=hours, mins=minutes, worker=entry['worker'])
                 item['title'] = title
@@ -927,10 +1470,7 @@ class TracHoursPlugin(Component):
                 if comments:
                     item['description'] += ': %s' % comments
 
-                # the 'GMT' business is wrong
-                # maybe use py2rssgen a la bitsyblog?
-                time_started = datetime.strptime(entry['time_started'], '%B %d %Y')
-                item['date'] = time_started.strftime('%a, %d %b %Y %T GMT')
+                item['date'] = http_date(entry['time_started'])
 
                 link = req.abs_href(req.path_info, entry['ticket'])
                 item['guid'] = '%s#%s' % (link, entry['id'])
@@ -953,19 +1493,17 @@ class TracHoursPlugin(Component):
         link = req.abs_href(req.path_info)
         adapted['url'] = link
         items = []
+        formatter = data['hours_formatter']
         for record in data['time_records']:
             item = {}
             title = _('{hours} worked by {worker}').format(
-                hours=record['hours_worked'], worker=record['worker'])
+                hours=formatter.hours_and_minutes(record['seconds_worked']),
+                worker=record['worker'])
             item['title'] = title
             item['description'] = \
                 '%s%s' % (title, (': %s' % record['comments']) or '')
 
-            # the 'GMT' business is wrong
-            # maybe use py2rssgen a la bitsyblog?
-            item['date'] = datetime.fromtimestamp(
-                float('%s' % record['time_started'])).strftime(
-                '%a, %d %b %Y %T GMT')
+            item['date'] = http_date(record['time_started'])
 
             # could add these links to the template
             item['guid'] = '%s#%s' % (link, record['id'])
@@ -999,6 +1537,7 @@ class TracHoursPlugin(Component):
                          for i in 'from_date', 'to_date'])
         writer.writerow([])
 
+        formatter = data['hours_formatter']
         for groupname, results in data['groups']:
             if groupname:
                 writer.writerow(unicode(groupname))
@@ -1007,7 +1546,8 @@ class TracHoursPlugin(Component):
             for result in results:
                 row = []
                 for header in data['headers']:
-                    value = result[header['name']]
+                    value = formatter.field(header['name'],
+                                            result[header['name']])
                     row.append(unicode(value).encode('utf-8'))
                 writer.writerow(row)
             writer.writerow([])
@@ -1062,7 +1602,11 @@ class TracHoursPlugin(Component):
                 # see #4791
                 comment = comment.replace(' ', '\t')
 
-                ticket.save_changes(logged_in_user, comment)
+                if self.comment_digest:
+                    self.queue_comment(ticket.id, logged_in_user, comment)
+                    self.post_digests(self.comment_digest_interval)
+                else:
+                    ticket.save_changes(logged_in_user, comment)
                 # XXX can/should this be used?:
                 # index = len(ticket.get_changelog()) - 1
 
@@ -1075,51 +1619,62 @@ class TracHoursPlugin(Component):
         # permission check
         req.perm.require('TICKET_ADD_HOURS')
 
-        # set hours
+        # set hours and remove checked hours
         new_hours = {}
+        removed = set()
         for field, newval in req.args.items():
-            if field.startswith("hours_"):
-                id_ = int(field[len("hours_"):])
+            if field.startswith('hours_'):
+                id_ = int(field[len('hours_'):])
                 h, m = newval.split(':')
                 new_hours[id_] = (int(float(h) * 3600 + float(m) * 60))
-
-        # remove checked hours
-        for field, newval in req.args.items():
-            if field.startswith('rm_'):
-                id_ = int(field[len('rm_'):])
-                new_hours[id_] = 0
-
-        hours = self.get_ticket_hours(ticket.id)
-        tickets = set()
-
-        # check permission if you're editing another's hours
-        for hour in hours:
-            tickets.add(hour['ticket'])
-
-            id_ = hour['id']
-            if id_ not in new_hours:
+            elif field.startswith('rm_'):
+                removed.add(int(field[len('rm_'):]))
+        for id_ in removed:
+            new_hours[id_] = 0
+        archived = self.get_archived_ids(new_hours)
+        if archived:
+            add_warning(req, _("The archived hours cannot be changed"))
+            for id_ in archived:
+                del new_hours[id_]
+        if not new_hours:
+            req.redirect(req.href(req.path_info))
+
+        # check permission if you're editing another's hours,
+        # and only touch the entries that actually change
+        updates = []
+        deletes = []
+        workers = set()
+        for id_, worker, seconds_worked in get_all(self.env, """
+                SELECT id, worker, seconds_worked FROM ticket_time
+                WHERE ticket=%%s AND id IN (%s)
+                """ % ",".join(map(str, new_hours)), ticket.id):
+            if new_hours[id_] == seconds_worked:
                 continue
-
-            if not hour['worker'] == req.authname:
+            if not worker == req.authname:
                 req.perm.require('TRAC_ADMIN')
-
-        # perform the edits
-        for hour in hours:
-            tickets.add(hour['ticket'])
-
-            id_ = hour['id']
-            if id_ not in new_hours:
-                continue
-
+            workers.add(worker)
             if new_hours[id_]:
-                execute_non_query(self.env, """
-                    UPDATE ticket_time SET seconds_worked=%s WHERE id=%s
-                    """, new_hours[id_], id_)
+                updates.append((id_, ticket.id, worker, seconds_worked,
+                                new_hours[id_]))
             else:
-                execute_non_query(self.env, """
-                    DELETE FROM ticket_time WHERE id=%s
-                    """, id_)
+                deletes.append((id_, ticket.id, worker, seconds_worked,
+                                None))
 
-        self.update_ticket_hours(tickets)
+        # perform the edits
+        if updates or deletes:
+            with write_seconds.time(operation='edit'):
+                with self.env.db_transaction:
+                    execute_many(self.env, """
+                        UPDATE ticket_time SET seconds_worked=%s WHERE id=%s
+                        """, [(change[4], change[0]) for change in updates])
+                    execute_many(self.env, """
+                        DELETE FROM ticket_time WHERE id=%s
+                        """, [(change[0],) for change in deletes])
+                    self.log_changes('update', updates)
+                    self.log_changes('delete', deletes)
+                    self.update_ticket_hours([ticket.id])
+            entries_written.inc(len(updates), operation='update')
+            entries_written.inc(len(deletes), operation='delete')
+            self.time_records_changed([ticket.id], workers)
 
         req.redirect(req.href(req.path_info))
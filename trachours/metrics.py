@@ -0,0 +1,345 @@
+# -*- coding: utf-8 -*-
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+"""Latency and throughput counters of the hours plugin.
+
+The metrics are accumulated per process. `TracHoursMetrics` serves them
+at `/hours/metrics` in the Prometheus text format and, when
+`[trachours] metrics_dir` is set, regularly saves the counters of each
+process to that directory so that all the processes serving the
+environment are reported together. When the metrics are read, the
+counters of the processes of the host which have exited are added to
+the aggregate file of the directory, so that the totals never go down.
+"""
+
+import errno
+import json
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from trac.config import IntOption, PathOption
+from trac.core import Component, implements
+from trac.perm import IPermissionRequestor
+from trac.web.api import IRequestFilter, IRequestHandler
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+_lock = threading.Lock()
+_metrics = []
+
+# the name of the saved metrics of this process: the host, the pid and
+# the start time, so that a reused pid gets another file
+_process_name = '%s-%d-%d' % (socket.gethostname(), os.getpid(),
+                              time.time())
+
+
+class Metric(object):
+    """Base class of the metrics. `samples` maps tuples of label values
+    to the value of the metric.
+    """
+
+    type = None
+
+    def __init__(self, name, help, *labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.samples = {}
+        _metrics.append(self)
+
+    def _key(self, labels):
+        return tuple(unicode(labels[label]) for label in self.labels)
+
+    def _format_labels(self, key, extra=()):
+        pairs = zip(self.labels, key) + list(extra)
+        if not pairs:
+            return ''
+        return '{%s}' % ','.join('%s="%s"' % (name, _escape(value))
+                                 for name, value in pairs)
+
+
+class Counter(Metric):
+
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with _lock:
+            self.samples[key] = self.samples.get(key, 0) + amount
+
+    def merge(self, samples, key, value):
+        samples[key] = samples.get(key, 0) + value
+
+    def format(self, samples):
+        for key, value in sorted(samples.iteritems()):
+            yield '%s%s %s' % (self.name, self._format_labels(key), value)
+
+
+class Histogram(Metric):
+
+    type = 'histogram'
+
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+               10.0)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with _lock:
+            sample = self.samples.get(key)
+            if sample is None:
+                # one count per bucket, then the sum and the count
+                sample = self.samples[key] = [0] * len(self.buckets) + \
+                                             [0.0, 0]
+            for idx, bound in enumerate(self.buckets):
+                if value <= bound:
+                    sample[idx] += 1
+            sample[-2] += value
+            sample[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, **labels)
+
+    def timed(self, **labels):
+        """Decorator observing the duration of each call."""
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.time(**labels):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def merge(self, samples, key, value):
+        sample = samples.get(key)
+        if sample is None:
+            samples[key] = list(value)
+        else:
+            for idx, count in enumerate(value):
+                sample[idx] += count
+
+    def format(self, samples):
+        for key, sample in sorted(samples.iteritems()):
+            for bound, count in zip(self.buckets + ('+Inf',), sample):
+                yield '%s_bucket%s %s' % (
+                    self.name, self._format_labels(key, [('le', bound)]),
+                    count if bound != '+Inf' else sample[-1])
+            labels = self._format_labels(key)
+            yield '%s_sum%s %s' % (self.name, labels, sample[-2])
+            yield '%s_count%s %s' % (self.name, labels, sample[-1])
+
+
+def _escape(value):
+    return unicode(value).replace('\\', '\\\\').replace('"', '\\"') \
+                         .replace('\n', '\\n')
+
+
+request_seconds = Histogram('trachours_request_seconds',
+    "Time spent in the request handlers of the plugin.", 'handler')
+
+write_seconds = Histogram('trachours_write_seconds',
+    "Time spent writing time records.", 'operation')
+
+entries_written = Counter('trachours_entries_written_total',
+    "Number of time records added, changed or deleted.", 'operation')
+
+comment_seconds = Histogram('trachours_comment_seconds',
+    "Time spent looking for hours in comments.", 'operation')
+
+comments_parsed = Counter('trachours_comments_parsed_total',
+    "Number of comments searched for hours, by whether hours were found.",
+    'result')
+
+digest_comments = Counter('trachours_digest_comments_total',
+    "Number of hours comments queued for a digest, and of digests posted.",
+    'operation')
+
+cache_requests = Counter('trachours_cache_requests_total',
+    "Number of lookups in the caches of the plugin.", 'cache', 'result')
+
+
+def snapshot():
+    """Return the samples of all the metrics as a JSON serializable
+    dictionary.
+    """
+    with _lock:
+        return dict((metric.name, [[list(key), value] for key, value
+                                   in metric.samples.iteritems()])
+                    for metric in _metrics)
+
+
+def _is_running(pid):
+    """Return whether the process `pid` is running."""
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        # the process may belong to another user
+        return e.errno == errno.EPERM
+    return True
+
+
+def _merge(metric, snapshots):
+    samples = {}
+    for snapshot in snapshots:
+        for key, value in snapshot.get(metric.name, []):
+            metric.merge(samples, tuple(key), value)
+    return samples
+
+
+def merge_snapshots(snapshots):
+    """Return the sum of `snapshots` as a single snapshot."""
+    return dict((metric.name, [[list(key), value] for key, value
+                               in _merge(metric, snapshots).iteritems()])
+                for metric in _metrics)
+
+
+def format_metrics(snapshots):
+    """Return the Prometheus text format of the sum of `snapshots`."""
+    lines = []
+    for metric in _metrics:
+        samples = _merge(metric, snapshots)
+        lines.append('# HELP %s %s' % (metric.name, metric.help))
+        lines.append('# TYPE %s %s' % (metric.name, metric.type))
+        lines.extend(metric.format(samples))
+    return '\n'.join(lines) + '\n'
+
+
+class TracHoursMetrics(Component):
+    """Serve the metrics of the plugin at `/hours/metrics`, in the
+    Prometheus text format.
+    """
+
+    implements(IPermissionRequestor, IRequestFilter, IRequestHandler)
+
+    metrics_dir = PathOption('trachours', 'metrics_dir', '',
+        """Directory where each process serving the environment saves its
+        metrics, so that `/hours/metrics` reports the metrics of all the
+        processes. Relative paths are resolved from the `conf` directory
+        of the environment. By default only the metrics of the process
+        handling the request are reported.""")
+
+    save_interval = IntOption('trachours', 'metrics_save_interval', 10,
+        """Minimum number of seconds between two saves of the metrics of
+        a process in `metrics_dir`.""")
+
+    _last_save = 0
+
+    # IPermissionRequestor methods
+
+    def get_permission_actions(self):
+        return ['HOURS_METRICS_VIEW']
+
+    # IRequestFilter methods
+
+    def pre_process_request(self, req, handler):
+        if self.metrics_dir and \
+                time.time() - self._last_save >= self.save_interval:
+            self.save()
+        return handler
+
+    def post_process_request(self, req, template, data, content_type,
+                             method=None):
+        return template, data, content_type, method
+
+    # IRequestHandler methods
+
+    def match_request(self, req):
+        return req.path_info.rstrip('/') == '/hours/metrics'
+
+    def process_request(self, req):
+        req.perm.require('HOURS_METRICS_VIEW')
+        if self.metrics_dir:
+            self.save()
+            snapshots = self.load()
+        else:
+            snapshots = [snapshot()]
+        req.send(format_metrics(snapshots).encode('utf-8'),
+                 'text/plain; version=0.0.4; charset=utf-8')
+
+    # Internal methods
+
+    def save(self):
+        """Save the metrics of this process in `metrics_dir`."""
+        self._last_save = time.time()
+        if not os.path.isdir(self.metrics_dir):
+            os.makedirs(self.metrics_dir)
+        filename = os.path.join(self.metrics_dir,
+                                '%s.json' % _process_name)
+        tmp = '%s.%d.tmp' % (filename, threading.current_thread().ident)
+        with open(tmp, 'w') as f:
+            json.dump(snapshot(), f)
+        os.rename(tmp, filename)
+
+    def load(self):
+        """Return the saved metrics of the running processes and the
+        aggregate of the exited ones, after adding the metrics of the
+        processes of this host which have exited to the aggregate.
+        """
+        host = socket.gethostname()
+        aggregate = os.path.join(self.metrics_dir, 'aggregate.json')
+        with self._lock():
+            snapshots = []
+            exited = []
+            for name in os.listdir(self.metrics_dir):
+                base, ext = os.path.splitext(name)
+                parts = base.rsplit('-', 2)
+                if ext != '.json' or len(parts) != 3 or \
+                        not parts[1].isdigit():
+                    continue
+                filename = os.path.join(self.metrics_dir, name)
+                try:
+                    with open(filename) as f:
+                        metrics = json.load(f)
+                except (IOError, ValueError), e:
+                    self.log.warning("Cannot read metrics %s: %s", name, e)
+                    continue
+                # the processes of the other hosts cannot be checked
+                if parts[0] == host and not _is_running(int(parts[1])):
+                    exited.append((filename, metrics))
+                else:
+                    snapshots.append(metrics)
+            try:
+                with open(aggregate) as f:
+                    totals = json.load(f)
+            except IOError:
+                totals = {}
+            if exited:
+                totals = merge_snapshots([totals] + [metrics for filename,
+                                                     metrics in exited])
+                tmp = '%s.%d.tmp' % (aggregate, os.getpid())
+                with open(tmp, 'w') as f:
+                    json.dump(totals, f)
+                os.rename(tmp, aggregate)
+                for filename, metrics in exited:
+                    try:
+                        os.remove(filename)
+                    except OSError, e:
+                        self.log.warning("Cannot delete metrics %s: %s",
+                                         filename, e)
+        return snapshots + [totals]
+
+    @contextmanager
+    def _lock(self):
+        # the files of the exited processes are merged only once
+        with open(os.path.join(self.metrics_dir, 'lock'), 'w') as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+
+class TimeRecord(object):
+    """A row of the `ticket_time` table.
+
+    The record is looked up like the dictionaries of `get_all_dict`, and
+    its columns are also attributes. When `row` is set to the dictionary
+    of its ticket in the results of a query, the fields of the ticket are
+    looked up in that shared dictionary rather than copied in each record
+    of the ticket. They take precedence over the columns of the record,
+    so that `record['id']` is the id of the ticket, as in the hours
+    views.
+    """
+
+    columns = ('id', 'ticket', 'time_submitted', 'worker', 'submitter',
+               'time_started', 'seconds_worked', 'comments')
+
+    __slots__ = columns + ('row',)
+
+    def __init__(self, id, ticket, time_submitted, worker, submitter,
+                 time_started, seconds_worked, comments, row=None):
+        self.id = id
+        self.ticket = ticket
+        self.time_submitted = time_submitted
+        self.worker = worker
+        self.submitter = submitter
+        self.time_started = time_started
+        self.seconds_worked = seconds_worked
+        self.comments = comments
+        self.row = row
+
+    def __getattr__(self, name):
+        # only called for the names which are not columns
+        try:
+            return self.row[name]
+        except (KeyError, TypeError):
+            raise AttributeError(name)
+
+    def __getitem__(self, key):
+        row = self.row
+        if row is not None and key in row:
+            return row[key]
+        if key in self.columns:
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key not in self.columns:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self.columns or \
+               self.row is not None and key in self.row
+
+    def __repr__(self):
+        return '<TimeRecord %s: #%s %s %ss>' % (self.id, self.ticket,
+                                                self.worker,
+                                                self.seconds_worked)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
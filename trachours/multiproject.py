@@ -20,8 +20,10 @@ from trac.util.datefmt import parse_date, user_time
 from trac.web.api import IRequestHandler
 from trac.web.href import Href
 
-from trachours.hours import _
+from trachours.aggregate import group_sum
+from trachours.hours import TracHoursPlugin, _
 from trachours.feed import total_hours
+from trachours.metrics import request_seconds
 from trachours.utils import hours_format, urljoin
 
 try:
@@ -71,33 +73,36 @@ def query_all(projects, path, base_url=None):
     return feeds
 
 
-def query_from_url(url, path='/hours?format=rss', directory=None):
+def query_from_url(url, path='/hours?format=rss', directory=None,
+                   backend=None):
     if directory:
         proj = projects_from_directory(directory)
     else:
         proj = projects_from_url(url)
     feeds = query_all(proj, path, base_url=url)
 
-    project_hours = {}
-    projects = set()
+    # the hours of each worker on each project, as columns
+    workers = []
+    projects = []
+    hours = []
     for project, feed in feeds.items():
         if feed is not None:
-            hours = total_hours(feed)
-            for worker in hours:
-                project_hours.setdefault(worker, {})[project] = hours[worker]
-            projects.add(project)
-
-    projects = sorted(projects)
+            for worker, value in total_hours(feed, backend).iteritems():
+                workers.append(worker)
+                projects.append(project)
+                hours.append(value)
+
+    project_hours = dict(group_sum(hours, workers, projects,
+                                   backend=backend))
+    totals = dict(group_sum(hours, workers, backend=backend))
+    projects = sorted(set(project for project, feed in feeds.items()
+                          if feed is not None))
     rows = [['worker'] + projects + ['total']]
-    for worker in sorted(project_hours):
-        row = [worker]
-        total = 0.
-        for project in projects:
-            value = project_hours[worker].get(project, 0.)
-            row.append(value)
-            total += value
-        row.append(total)
-        rows.append(row)
+    for worker in sorted(totals):
+        rows.append([worker] +
+                    [project_hours.get((worker, project), 0.)
+                     for project in projects] +
+                    [totals[worker]])
     return rows
 
 
@@ -111,6 +116,7 @@ class MultiprojectHours(Component):
         """Return whether the handler wants to process the given request."""
         return req.path_info.rstrip('/') == '/hours/multiproject'
 
+    @request_seconds.timed(handler='multiproject')
     def process_request(self, req):
         """Process the request. For ClearSilver, return a (template_name,
         content_type) tuple, where `template` is the ClearSilver template to
@@ -165,7 +171,9 @@ class MultiprojectHours(Component):
         # XXX this could be configurable in an intelligent way
         directory = os.path.split(self.env.path)[0]
 
-        rows = query_from_url(url, path=path, directory=directory)
+        rows = query_from_url(
+            url, path=path, directory=directory,
+            backend=TracHoursPlugin(self.env).aggregate_backend)
         data['rows'] = rows[1:]
         data['projects'] = []
 
@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+"""Hours pivoted by a ticket field, or by worker, against periods.
+
+`/hours/pivot` sums the hours of a date range by the values of a row
+dimension and by day, week, month or year, in a single grouped query:
+the periods are mapped to columns by a `CASE` expression on the start
+time of the records, as the bounds of the periods depend on the
+timezone of the user.
+"""
+
+import csv
+import json
+from StringIO import StringIO
+from collections import OrderedDict
+from datetime import timedelta
+
+from trac.config import IntOption
+from trac.core import Component, TracError, implements
+from trac.ticket.api import TicketSystem
+from trac.util.datefmt import (
+    format_date, parse_date, to_datetime, user_time
+)
+from trac.web.api import IRequestHandler
+from trac.web.chrome import (
+    Chrome, ITemplateProvider, add_ctxtnav, add_link, add_stylesheet
+)
+
+from cache import SharedCache
+from hours import TracHoursPlugin, _
+from metrics import request_seconds
+from profiling import memory_phase
+from sqlhelper import get_all
+from utils import hours_format, period_buckets, period_case, periods
+
+
+class TracHoursPivot(Component):
+    """Serve the hours pivoted by a ticket field against periods at
+    `/hours/pivot`.
+    """
+
+    implements(IRequestHandler, ITemplateProvider)
+
+    cache_ttl = IntOption('trachours', 'pivot_cache_ttl', 60,
+        """Number of seconds the results of `/hours/pivot` are cached,
+        in files shared by the processes. The results are dropped when
+        hours are logged or edited, or tickets changed, in any process.
+        `0` disables the cache.""")
+
+    max_periods = IntOption('trachours', 'pivot_max_periods', 400,
+        """Maximum number of columns of `/hours/pivot`.""")
+
+    def __init__(self):
+        self._cache = SharedCache(self.env, 'pivot')
+
+    # IRequestHandler methods
+
+    def match_request(self, req):
+        return req.path_info.rstrip('/') == '/hours/pivot'
+
+    @request_seconds.timed(handler='pivot')
+    def process_request(self, req):
+        req.perm.require('TICKET_VIEW_HOURS')
+        fields = self.get_row_fields()
+        row = req.args.get('row', 'worker')
+        if row not in fields:
+            raise TracError(_("Invalid row: {row}").format(row=row))
+        period = req.args.get('period', 'week')
+        if period not in periods:
+            raise TracError(_("Invalid period: {period}").format(
+                period=period))
+
+        today = to_datetime(None, req.tz).date()
+        if req.args.get('to_date'):
+            last = user_time(req, parse_date, req.args['to_date']).date()
+        else:
+            last = today
+        if req.args.get('from_date'):
+            first = user_time(req, parse_date, req.args['from_date']).date()
+        else:
+            first = last - timedelta(weeks=12)
+        if first > last:
+            first, last = last, first
+        buckets, end = period_buckets(first, last, period, req.tz)
+        if len(buckets) > self.max_periods:
+            raise TracError(_("Too many periods: {count}, at most {max} "
+                              "are shown").format(count=len(buckets),
+                                                  max=self.max_periods))
+
+        memory_phase('fetch')
+        key = (row, period, tuple(start for label, start in buckets), end)
+        rows = self._cache.get(
+            key, lambda: self.get_pivot(row, [start for label, start
+                                              in buckets], end),
+            self.cache_ttl)
+
+        memory_phase('group')
+        data = {
+            'row': row,
+            'period': period,
+            'fields': fields,
+            'periods': periods,
+            'from_date': user_time(req, format_date, to_datetime(first,
+                                                                 req.tz)),
+            'to_date': user_time(req, format_date, to_datetime(last,
+                                                               req.tz)),
+            'columns': [label for label, start in buckets],
+            'starts': [start for label, start in buckets],
+            'rows': rows,
+            'totals': [sum(seconds[idx] for value, seconds in rows)
+                       for idx in xrange(len(buckets))],
+            'hours_format': hours_format,
+        }
+        data['total'] = sum(data['totals'])
+
+        format = req.args.get('format')
+        if format == 'csv':
+            self.export_csv(req, data)
+        elif format == 'json':
+            self.export_json(req, data)
+
+        args = dict(row=row, period=period, from_date=data['from_date'],
+                    to_date=data['to_date'])
+        add_stylesheet(req, 'common/css/report.css')
+        add_ctxtnav(req, _('Hours by Query'),
+                    req.href.hours(from_date=data['from_date'],
+                                   to_date=data['to_date']))
+        add_ctxtnav(req, _('Hours by User'),
+                    req.href.hours('user', from_date=data['from_date'],
+                                   to_date=data['to_date']))
+        add_link(req, 'alternate', req.href.hours('pivot', format='csv',
+                                                  **args),
+                 'CSV', 'text/csv', 'csv')
+        add_link(req, 'alternate', req.href.hours('pivot', format='json',
+                                                  **args),
+                 'JSON', 'application/json', 'json')
+        Chrome(self.env).add_jquery_ui(req)
+        return 'hours_pivot.html', data, 'text/html'
+
+    # ITemplateProvider methods
+
+    def get_htdocs_dirs(self):
+        return []
+
+    def get_templates_dirs(self):
+        from pkg_resources import resource_filename
+        return [resource_filename(__name__, 'templates')]
+
+    # Internal methods
+
+    def get_row_fields(self):
+        """Return the row dimensions, as an ordered dictionary of labels
+        by name: the worker and the ticket fields which have short
+        values.
+        """
+        fields = [('worker', _('Worker'))]
+        for field in TicketSystem(self.env).fields:
+            if field['type'] not in ('textarea', 'time'):
+                fields.append((field['name'], field['label']))
+        return OrderedDict(fields)
+
+    def get_pivot(self, row, starts, end):
+        """Return the `(value, seconds)` of the values of the `row`
+        dimension having hours started from `starts[0]` to `end`, where
+        `seconds` lists the seconds worked in each period starting at
+        `starts`.
+        """
+        args = []
+        joins = ''
+        if row == 'worker':
+            column = 'tt.worker'
+        elif row in [f['name'] for f in TicketSystem(self.env).fields
+                     if not f.get('custom')]:
+            column = 't.%s' % row
+            joins = 'INNER JOIN ticket t ON t.id=tt.ticket'
+        else:
+            column = 'c.value'
+            joins = """
+                INNER JOIN ticket t ON t.id=tt.ticket
+                LEFT OUTER JOIN ticket_custom c
+                  ON c.ticket=t.id AND c.name=%s"""
+            args.append(row)
+        column = "COALESCE(%s, '')" % column
+        # the bounds are integers computed by period_buckets
+        bucket = period_case('tt.time_started', starts)
+        pivot = {}
+        for value, idx, seconds in get_all(self.env, """
+                SELECT %(column)s, %(bucket)s, SUM(tt.seconds_worked)
+                FROM %(table)s %(joins)s
+                WHERE tt.time_started >= %%s AND tt.time_started < %%s
+                GROUP BY %(column)s, %(bucket)s
+                """ % {'column': column, 'bucket': bucket, 'joins': joins,
+                       'table': TracHoursPlugin(self.env).time_records_table(
+                           starts[0], 'tt')},
+                *(args + [starts[0], end])):
+            if value not in pivot:
+                pivot[value] = [0] * len(starts)
+            pivot[value][idx] = seconds or 0
+        return sorted(pivot.iteritems())
+
+    def export_csv(self, req, data):
+        content = StringIO()
+        writer = csv.writer(content)
+
+        def writerow(row):
+            # the csv module writes byte strings only
+            writer.writerow([unicode(value).encode('utf-8') for value in row])
+
+        writerow([data['fields'][data['row']]] + data['columns'] +
+                 [_('Total')])
+        for value, seconds in data['rows']:
+            writerow([value] +
+                     [hours_format % (s / 3600.) for s in seconds] +
+                     [hours_format % (sum(seconds) / 3600.)])
+        writerow([_('Total')] +
+                 [hours_format % (s / 3600.) for s in data['totals']] +
+                 [hours_format % (data['total'] / 3600.)])
+        req.send(content.getvalue(), 'text/csv')
+
+    def export_json(self, req, data):
+        req.send(json.dumps({
+            'row': data['row'],
+            'period': data['period'],
+            'from_date': data['from_date'],
+            'to_date': data['to_date'],
+            'columns': [{'label': label, 'start': start}
+                        for label, start in zip(data['columns'],
+                                                data['starts'])],
+            'rows': [{'value': value, 'seconds': seconds,
+                      'total': sum(seconds)}
+                     for value, seconds in data['rows']],
+            'totals': data['totals'],
+            'total': data['total'],
+        }), 'application/json')
+
@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+"""On-demand profiling of the hours views.
+
+When `[trachours] profiling` is enabled, a `TRAC_ADMIN` can add
+`hours_profile=1` to a request handled by the plugin to get the
+statistics of the handler and of the template rendering, as collected by
+`cProfile`, instead of the page. With `hours_profile=save` the page is
+returned as usual and the statistics are saved to the `log` directory of
+the environment, to be read with `pstats`.
+
+With `hours_profile=memory` the allocations of each phase of the
+request are reported instead: the phases are delimited in the handlers
+with `memory_phase`. `tracemalloc` is used when it is available,
+otherwise only the growth of the peak resident memory of the process is
+reported, as walking the heap at each phase would take longer than the
+request itself.
+"""
+
+import cProfile
+import os
+import pstats
+import resource
+import sys
+import threading
+import time
+from StringIO import StringIO
+from functools import partial
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from trac.config import BoolOption, IntOption
+from trac.core import Component, implements
+from trac.web.api import IRequestFilter, RequestDone
+from trac.web.chrome import Chrome
+from trac.web.main import RequestDispatcher
+
+_lock = threading.Lock()
+_local = threading.local()
+
+# the request handlers of the plugin
+profiled_handlers = ('TracHoursPlugin', 'TracUserHours', 'TracHoursPivot',
+                     'TracHoursTimesheet', 'MultiprojectHours')
+
+sort_keys = ('calls', 'cumulative', 'file', 'line', 'module', 'name',
+             'ncalls', 'pcalls', 'stdname', 'time', 'tottime')
+
+# ru_maxrss is in kilobytes, except on OS X
+_maxrss_unit = 1 if sys.platform == 'darwin' else 1024
+
+
+def memory_phase(name):
+    """Start the phase `name` of the allocation profile of the current
+    request, if any, ending the previous phase.
+    """
+    profile = getattr(_local, 'allocations', None)
+    if profile is not None:
+        profile.mark(name)
+
+
+class AllocationProfile(object):
+    """The memory allocated by each phase of a request.
+
+    `phases` lists the `(name, size, peak, sites)` of the ended phases:
+    `size` is the growth of the memory and `peak` the highest growth
+    during the phase, in bytes, and `sites` the `(site, size, count)` of
+    the places allocating the most memory. Without `tracemalloc`, `size`
+    is `None`, `peak` is the growth of the peak resident memory of the
+    process and no sites are reported.
+    """
+
+    def __init__(self, top=10):
+        self.top = top
+        self.phases = []
+        self._phase = None
+        self._started = False
+
+    def start(self, name):
+        if tracemalloc and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started = True
+        self.mark(name)
+
+    def stop(self):
+        self.mark(None)
+        if self._started:
+            tracemalloc.stop()
+
+    def mark(self, name):
+        snapshot = self._snapshot()
+        if self._phase is not None:
+            self.phases.append((self._phase[0],) +
+                               self._compare(self._phase[1], snapshot))
+        self._phase = (name, snapshot) if name else None
+
+    def format(self):
+        lines = []
+        for name, size, peak, sites in self.phases:
+            lines.append('%s: %s allocated, %s peak' % (
+                name, _format_size(size), _format_size(peak)))
+            for site, size, count in sites:
+                lines.append('    %s: %s in %+d blocks' % (
+                    site, _format_size(size), count))
+        return '\n'.join(lines) + '\n'
+
+    def _snapshot(self):
+        if tracemalloc:
+            memory = tracemalloc.get_traced_memory()
+            snapshot = tracemalloc.take_snapshot()
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            return snapshot, memory
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    def _compare(self, before, after):
+        if tracemalloc:
+            stats = after[0].compare_to(before[0], 'lineno')[:self.top]
+            sites = [(str(stat.traceback[0]), stat.size_diff, stat.count_diff)
+                     for stat in stats]
+            return (after[1][0] - before[1][0], after[1][1] - before[1][0],
+                    sites)
+        return None, (after - before) * _maxrss_unit, []
+
+
+def _format_size(size):
+    if size is None:
+        return '?'
+    return '%+.1f KiB' % (size / 1024.)
+
+
+class TracHoursProfiler(Component):
+    """Profile the requests to the hours views on demand."""
+
+    implements(IRequestFilter)
+
+    enabled = BoolOption('trachours', 'profiling', False,
+        """Allow the administrators to profile the hours views by adding
+        `hours_profile=1`, `hours_profile=save` or `hours_profile=memory`
+        to the query string.""")
+
+    interval = IntOption('trachours', 'profiling_interval', 60,
+        """Minimum number of seconds between two profiled requests in a
+        process.""")
+
+    limit = IntOption('trachours', 'profiling_limit', 50,
+        """Number of functions listed in the returned statistics.""")
+
+    memory_top = IntOption('trachours', 'profiling_memory_top', 10,
+        """Number of allocation sites reported for each phase of a
+        request profiled with `hours_profile=memory`.""")
+
+    _last_capture = 0
+
+    # IRequestFilter methods
+
+    def pre_process_request(self, req, handler):
+        mode = req.args.get('hours_profile')
+        if not self.enabled or not mode or handler is None or \
+                handler.__class__.__name__ not in profiled_handlers or \
+                'TRAC_ADMIN' not in req.perm:
+            return handler
+        with _lock:
+            now = time.time()
+            if now - TracHoursProfiler._last_capture < self.interval:
+                self.log.info("Not profiling %s: last profile less than %d "
+                              "seconds ago", req.path_info, self.interval)
+                return handler
+            TracHoursProfiler._last_capture = now
+        return ProfiledHandler(self, handler, mode)
+
+    def post_process_request(self, req, template, data, content_type):
+        return template, data, content_type
+
+    # Internal methods
+
+    def filename(self, handler, ext):
+        """Return the path of a new file of the `log` directory of the
+        environment, for a profile of `handler`.
+        """
+        if not os.path.isdir(self.env.log_dir):
+            os.makedirs(self.env.log_dir)
+        return os.path.join(self.env.log_dir, 'hours-%s-%s-%d.%s' % (
+            handler.__class__.__name__, time.strftime('%Y%m%d%H%M%S'),
+            os.getpid(), ext))
+
+    def save(self, profiler, handler):
+        """Save the statistics in the `log` directory of the environment
+        and return the path of the file.
+        """
+        filename = self.filename(handler, 'prof')
+        profiler.dump_stats(filename)
+        self.log.info("Saved the profile of %s to %s",
+                      handler.__class__.__name__, filename)
+        return filename
+
+    def save_allocations(self, profile, handler):
+        """Save the allocation report in the `log` directory of the
+        environment and return the path of the file.
+        """
+        filename = self.filename(handler, 'txt')
+        with open(filename, 'w') as f:
+            f.write(profile.format())
+        self.log.info("Saved the allocation profile of %s to %s",
+                      handler.__class__.__name__, filename)
+        return filename
+
+    def format(self, profiler, sort):
+        """Return the statistics sorted by `sort`, as text."""
+        out = StringIO()
+        stats = pstats.Stats(profiler, stream=out)
+        stats.sort_stats(sort if sort in sort_keys else 'cumulative')
+        stats.print_stats(self.limit)
+        return out.getvalue()
+
+
+class ProfiledHandler(object):
+    """Run a request handler and the rendering of its template under
+    `cProfile`, or under an `AllocationProfile` for the `memory` mode.
+    """
+
+    def __init__(self, profiler, handler, mode):
+        self.profiler = profiler
+        self.handler = handler
+        self.mode = mode
+
+    def process_request(self, req):
+        # the navigation item of the profiled handler stays active
+        req.callbacks['chrome'] = partial(
+            Chrome(self.profiler.env).prepare_request, handler=self.handler)
+        if self.mode == 'memory':
+            return self._profile_allocations(req)
+        profiler = cProfile.Profile()
+        try:
+            resp = profiler.runcall(self.handler.process_request, req)
+        except RequestDone:
+            # the handler sent the response itself (CSV and RSS exports)
+            self.profiler.save(profiler, self.handler)
+            raise
+        output, content_type = self._render(req, resp, profiler)
+        if self.mode == 'save':
+            self.profiler.save(profiler, self.handler)
+            if output is None:
+                return resp
+            req.send(output, content_type or 'text/html')
+        req.send(self.profiler.format(profiler,
+                                      req.args.get('hours_profile_sort')),
+                 'text/plain')
+
+    def _profile_allocations(self, req):
+        profile = AllocationProfile(self.profiler.memory_top)
+        _local.allocations = profile
+        profile.start('request')
+        try:
+            try:
+                resp = self.handler.process_request(req)
+                memory_phase('render')
+                self._render(req, resp)
+            finally:
+                _local.allocations = None
+                profile.stop()
+        except RequestDone:
+            self.profiler.save_allocations(profile, self.handler)
+            raise
+        req.send(profile.format(), 'text/plain')
+
+    def _render(self, req, resp, profiler=None):
+        """Render the template returned by the handler, as the request
+        dispatcher does.
+        """
+        if not resp:
+            return None, None
+        env = self.profiler.env
+        template, data, content_type, method = \
+            RequestDispatcher(env)._post_process_request(req, *resp)
+        render = Chrome(env).render_template
+        if profiler is not None:
+            output = profiler.runcall(render, req, template, data,
+                                      content_type, method=method)
+        else:
+            output = render(req, template, data, content_type,
+                            method=method)
+        return output, content_type
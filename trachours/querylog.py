@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+"""Per-request instrumentation of the queries done by the plugin.
+
+All the database accesses of the plugin go through `sqlhelper`, which
+records each statement in the `QueryLog` of the current request, if
+any. `TracHoursQueryLog` opens a log for each request and writes it to
+the Trac log when the request exceeds the configured thresholds.
+"""
+
+import os
+import re
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from genshi.core import Stream
+from trac.config import BoolOption, FloatOption, IntOption
+from trac.core import Component, implements
+from trac.web.api import IRequestFilter, ITemplateStreamFilter
+
+_local = threading.local()
+
+_fingerprint_re = re.compile(r"'(?:[^']|'')*'|\b[0-9]+(?:\.[0-9]+)?\b|\s+")
+_in_list_re = re.compile(r"IN \((?:\?, ?)*\?\)", re.I)
+
+# modules that are not the interesting caller of a query
+_helper_modules = ('sqlhelper', 'querylog', 'contextlib')
+
+
+def fingerprint(sql):
+    """Normalize a statement so that statements that only differ by
+    their literal values or their whitespace are equal.
+    """
+    def replace(match):
+        return ' ' if match.group().isspace() else '?'
+    sql = _fingerprint_re.sub(replace, sql).strip()
+    return _in_list_re.sub('IN (...)', sql)
+
+
+def caller():
+    """Return the `file:line (function)` location of the plugin code
+    that issued the query being recorded.
+    """
+    frame = sys._getframe(1)
+    while frame is not None:
+        module = frame.f_globals.get('__name__', '')
+        if module.rsplit('.', 1)[-1] not in _helper_modules:
+            code = frame.f_code
+            return '%s:%d (%s)' % (os.path.basename(code.co_filename),
+                                   frame.f_lineno, code.co_name)
+        frame = frame.f_back
+    return None
+
+
+class QueryLog(object):
+    """The statements executed while processing a request."""
+
+    def __init__(self, view):
+        self.view = view
+        self.start = time.time()
+        self.queries = []
+
+    def add(self, sql, duration, rows):
+        self.queries.append((fingerprint(sql), duration, rows, caller()))
+
+    @property
+    def duration(self):
+        return sum(query[1] for query in self.queries)
+
+    def statements(self):
+        """Return the `(fingerprint, count, duration, rows, callers)` of
+        each distinct statement, the most expensive first. `callers` maps
+        the call sites to the number of executions.
+        """
+        stats = {}
+        for sql, duration, rows, site in self.queries:
+            stat = stats.setdefault(sql, [sql, 0, 0.0, 0, {}])
+            stat[1] += 1
+            stat[2] += duration
+            stat[3] += rows or 0
+            stat[4][site] = stat[4].get(site, 0) + 1
+        return sorted((tuple(stat) for stat in stats.itervalues()),
+                      key=lambda stat: stat[2], reverse=True)
+
+
+def start_log(view):
+    _local.log = QueryLog(view)
+    return _local.log
+
+
+def stop_log():
+    log = getattr(_local, 'log', None)
+    _local.log = None
+    return log
+
+
+class _Measure(object):
+
+    __slots__ = ('rows',)
+
+    def __init__(self):
+        self.rows = None
+
+
+@contextmanager
+def measure(sql):
+    """Record the execution of `sql` in the log of the current request.
+    The row count can be set on the returned object.
+    """
+    log = getattr(_local, 'log', None)
+    result = _Measure()
+    if log is None:
+        yield result
+        return
+    start = time.time()
+    try:
+        yield result
+    finally:
+        log.add(sql, time.time() - start, result.rows)
+
+
+class TracHoursQueryLog(Component):
+    """Log the requests for which the plugin runs too many or too slow
+    queries, along with the statements repeated from a same request.
+    """
+
+    implements(IRequestFilter, ITemplateStreamFilter)
+
+    enabled = BoolOption('trachours', 'query_log', False,
+        """Record the queries done by the hours plugin for each request.""")
+
+    max_queries = IntOption('trachours', 'query_log_count', 50,
+        """Log the requests for which the plugin runs more queries.""")
+
+    max_time = FloatOption('trachours', 'query_log_time', 1.0,
+        """Log the requests for which the queries of the plugin take more
+        seconds.""")
+
+    repeated = IntOption('trachours', 'query_log_repeated', 10,
+        """Report the statements executed at least this number of times
+        for a request, which usually means a query is run for each item
+        of a list instead of once for the whole list.""")
+
+    # IRequestFilter methods
+
+    def pre_process_request(self, req, handler):
+        if self.enabled:
+            self._report(stop_log())
+            view = '%s %s' % (handler.__class__.__name__, req.path_info) \
+                   if handler is not None else req.path_info
+            start_log(view)
+            # requests ended by RequestDone never reach the end of a
+            # template stream, so their log is reported once sent
+            for name in ('send', 'send_file', 'send_no_content',
+                         'redirect'):
+                setattr(req, name, self._reporting(getattr(req, name)))
+        return handler
+
+    def post_process_request(self, req, template, data, content_type,
+                             method=None):
+        if template is None:
+            self._report(stop_log())
+        return template, data, content_type, method
+
+    # ITemplateStreamFilter methods
+
+    def filter_stream(self, req, method, filename, stream, data):
+        log = getattr(_local, 'log', None)
+        if log is None:
+            return stream
+
+        def report(stream):
+            for event in stream:
+                yield event
+            if getattr(_local, 'log', None) is log:
+                self._report(stop_log())
+        return Stream(report(stream))
+
+    # Internal methods
+
+    def _reporting(self, send):
+        @wraps(send)
+        def wrapper(*args, **kwargs):
+            try:
+                return send(*args, **kwargs)
+            finally:
+                self._report(stop_log())
+        return wrapper
+
+    def _report(self, log):
+        if not log or not log.queries:
+            return
+        duration = log.duration
+        repeated = [stat for stat in log.statements()
+                    if stat[1] >= self.repeated]
+        if len(log.queries) < self.max_queries and \
+                duration < self.max_time and not repeated:
+            return
+        self.log.warning("%s: %d queries in %.3fs (%.3fs elapsed)",
+                         log.view, len(log.queries), duration,
+                         time.time() - log.start)
+        for sql, count, duration, rows, callers in log.statements()[:10]:
+            self.log.warning("  %dx %.3fs %d rows: %s", count, duration,
+                             rows, sql)
+        for sql, count, duration, rows, callers in repeated:
+            site = max(callers, key=callers.get)
+            self.log.warning("  repeated %d times from %s: %s", count, site,
+                             sql)
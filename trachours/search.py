@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+"""Search of the comments of the time records.
+
+On SQLite, the comments are indexed by the full-text table
+`ticket_time_fts`, which triggers keep in sync with `ticket_time`, and
+the matching records are ranked by relevance with FTS5. Elsewhere, or
+when SQLite is built without full-text search, the comments are
+searched with `LIKE`: the triggers are dropped if the module of the
+index is missing, so that the time records can still be written. The
+comments of the archived time records are removed from the index and
+are always searched with `LIKE`, after the matching records of
+`ticket_time`.
+"""
+
+from trac.config import IntOption
+from trac.core import Component, implements
+from trac.search.api import ISearchSource, search_to_sql, shorten_result
+from trac.util.datefmt import to_datetime, utc
+
+from db import SetupTracHours
+from hours import TracHoursPlugin, _
+from sqlhelper import get_all
+from utils import format_hours_and_minutes
+
+
+class TracHoursSearch(Component):
+    """Search the comments of the logged hours."""
+
+    implements(ISearchSource)
+
+    limit = IntOption('trachours', 'search_limit', 100,
+        """Maximum number of time records returned by a search of the
+        comments of the hours, the most relevant first when the comments
+        are indexed with FTS5.""")
+
+    _index = None
+
+    # ISearchSource methods
+
+    def get_search_filters(self, req):
+        if 'TICKET_VIEW_HOURS' in req.perm:
+            yield ('hours', _('Hours'))
+
+    def get_search_results(self, req, terms, filters):
+        if 'hours' not in filters or 'TICKET_VIEW_HOURS' not in req.perm:
+            return
+        for id_, ticket, time_submitted, worker, seconds_worked, comments, \
+                summary in self.search(terms):
+            if 'TICKET_VIEW' not in req.perm('ticket', ticket):
+                continue
+            yield (req.href.hours(ticket),
+                   _("{hours} hours on #{ticket}: {summary}").format(
+                       hours=format_hours_and_minutes(seconds_worked),
+                       ticket=ticket, summary=summary),
+                   to_datetime(time_submitted, utc), worker,
+                   shorten_result(comments, terms))
+
+    # Internal methods
+
+    def get_index(self):
+        """Return the module of the full-text index of the comments,
+        `fts5` or `fts4`, or `''` if the comments are not indexed.
+        """
+        if self._index is None:
+            self._index = SetupTracHours(self.env).get_comments_index()
+        return self._index
+
+    def search(self, terms):
+        """Return the `id`, `ticket`, `time_submitted`, `worker`,
+        `seconds_worked` and `comments` of the time records, and the
+        summary of their ticket, whose comments match all the `terms`.
+        """
+        columns = """t.id, t.ticket, t.time_submitted, t.worker,
+                     t.seconds_worked, t.comments, k.summary"""
+        index = self.get_index()
+        if index:
+            # words starting with each term
+            if index == 'fts5':
+                query = ' '.join('"%s"*' % term.replace('"', '""')
+                                 for term in terms)
+                order = 'ticket_time_fts.rank'
+            else:
+                query = ' '.join('"%s*"' % term.replace('"', '""')
+                                 for term in terms)
+                order = 't.time_submitted DESC, t.id DESC'
+            rows = get_all(self.env, """
+                SELECT %s FROM ticket_time_fts
+                INNER JOIN ticket_time t ON t.id=ticket_time_fts.rowid
+                INNER JOIN ticket k ON k.id=t.ticket
+                WHERE ticket_time_fts MATCH %%s
+                ORDER BY %s LIMIT %%s
+                """ % (columns, order), query, self.limit)
+            if not TracHoursPlugin(self.env).archived_before or \
+                    len(rows) >= self.limit:
+                return rows
+            table = 'ticket_time_archive'
+        else:
+            rows = []
+            table = TracHoursPlugin(self.env).time_records_table()
+
+        with self.env.db_query as db:
+            sql, args = search_to_sql(db, ['t.comments'], terms)
+        return rows + get_all(self.env, """
+            SELECT %s FROM %s t
+            INNER JOIN ticket k ON k.id=t.ticket
+            WHERE %s ORDER BY t.time_submitted DESC, t.id DESC LIMIT %%s
+            """ % (columns, table, sql),
+            *(list(args) + [self.limit - len(rows)]))
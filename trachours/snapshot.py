@@ -0,0 +1,438 @@
+# -*- coding: utf-8 -*-
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+"""Columnar snapshot of the time records.
+
+The snapshot stores the `id`, `ticket`, `worker`, `time_started` and
+`seconds_worked` of all the time records as arrays of fixed size
+numbers, one file per column, under the `cache/trachours/snapshot`
+directory of the environment, with the dictionary of the workers whose
+index is stored in the `worker` column. The rows are ordered by id.
+
+The snapshot is built by `trac-admin hours snapshot`, and then follows
+the changes of the time records logged in `ticket_time_changes`: added
+records are appended, the rows of changed records are set to their
+current values and the rows of deleted records are zeroed. This is done
+after each write when `[trachours] snapshot` is enabled, and before the
+snapshot is read. The changes of the last `settle_seconds` are applied
+again at the next refresh, as the transactions still open when they
+were read may log changes numbered before them. A snapshot written with
+another format or byte order is built again.
+
+The columns are read by mapping their files in memory, without loading
+the rows from the database: with numpy the arrays share the mapped
+memory, otherwise they are copied in `array`s in a single operation.
+"""
+
+import array
+import bisect
+import json
+import mmap
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+from trac.config import BoolOption
+from trac.core import Component, implements
+
+from api import ChangesPrunedError, ITimeRecordChangeListener
+from hours import TracHoursPlugin
+from sqlhelper import get_all, get_scalar, get_system_value
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# the columns and the typecodes of their arrays
+columns = (('id', 'i'), ('ticket', 'i'), ('worker', 'i'),
+           ('time_started', 'd'), ('seconds_worked', 'i'))
+typecodes = dict(columns)
+
+format_version = 1
+
+
+def _write_atomic(path, data):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    if os.name == 'nt' and os.path.exists(path):
+        os.remove(path)
+    os.rename(tmp, path)
+
+
+class SnapshotReader(object):
+    """The columns of a snapshot, mapped in memory.
+
+    `count` is the number of rows and `workers` the list of the workers,
+    indexed by the `worker` column. Deleted records are left as rows of
+    ticket 0 and 0 seconds.
+    """
+
+    def __init__(self, path, meta, workers):
+        self.path = path
+        self.count = meta['count']
+        self.seq = meta['seq']
+        self.workers = workers
+        self._files = []
+        self._maps = {}
+
+    def column(self, name):
+        """Return the column `name`, as a numpy array sharing the mapped
+        file if numpy is installed, or as an `array`.
+        """
+        typecode = typecodes[name]
+        size = self.count * array.array(typecode).itemsize
+        if name not in self._maps:
+            if not size:
+                return array.array(typecode)
+            f = open(os.path.join(self.path, name), 'rb')
+            self._files.append(f)
+            self._maps[name] = mmap.mmap(f.fileno(), size,
+                                         access=mmap.ACCESS_READ)
+        if numpy is not None:
+            return numpy.frombuffer(self._maps[name], dtype=typecode,
+                                    count=self.count)
+        values = array.array(typecode)
+        values.fromstring(self._maps[name][:size])
+        return values
+
+    def sum_seconds(self, start=None, end=None):
+        """Return the seconds worked by each worker on the records started
+        from `start` to `end` (excluded), which are timestamps. The
+        workers of records in the range are listed even if their seconds
+        sum to zero, as when reading the records.
+        """
+        tickets = self.column('ticket')
+        workers = self.column('worker')
+        times = self.column('time_started')
+        seconds = self.column('seconds_worked')
+        if numpy is not None:
+            # the rows of the deleted records are zeroed
+            mask = tickets != 0
+            if start is not None:
+                mask &= times >= start
+            if end is not None:
+                mask &= times < end
+            counts = numpy.bincount(workers[mask],
+                                    minlength=len(self.workers))
+            sums = numpy.bincount(workers[mask], weights=seconds[mask],
+                                  minlength=len(self.workers))
+            return dict((self.workers[idx], int(sums[idx]))
+                        for idx, count in enumerate(counts) if count)
+        if start is None:
+            start = float('-inf')
+        if end is None:
+            end = float('inf')
+        sums = {}
+        for ticket, worker, started, worked in zip(tickets, workers, times,
+                                                   seconds):
+            if ticket and start <= started < end:
+                sums[worker] = sums.get(worker, 0) + worked
+        return dict((self.workers[idx], total)
+                    for idx, total in sums.iteritems())
+
+    def close(self):
+        for map_ in self._maps.itervalues():
+            try:
+                map_.close()
+            except Exception:
+                pass  # numpy arrays still refer to the map
+        for f in self._files:
+            f.close()
+        self._maps = {}
+        self._files = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class TracHoursSnapshot(Component):
+    """Maintain the columnar snapshot of the time records."""
+
+    implements(ITimeRecordChangeListener)
+
+    enabled = BoolOption('trachours', 'snapshot', False,
+        """Update the columnar snapshot of the time records after each
+        write, once built by `trac-admin hours snapshot`, and sum the
+        hours of the workers of `/hours/user` from it.""")
+
+    # number of records read from the database at once
+    chunk_size = 10000
+
+    # number of seconds after which the changes are assumed committed
+    settle_seconds = 60
+
+    @property
+    def directory(self):
+        return os.path.join(self.env.path, 'cache', 'trachours', 'snapshot')
+
+    # ITimeRecordChangeListener methods
+
+    def time_records_changed(self, tickets, workers):
+        if self.enabled:
+            self.refresh()
+
+    # Public methods
+
+    def exists(self):
+        return self._current() is not None
+
+    def open(self):
+        """Bring the snapshot up to date and return a `SnapshotReader` of
+        it, or `None` if the snapshot has not been built.
+        """
+        if not self.refresh():
+            return None
+        with self._lock():
+            current = self._current()
+            path = os.path.join(self.directory, current)
+            meta, workers = self._read_meta(path)
+            return SnapshotReader(path, meta, workers)
+
+    def build(self):
+        """Write a new snapshot of all the time records, and return the
+        number of records.
+        """
+        with self._lock():
+            return self._build()
+
+    def refresh(self):
+        """Apply the changes of the time records logged since the
+        snapshot was written, and return whether the snapshot exists.
+        """
+        with self._lock():
+            current = self._current()
+            if current is None:
+                return False
+            path = os.path.join(self.directory, current)
+            meta, workers = self._read_meta(path)
+            if meta.get('version') != format_version or \
+                    meta.get('byteorder') != sys.byteorder:
+                self._build()
+                return True
+            try:
+                changes = TracHoursPlugin(self.env).get_changes(meta['seq'])
+            except ChangesPrunedError:
+                self._build()
+                return True
+            if changes and not self._apply(path, meta, workers, changes):
+                self._build()
+            return True
+
+    # Internal methods
+
+    @contextmanager
+    def _lock(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        with open(os.path.join(self.directory, 'lock'), 'w') as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _current(self):
+        """Return the directory of the current snapshot, or `None`."""
+        try:
+            with open(os.path.join(self.directory, 'CURRENT')) as f:
+                current = f.read().strip()
+        except IOError:
+            return None
+        if os.path.isdir(os.path.join(self.directory, current)):
+            return current
+
+    def _read_meta(self, path):
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        with open(os.path.join(path, 'workers.json')) as f:
+            workers = json.load(f)
+        return meta, workers
+
+    def _write_meta(self, path, count, seq, workers):
+        _write_atomic(os.path.join(path, 'workers.json'),
+                      json.dumps(workers))
+        _write_atomic(os.path.join(path, 'meta.json'), json.dumps({
+            'version': format_version, 'byteorder': sys.byteorder,
+            'columns': dict(columns), 'count': count, 'seq': seq}))
+
+    def _append(self, path, count, rows, workers, index):
+        """Append `rows` of `(id, ticket, worker, time_started,
+        seconds_worked)` to the columns of `count` rows, adding the new
+        workers to `workers` and `index`. The columns are first cut to
+        `count` rows, dropping the rows of an update which failed.
+        """
+        values = dict((name, array.array(typecode))
+                      for name, typecode in columns)
+        for id_, ticket, worker, time_started, seconds_worked in rows:
+            if worker not in index:
+                index[worker] = len(workers)
+                workers.append(worker)
+            values['id'].append(id_)
+            values['ticket'].append(ticket)
+            values['worker'].append(index[worker])
+            values['time_started'].append(time_started or 0)
+            values['seconds_worked'].append(seconds_worked or 0)
+        for name, typecode in columns:
+            with open(os.path.join(path, name), 'r+b') as f:
+                f.seek(count * values[name].itemsize)
+                f.truncate()
+                values[name].tofile(f)
+
+    def _build(self):
+        # the position in the change log before the records are read, so
+        # that the changes made meanwhile are applied again, along with
+        # the recent changes of transactions which may still be open
+        hours = TracHoursPlugin(self.env)
+        seq = max(get_scalar(self.env, """
+                      SELECT MAX(seq) FROM ticket_time_changes
+                      WHERE time < %s
+                      """, 0, int(time.time()) - self.settle_seconds) or 0,
+                  int(get_system_value(self.env, hours.changes_pruned, 0)))
+        current = '%d-%d' % (time.time() * 1000, os.getpid())
+        path = os.path.join(self.directory, current)
+        os.makedirs(path)
+        workers = []
+        index = {}
+        count = 0
+        last_id = 0
+        for name, typecode in columns:
+            open(os.path.join(path, name), 'wb').close()
+        # the archived records are included
+        table = hours.time_records_table()
+        while True:
+            rows = get_all(self.env, """
+                SELECT id, ticket, worker, time_started, seconds_worked
+                FROM %s WHERE id > %%s ORDER BY id LIMIT %%s
+                """ % table, last_id, self.chunk_size)
+            self._append(path, count, rows, workers, index)
+            count += len(rows)
+            if len(rows) < self.chunk_size:
+                break
+            last_id = rows[-1][0]
+        self._write_meta(path, count, seq, workers)
+        _write_atomic(os.path.join(self.directory, 'CURRENT'), current)
+        for name in os.listdir(self.directory):
+            if name != current and \
+                    os.path.isdir(os.path.join(self.directory, name)):
+                shutil.rmtree(os.path.join(self.directory, name), True)
+        # the changes made while the records were read
+        meta, workers = self._read_meta(path)
+        changes = hours.get_changes(seq)
+        if changes:
+            self._apply(path, meta, workers, changes)
+        return count
+
+    def _apply(self, path, meta, workers, changes):
+        """Apply `changes` to the snapshot in `path`, and return whether
+        they could be applied: the ids of the rows must stay ordered.
+
+        The rows of the changed records are set to the current values of
+        the records, or zeroed if they have been deleted, so a change can
+        be applied again.
+        """
+        count = meta['count']
+        index = dict((worker, idx) for idx, worker in enumerate(workers))
+        current = {}
+        entries = sorted(set(change['entry'] for change in changes))
+        table = TracHoursPlugin(self.env).time_records_table()
+        for idx in xrange(0, len(entries), 1000):
+            for row in get_all(self.env, """
+                    SELECT id, ticket, worker, time_started, seconds_worked
+                    FROM %s WHERE id IN (%s)
+                    """ % (table,
+                           ','.join(map(str, entries[idx:idx + 1000])))):
+                current[row[0]] = row
+
+        # the last row of a record is the only one not zeroed
+        positions = {}
+        if count:
+            with open(os.path.join(path, 'id'), 'rb') as f:
+                id_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                ids = _Column(id_map, typecodes['id'], count)
+                last_id = ids[count - 1]
+                for entry in entries:
+                    pos = ids.rindex(entry)
+                    if pos is not None:
+                        positions[entry] = pos
+            finally:
+                id_map.close()
+        else:
+            last_id = 0
+        appended = [entry for entry in entries
+                    if entry not in positions and entry in current]
+        if appended and appended[0] <= last_id:
+            return False
+
+        files = dict((name, open(os.path.join(path, name), 'r+b'))
+                     for name, typecode in columns if name != 'id')
+        try:
+            for entry, pos in sorted(positions.iteritems(),
+                                     key=lambda item: item[1]):
+                row = current.get(entry, (entry, 0, None, 0, 0))
+                worker = row[2]
+                if worker is not None and worker not in index:
+                    index[worker] = len(workers)
+                    workers.append(worker)
+                values = (row[1], index.get(worker, 0), row[3] or 0,
+                          row[4] or 0)
+                for name, value in zip(('ticket', 'worker', 'time_started',
+                                        'seconds_worked'), values):
+                    f = files[name]
+                    typecode = typecodes[name]
+                    f.seek(pos * struct.calcsize('=' + typecode))
+                    f.write(struct.pack('=' + typecode, value))
+        finally:
+            for f in files.itervalues():
+                f.close()
+        self._append(path, count, [current[entry] for entry in appended],
+                     workers, index)
+        # the recent changes are applied again by the next refresh
+        horizon = time.time() - self.settle_seconds
+        seq = max([meta['seq']] + [change['seq'] for change in changes
+                                   if change['time'] < horizon])
+        self._write_meta(path, count + len(appended), seq, workers)
+        return True
+
+
+class _Column(object):
+    """The first `count` numbers of type `typecode` of a mapped file."""
+
+    def __init__(self, map_, typecode, count):
+        self.map = map_
+        self.format = '=' + typecode
+        self.size = struct.calcsize(self.format)
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, pos):
+        return struct.unpack_from(self.format, self.map, pos * self.size)[0]
+
+    def rindex(self, value):
+        """Return the position of the last `value` of the ordered
+        column, or `None`.
+        """
+        pos = bisect.bisect_right(self, value) - 1
+        if pos >= 0 and self[pos] == value:
+            return pos
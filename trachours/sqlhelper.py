@@ -7,27 +7,48 @@
 # you should have received as part of this distribution.
 
 from trac.db import DatabaseManager
+from trac.ticket.model import Ticket
+
+from querylog import measure
 
 def execute_non_query(env, sql, *params):
     with env.db_transaction as db:
         cur = db.cursor()
-        cur.execute(sql, params)
+        with measure(sql) as m:
+            cur.execute(sql, params)
+            m.rows = cur.rowcount
+
+def execute_many(env, sql, args):
+    args = list(args)
+    if not args:
+        return
+    with env.db_transaction as db:
+        cur = db.cursor()
+        with measure(sql) as m:
+            cur.executemany(sql, args)
+            m.rows = len(args)
 
 def get_scalar(env, sql, column=0, *params):
     with env.db_transaction as db:
         cur = db.cursor()
-        cur.execute(sql, params)
-        data = cur.fetchone()
+        with measure(sql) as m:
+            cur.execute(sql, params)
+            data = cur.fetchone()
+            m.rows = 1 if data else 0
         if data:
             return data[column]
 
 def get_column(env, table, column):
+    sql = """
+            SELECT %s FROM %s
+            """ % (column, table)
     with env.db_transaction as db:
         cur = db.cursor()
-        cur.execute("""
-            SELECT %s FROM %s
-            """ % (column, table))
-        return [datum[0] for datum in cur.fetchall()]
+        with measure(sql) as m:
+            cur.execute(sql)
+            rows = cur.fetchall()
+            m.rows = len(rows)
+        return [datum[0] for datum in rows]
 
 def create_table(env, table):
     conn, _ = DatabaseManager(env).get_connector()
@@ -35,11 +56,22 @@ def create_table(env, table):
     for stmt in stmts:
         execute_non_query(env, stmt)
 
+def get_all(env, sql, *params):
+    with env.db_transaction as db:
+        cur = db.cursor()
+        with measure(sql) as m:
+            cur.execute(sql, params)
+            rows = cur.fetchall()
+            m.rows = len(rows)
+        return rows
+
 def get_all_dict(env, sql, *params):
     with env.db_transaction as db:
         cur = db.cursor()
-        cur.execute(sql, params)
-        rows = cur.fetchall()
+        with measure(sql) as m:
+            cur.execute(sql, params)
+            rows = cur.fetchall()
+            m.rows = len(rows)
         desc = cur.description
 
         results = []
@@ -49,3 +81,55 @@ def get_all_dict(env, sql, *params):
                 row_dict[col[0]] = field
             results.append(row_dict)
         return results
+
+def get_ticket(env, tid):
+    with measure('Ticket(%s)'):
+        return Ticket(env, tid)
+
+def get_system_value(env, name, default=None):
+    for value, in get_all(env, """
+            SELECT value FROM system WHERE name=%s
+            """, name):
+        return value
+    return default
+
+def set_system_value(env, name, value):
+    with env.db_transaction:
+        execute_non_query(env, "DELETE FROM system WHERE name=%s", name)
+        if value is not None:
+            execute_non_query(env, """
+                INSERT INTO system (name, value) VALUES (%s, %s)
+                """, name, value)
+
+def insert_rows(env, table, columns, rows, chunk_size=100):
+    """Insert `rows` in `table` and return the ids of the new rows, in
+    order. The ids are read back from each statement, so that the rows
+    added by other connections at the same time are never mistaken for
+    them. On PostgreSQL and SQLite up to `chunk_size` rows are inserted
+    by each statement, on the other databases a row at a time.
+    """
+    uri = DatabaseManager(env).connection_uri
+    returning = uri.startswith('postgres:')
+    if not returning and not uri.startswith('sqlite:'):
+        chunk_size = 1
+    values = '(%s)' % ','.join(['%s'] * len(columns))
+    ids = []
+    with env.db_transaction as db:
+        cur = db.cursor()
+        for idx in xrange(0, len(rows), chunk_size):
+            chunk = rows[idx:idx + chunk_size]
+            sql = "INSERT INTO %s (%s) VALUES %s" % (
+                table, ','.join(columns), ','.join([values] * len(chunk)))
+            if returning:
+                sql += " RETURNING id"
+            with measure(sql) as m:
+                cur.execute(sql, [value for row in chunk for value in row])
+                m.rows = len(chunk)
+            if returning:
+                ids.extend(id_ for id_, in cur.fetchall())
+            else:
+                # SQLite allows a single writer, so the rows of a
+                # statement get consecutive ids
+                last_id = db.get_last_id(cur, table)
+                ids.extend(xrange(last_id - len(chunk) + 1, last_id + 1))
+    return ids
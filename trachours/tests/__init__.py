@@ -18,6 +18,12 @@ def revert_trachours_schema_init(env):
     with env.db_transaction as db:
         db("DROP TABLE IF EXISTS ticket_time")
         db("DROP TABLE IF EXISTS ticket_time_query")
+        db("DROP TABLE IF EXISTS ticket_time_estimate")
+        db("DROP TABLE IF EXISTS ticket_time_changes")
+        db("DROP TABLE IF EXISTS ticket_time_digest")
+        db("DROP TABLE IF EXISTS ticket_time_fts")
+        db("DROP TABLE IF EXISTS ticket_time_archive")
+        db("DROP TABLE IF EXISTS ticket_time_archive_summary")
         db("DELETE FROM system WHERE name='trachours.db_version'")
 
 
@@ -30,6 +36,40 @@ def test_suite():
     suite.addTest(trachours.tests.ticket.test_suite())
     import trachours.tests.db
     suite.addTest(trachours.tests.db.test_suite())
+    import trachours.tests.admin
+    suite.addTest(trachours.tests.admin.test_suite())
+    import trachours.tests.bench
+    suite.addTest(trachours.tests.bench.test_suite())
+    import trachours.tests.querylog
+    suite.addTest(trachours.tests.querylog.test_suite())
+    import trachours.tests.metrics
+    suite.addTest(trachours.tests.metrics.test_suite())
+    import trachours.tests.profiling
+    suite.addTest(trachours.tests.profiling.test_suite())
+    import trachours.tests.model
+    suite.addTest(trachours.tests.model.test_suite())
+    import trachours.tests.utils
+    suite.addTest(trachours.tests.utils.test_suite())
+    import trachours.tests.pivot
+    suite.addTest(trachours.tests.pivot.test_suite())
+    import trachours.tests.web_ui
+    suite.addTest(trachours.tests.web_ui.test_suite())
+    import trachours.tests.cache
+    suite.addTest(trachours.tests.cache.test_suite())
+    import trachours.tests.delta
+    suite.addTest(trachours.tests.delta.test_suite())
+    import trachours.tests.search
+    suite.addTest(trachours.tests.search.test_suite())
+    import trachours.tests.snapshot
+    suite.addTest(trachours.tests.snapshot.test_suite())
+    import trachours.tests.timeline
+    suite.addTest(trachours.tests.timeline.test_suite())
+    import trachours.tests.timesheet
+    suite.addTest(trachours.tests.timesheet.test_suite())
+    import trachours.tests.aggregate
+    suite.addTest(trachours.tests.aggregate.test_suite())
+    import trachours.tests.archive
+    suite.addTest(trachours.tests.archive.test_suite())
 
 
     return suite
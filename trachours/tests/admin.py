@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from trac.admin.api import AdminCommandError
+from trac.test import EnvironmentStub
+from trac.ticket.model import Ticket
+
+from trachours.admin import TracHoursAdmin
+from trachours.db import SetupTracHours
+from trachours.hours import TracHoursPlugin
+from trachours.sqlhelper import get_system_value
+
+from trachours.tests import revert_trachours_schema_init
+
+
+class TracHoursAdminTestCase(unittest.TestCase):
+    def setUp(self):
+        self.env = EnvironmentStub(default_data=True,
+                                   enable=['trac.*', 'trachours.*'])
+        self.env.path = tempfile.mkdtemp()
+        self.env.config.set('trachours', 'admin_chunk_size', 2)
+        setup = SetupTracHours(self.env)
+        with self.env.db_transaction as db:
+            setup.upgrade_environment(db)
+        self.hours_thp = TracHoursPlugin(self.env)
+        self.admin = TracHoursAdmin(self.env)
+
+    def tearDown(self):
+        self.env.reset_db()
+        revert_trachours_schema_init(self.env)
+        shutil.rmtree(self.env.path)
+
+    def _insert_tickets(self, count):
+        ids = []
+        for i in range(count):
+            ticket = Ticket(self.env)
+            ticket['summary'] = 'ticket %s' % i
+            ticket.insert()
+            ids.append(ticket.id)
+        return ids
+
+    def _totalhours(self, tid):
+        return float(Ticket(self.env, tid)['totalhours'])
+
+    def test_recalc_all(self):
+        ids = self._insert_tickets(5)
+        self.hours_thp.add_ticket_hours(ids[0], 'joe', 3600)
+        self.hours_thp.add_ticket_hours(ids[4], 'joe', 1800)
+        self.env.db_transaction("""
+            UPDATE ticket_custom SET value='42' WHERE name='totalhours'""")
+        self.env.db_transaction("""
+            DELETE FROM ticket_custom WHERE name='totalhours' AND ticket=%s
+            """, (ids[2],))
+
+        self.admin._do_recalc()
+
+        self.assertEqual([1.0, 0.0, 0.0, 0.0, 0.5],
+                         [self._totalhours(tid) for tid in ids])
+        self.assertIsNone(get_system_value(self.env,
+                                           self.admin.recalc_checkpoint))
+
+    def test_recalc_tickets(self):
+        ids = self._insert_tickets(3)
+        self.env.db_transaction("""
+            UPDATE ticket_custom SET value='42' WHERE name='totalhours'""")
+
+        self.admin._do_recalc(str(ids[1]))
+
+        self.assertEqual([42.0, 0.0, 42.0],
+                         [self._totalhours(tid) for tid in ids])
+
+    def test_recalc_resume(self):
+        ids = self._insert_tickets(3)
+        self.env.db_transaction("""
+            UPDATE ticket_custom SET value='42' WHERE name='totalhours'""")
+        self.env.db_transaction("""
+            INSERT INTO system (name, value) VALUES (%s, %s)
+            """, (self.admin.recalc_checkpoint, ids[0]))
+
+        self.admin._do_recalc('resume')
+
+        self.assertEqual([42.0, 0.0, 0.0],
+                         [self._totalhours(tid) for tid in ids])
+
+    def _export_import(self, format):
+        ids = self._insert_tickets(2)
+        self.hours_thp.add_ticket_hours(ids[0], 'joe', 3600,
+                                        comments=u'caf\xe9, "quoted"')
+        self.hours_thp.add_ticket_hours(ids[1], 'jim', 1800, submitter='joe')
+        exported = self.hours_thp.get_ticket_hours(ids)
+        filename = os.path.join(self.env.path, 'hours.' + format)
+
+        self.admin._do_export(format, filename)
+        self.env.db_transaction("DELETE FROM ticket_time")
+        self.hours_thp.update_ticket_hours(ids)
+        self.admin._do_import(format, filename)
+
+        imported = self.hours_thp.get_ticket_hours(ids)
+        for record in exported + imported:
+            del record['id']
+        self.assertEqual(exported, imported)
+        self.assertEqual([1.0, 0.5], [self._totalhours(tid) for tid in ids])
+
+    def test_export_import_csv(self):
+        self._export_import('csv')
+
+    def test_export_import_ndjson(self):
+        self._export_import('ndjson')
+
+    def _import_records(self, records):
+        tickets = set()
+        rejected = []
+        count = self.admin.import_records(iter(records), tickets, rejected)
+        return count, tickets, rejected
+
+    def test_import_chunks(self):
+        ids = self._insert_tickets(1)
+        records = [{'ticket': ids[0], 'worker': 'joe', 'seconds_worked': 60}
+                   for i in range(5)]
+        count, tickets, rejected = self._import_records(records)
+        self.assertEqual(5, count)
+        self.assertEqual(set(ids), tickets)
+        self.assertEqual([], rejected)
+        self.assertEqual(5, len(self.hours_thp.get_ticket_hours(ids[0])))
+        self.assertEqual(5, len(list(self.admin.iter_records())))
+
+    def test_import_missing_tickets(self):
+        ids = self._insert_tickets(1)
+        records = [{'ticket': tid, 'worker': 'joe', 'seconds_worked': 60}
+                   for tid in (ids[0], 99, ids[0], 98)]
+        count, tickets, rejected = self._import_records(records)
+        self.assertEqual(2, count)
+        self.assertEqual(set(ids), tickets)
+        self.assertEqual([(2, 99), (4, 98)], rejected)
+        self.assertEqual([ids[0]] * 2, [row[1] for row
+                                        in self.admin.iter_records()])
+
+    def test_import_invalid(self):
+        ids = self._insert_tickets(1)
+        filename = os.path.join(self.env.path, 'hours.ndjson')
+        with open(filename, 'w') as f:
+            for seconds in ('3600', '1800', 'soon'):
+                f.write(json.dumps({'ticket': ids[0], 'worker': 'joe',
+                                    'seconds_worked': seconds}) + '\n')
+        try:
+            self.admin._do_import('ndjson', filename)
+        except AdminCommandError, e:
+            self.assertIn('2 time records imported', unicode(e))
+        else:
+            self.fail('AdminCommandError not raised')
+        # the committed records are counted in the total hours
+        self.assertEqual(1.5, self._totalhours(ids[0]))
+
+    def test_prune(self):
+        ids = self._insert_tickets(1)
+        for seconds in (60, 120):
+            self.hours_thp.add_ticket_hours(ids[0], 'joe', seconds)
+        self.env.db_transaction("UPDATE ticket_time_changes SET time=0")
+        self.admin._do_prune()
+        self.assertEqual([2], [change['seq'] for change
+                               in self.hours_thp.get_changes(1)])
+
+    def test_digest(self):
+        ids = self._insert_tickets(2)
+        for tid in ids + ids:
+            self.hours_thp.queue_comment(tid, 'joe', 'hours logged')
+        self.admin._do_digest()
+        self.assertEqual(2, self.env.db_query("""
+            SELECT COUNT(*) FROM ticket_change WHERE field='comment'
+            """)[0][0])
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TracHoursAdminTestCase, 'test'))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+import unittest
+
+from trachours import aggregate
+from trachours.aggregate import get_backend, group_sum
+
+
+class ArrayBackendTestCase(unittest.TestCase):
+
+    backend = 'array'
+
+    workers = [u'joe', u'jim', u'joe', u'jack', u'jim']
+    tickets = [1, 2, 1, 1, 3]
+    seconds = [3600, 1800, 900, 60, 600]
+
+    def test_backend(self):
+        self.assertEqual(self.backend, get_backend(self.backend).name)
+
+    def test_single_key(self):
+        self.assertEqual([(u'joe', 4500), (u'jim', 2400), (u'jack', 60)],
+                         group_sum(self.seconds, self.workers,
+                                   backend=self.backend))
+        self.assertEqual([(1, 4560), (2, 1800), (3, 600)],
+                         group_sum(self.seconds, self.tickets,
+                                   backend=self.backend))
+
+    def test_several_keys(self):
+        self.assertEqual([((u'joe', 1), 4500), ((u'jim', 2), 1800),
+                          ((u'jack', 1), 60), ((u'jim', 3), 600)],
+                         group_sum(self.seconds, self.workers, self.tickets,
+                                   backend=self.backend))
+        self.assertEqual([((1, u'joe', None), 4500),
+                          ((2, u'jim', u'm1'), 1800),
+                          ((1, u'jack', None), 60),
+                          ((3, u'jim', u'm1'), 600)],
+                         group_sum(self.seconds, self.tickets, self.workers,
+                                   [None, u'm1', None, None, u'm1'],
+                                   backend=self.backend))
+
+    def test_values(self):
+        totals = group_sum([0.5, 0.25, 1.0], [u'a', u'b', u'a'],
+                           backend=self.backend)
+        self.assertEqual([(u'a', 1.5), (u'b', 0.25)], totals)
+        self.assertEqual([], group_sum([], [], [], backend=self.backend))
+        self.assertRaises(ValueError, group_sum, self.seconds)
+
+    def test_floor_divide(self):
+        self.assertEqual([0, 1, 2],
+                         list(get_backend(self.backend)
+                              .floor_divide([899, 900, 2000], 900)))
+
+
+class NumpyBackendTestCase(ArrayBackendTestCase):
+
+    backend = 'numpy'
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(ArrayBackendTestCase, 'test'))
+    if aggregate.numpy is not None:
+        suite.addTest(unittest.makeSuite(NumpyBackendTestCase, 'test'))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
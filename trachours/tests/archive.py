@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+
+from trac.perm import PermissionSystem
+from trac.test import EnvironmentStub, MockRequest
+from trac.ticket.model import Ticket
+from trac.util.datefmt import to_timestamp, utc
+from trac.web.api import RequestDone
+
+from trachours.admin import TracHoursAdmin
+from trachours.archive import TracHoursArchive
+from trachours.db import SetupTracHours
+from trachours.hours import TracHoursPlugin
+from trachours.search import TracHoursSearch
+from trachours.web_ui import TracUserHours
+
+from trachours.tests import revert_trachours_schema_init
+
+
+class ArchiveTestCase(unittest.TestCase):
+    def setUp(self):
+        self.env = EnvironmentStub(default_data=True,
+                                   enable=['trac.*', 'trachours.*'])
+        self.env.path = tempfile.mkdtemp()
+        setup = SetupTracHours(self.env)
+        with self.env.db_transaction as db:
+            setup.upgrade_environment(db)
+        PermissionSystem(self.env).grant_permission('joe',
+                                                    'TICKET_VIEW_HOURS')
+        self.hours_thp = TracHoursPlugin(self.env)
+        self.archive = TracHoursArchive(self.env)
+        ticket = Ticket(self.env)
+        ticket['summary'] = 'ticket summary'
+        ticket.insert()
+        self.ticket = ticket.id
+        self.add_hours('joe', datetime(2018, 1, 1, 9), 3600, 'outage')
+        self.add_hours('joe', datetime(2018, 1, 1, 14), 3600)
+        self.add_hours('jim', datetime(2018, 1, 3, 9), 1800)
+        self.add_hours('joe', datetime(2018, 12, 31, 9), 900, 'outage')
+        self.add_hours('joe', datetime(2019, 1, 1, 9), 900)
+        self.hours_thp.update_ticket_hours([self.ticket])
+        self.cutoff = self.timestamp(datetime(2018, 7, 1))
+
+    def tearDown(self):
+        self.env.reset_db()
+        revert_trachours_schema_init(self.env)
+        shutil.rmtree(self.env.path)
+
+    def timestamp(self, dt):
+        return to_timestamp(dt.replace(tzinfo=utc))
+
+    def add_hours(self, worker, started, seconds, comments=''):
+        started = self.timestamp(started)
+        self.env.db_transaction("""
+            INSERT INTO ticket_time (ticket, time_submitted, worker,
+              submitter, time_started, seconds_worked, comments)
+            VALUES (%s, %s, %s, %s, %s, %s, %s)
+            """, (self.ticket, started, worker, worker, started, seconds,
+                  comments))
+
+    def _ids(self, table):
+        return [id_ for id_, in self.env.db_query("""
+            SELECT id FROM %s ORDER BY id""" % table)]
+
+    def _summary(self):
+        return self.env.db_query("""
+            SELECT ticket, worker, seconds, entries
+            FROM ticket_time_archive_summary ORDER BY worker""")
+
+    def test_archive(self):
+        self.assertEqual((self.cutoff, 3),
+                         self.archive.archive(self.cutoff, 1))
+        self.assertEqual([4, 5], self._ids('ticket_time'))
+        self.assertEqual([1, 2, 3], self._ids('ticket_time_archive'))
+        self.assertEqual([(self.ticket, 'jim', 1800, 1),
+                          (self.ticket, 'joe', 7200, 2)], self._summary())
+        self.assertEqual(self.cutoff, self.hours_thp.archived_before)
+
+        # an earlier cutoff keeps the current one
+        self.assertEqual((self.cutoff, 0), self.archive.archive(0))
+
+    def test_new_ids(self):
+        self.archive.archive(self.cutoff)
+        # the records left are deleted, so SQLite would reuse the ids
+        self.hours_thp.update_time_records('joe', deletes=[4, 5])
+        self.hours_thp.add_many_ticket_hours(self.ticket, 'joe',
+                                             [(60, ''), (120, '')])
+        self.assertEqual([4, 5], self._ids('ticket_time'))
+        self.assertEqual([1, 2, 3], self._ids('ticket_time_archive'))
+
+        cutoff = self.timestamp(datetime(2100, 1, 1))
+        self.assertEqual((cutoff, 2), self.archive.archive(cutoff))
+        self.assertEqual([], self._ids('ticket_time'))
+        self.hours_thp.add_ticket_hours(self.ticket, 'joe', 60)
+        self.assertEqual([6], self._ids('ticket_time'))
+        self.assertEqual([1, 2, 3, 4, 5, 6], sorted(
+            record['id'] for record
+            in self.hours_thp.get_ticket_hours(self.ticket)))
+
+    def test_total_hours(self):
+        totalhours = Ticket(self.env, self.ticket)['totalhours']
+        self.archive.archive(self.cutoff)
+        self.assertEqual(10800, self.hours_thp.get_total_hours(self.ticket))
+        self.hours_thp.update_ticket_hours([self.ticket])
+        self.assertEqual(totalhours,
+                         Ticket(self.env, self.ticket)['totalhours'])
+
+    def test_ticket_hours(self):
+        self.archive.archive(self.cutoff)
+        self.assertEqual([1, 2, 3, 4, 5], sorted(
+            record['id'] for record
+            in self.hours_thp.get_ticket_hours(self.ticket)))
+        self.assertEqual([3, 4], sorted(
+            record['id'] for record in self.hours_thp.get_ticket_hours(
+                self.ticket, datetime(2018, 1, 2), datetime(2019, 1, 1))))
+        self.assertEqual([4], [
+            record['id'] for record in self.hours_thp.get_ticket_hours(
+                self.ticket, datetime(2018, 8, 1), datetime(2019, 1, 1))])
+
+    def test_table(self):
+        self.assertEqual('ticket_time', self.hours_thp.time_records_table())
+        self.archive.archive(self.cutoff)
+        self.assertEqual('ticket_time', self.hours_thp.time_records_table(
+            self.cutoff))
+        self.assertIn('ticket_time_archive',
+                      self.hours_thp.time_records_table(self.cutoff - 1))
+        self.assertIn('ticket_time_archive',
+                      self.hours_thp.time_records_table())
+
+    def test_users(self):
+        self.archive.archive(self.cutoff)
+        user_hours = TracUserHours(self.env)
+        req = MockRequest(self.env, authname='joe', path_info='/hours/user',
+                          args={'from_date': '01/01/18',
+                                'to_date': '12/31/18'}, tz=utc)
+        self.assertTrue(user_hours.match_request(req))
+        data = user_hours.process_request(req)[1]
+        self.assertEqual([('jim', 0.5), ('joe', 2.25)], data['worker_hours'])
+
+    def test_delete_ticket_hours(self):
+        self.archive.archive(self.cutoff)
+        self.hours_thp.delete_ticket_hours(self.ticket)
+        self.assertEqual([], self._ids('ticket_time'))
+        self.assertEqual([], self._ids('ticket_time_archive'))
+        self.assertEqual([], self._summary())
+        self.assertEqual(0, self.hours_thp.get_total_hours(self.ticket))
+        self.assertEqual([1, 2, 3, 4, 5], sorted(
+            change['entry'] for change in self.hours_thp.get_changes()
+            if change['operation'] == 'delete'))
+
+    def test_edit_archived(self):
+        self.archive.archive(self.cutoff)
+        PermissionSystem(self.env).grant_permission('joe',
+                                                    'TICKET_ADD_HOURS')
+        ticket = Ticket(self.env, self.ticket)
+        req = MockRequest(self.env, authname='joe',
+                          path_info='/hours/%s' % self.ticket)
+        data = self.hours_thp.process_ticket(req)[1]
+        self.assertEqual(set([1, 2, 3]), data['archived'])
+
+        req = MockRequest(self.env, authname='joe', method='POST',
+                          path_info='/hours/%s' % self.ticket,
+                          args={'hours_1': '2:00', 'rm_2': 'on',
+                                'hours_4': '0:30'})
+        self.assertRaises(RequestDone, self.hours_thp.edit_ticket_hours,
+                          req, ticket)
+        self.assertEqual(1, len(req.chrome['warnings']))
+        self.assertEqual([(1, 3600), (2, 3600), (4, 1800)],
+                         self.env.db_query("""
+                             SELECT id, seconds_worked FROM ticket_time_archive
+                             WHERE id IN (1, 2)
+                             UNION ALL
+                             SELECT id, seconds_worked FROM ticket_time
+                             WHERE id=4 ORDER BY id"""))
+
+    def test_export(self):
+        self.archive.archive(self.cutoff)
+        self.assertEqual([1, 2, 3, 4, 5], [
+            row[0] for row in TracHoursAdmin(self.env).iter_records()])
+
+    def test_search(self):
+        self.archive.archive(self.cutoff)
+        self.assertEqual([4, 1], [row[0] for row in
+                                  TracHoursSearch(self.env).search(
+                                      ['outage'])])
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(ArchiveTestCase, 'test'))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
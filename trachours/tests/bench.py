@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+import unittest
+
+from trachours.benchmarks import benchmarks, run
+from trachours.benchmarks.dataset import Dataset
+
+
+class BenchmarksTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dataset = Dataset(tickets=10, workers=3, milestones=2,
+                               entries=50, days=30)
+        self.env = self.dataset.create()
+
+    def tearDown(self):
+        self.dataset.destroy()
+
+    def test_dataset(self):
+        self.assertEqual(10, self.env.db_query("""
+            SELECT COUNT(*) FROM ticket""")[0][0])
+        self.assertEqual(50, self.env.db_query("""
+            SELECT COUNT(*) FROM ticket_time""")[0][0])
+        total, = self.env.db_query("""
+            SELECT SUM(seconds_worked) FROM ticket_time""")[0]
+        totalhours = sum(float(value) for value, in self.env.db_query("""
+            SELECT value FROM ticket_custom WHERE name='totalhours'"""))
+        self.assertAlmostEqual(total / 3600.0, totalhours, 1)
+
+    def test_run(self):
+        results = run(self.dataset, repeat=1)
+        self.assertEqual(sorted(func.__name__ for func in benchmarks),
+                         sorted(results))
+        for name, result in results.iteritems():
+            self.assertNotIn('error', result,
+                             '%s: %s' % (name, result.get('error')))
+            self.assertIn('median', result, name)
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(BenchmarksTestCase, 'test'))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from trac.test import EnvironmentStub
+from trac.ticket.model import Ticket
+
+from trachours.cache import SharedCache
+from trachours.db import SetupTracHours
+from trachours.hours import TracHoursPlugin
+
+from trachours.tests import revert_trachours_schema_init
+
+
+class SharedCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.env = EnvironmentStub(default_data=True,
+                                   enable=['trac.*', 'trachours.*'])
+        self.env.path = tempfile.mkdtemp()
+        setup = SetupTracHours(self.env)
+        with self.env.db_transaction as db:
+            setup.upgrade_environment(db)
+        self.hours_thp = TracHoursPlugin(self.env)
+        self.computed = []
+
+    def tearDown(self):
+        self.env.reset_db()
+        revert_trachours_schema_init(self.env)
+        shutil.rmtree(self.env.path)
+
+    def compute(self, keys):
+        # the results are the number of the call
+        self.computed.append(keys)
+        return dict((key, len(self.computed)) for key in keys)
+
+    def test_shared(self):
+        # the caches of two processes
+        cache = SharedCache(self.env, 'test')
+        other = SharedCache(self.env, 'test')
+        self.assertEqual({'a': 1, 'b': 1},
+                         cache.get_many(['a', 'b'], self.compute, 60))
+        self.assertEqual({'a': 1, 'b': 1, 'c': 2},
+                         other.get_many(['a', 'b', 'c'], self.compute, 60))
+        self.assertEqual([['a', 'b'], ['c']], self.computed)
+        self.assertEqual(3, len(cache))
+
+    def test_generation(self):
+        cache = SharedCache(self.env, 'test')
+        cache.get_many(['a'], self.compute, 60)
+        ticket = Ticket(self.env)
+        ticket['summary'] = 'ticket summary'
+        ticket.insert()
+        generation = self.hours_thp.get_generation()
+        self.assertEqual({'a': 2}, cache.get_many(['a'], self.compute, 60))
+        self.hours_thp.add_ticket_hours(ticket.id, 'joe', 60)
+        self.assertEqual(generation + 1, self.hours_thp.get_generation())
+        self.assertEqual({'a': 3}, cache.get_many(['a'], self.compute, 60))
+        self.assertEqual({'a': 3}, cache.get_many(['a'], self.compute, 60))
+
+    def test_ttl(self):
+        cache = SharedCache(self.env, 'test')
+        self.assertEqual(1, cache.get('a', lambda: self.compute(['a'])['a'],
+                                      0))
+        self.assertEqual(0, len(cache))
+        cache.get_many(['a'], self.compute, -1)
+        self.assertEqual({'a': 3}, cache.get_many(['a'], self.compute, 60))
+
+    def test_invalid_file(self):
+        cache = SharedCache(self.env, 'test')
+        cache.get_many(['a'], self.compute, 60)
+        with open(cache._path('a'), 'wb') as f:
+            f.write('garbage')
+        self.assertEqual({'a': 2}, cache.get_many(['a'], self.compute, 60))
+
+    def test_evict(self):
+        cache = SharedCache(self.env, 'test', size=10)
+        for key in xrange(25):
+            cache.get_many([key], self.compute, 60)
+        self.assertTrue(len(cache) <= 11)
+        cache.invalidate()
+        self.assertEqual(0, len(cache))
+        self.assertTrue(os.path.isdir(cache.directory))
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(SharedCacheTestCase, 'test'))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
@@ -12,9 +12,9 @@ import unittest
 
 from trac.test import EnvironmentStub
 # from trac.ticket.api import TicketSystem
-# from trac.ticket.model import Ticket
+from trac.ticket.model import Ticket
 
-# from trachours.hours import TracHoursPlugin
+from trachours.hours import TracHoursPlugin
 from trachours.db import SetupTracHours
 # from trachours.ticket import TracHoursByComment
 
@@ -48,6 +48,47 @@ class TracHoursSetupTestCase(unittest.TestCase):
         ret = self.setup._needs_user_manual()
         self.assertFalse(ret)
 
+    def test_upgrade_copies_estimated_hours(self):
+        ids = []
+        for estimate in ('3', '', '-1', '0.5'):
+            ticket = Ticket(self.env)
+            ticket['summary'] = 'ticket summary'
+            ticket['estimatedhours'] = estimate
+            ids.append(ticket.insert())
+        with self.env.db_transaction as db:
+            db("DROP TABLE ticket_time_estimate")
+            db("DROP TABLE ticket_time_changes")
+            db("DROP TABLE ticket_time_digest")
+            db("DROP INDEX ticket_time_time_submitted_idx")
+            db("DROP TABLE ticket_time_archive")
+            db("DROP TABLE ticket_time_archive_summary")
+            db("UPDATE system SET value='4' WHERE name='trachours.db_version'")
+        self.assertEqual(4, self.setup.version())
+        self.setup.upgrade_environment()
+        self.assertEqual(self.setup.db_version, self.setup.version())
+        self.assertEqual({ids[0]: 10800, ids[3]: 1800},
+                         TracHoursPlugin(self.env).get_estimated_hours(ids))
+
+    def test_upgrade_adds_write_generation(self):
+        hours = TracHoursPlugin(self.env)
+        hours.bump_generation()
+        self.assertEqual(1, hours.get_generation())
+        # the generation of an upgraded environment is kept
+        self.env.db_transaction("""
+            UPDATE system SET value='10' WHERE name='trachours.db_version'
+            """)
+        self.setup.upgrade_environment()
+        self.assertEqual(1, hours.get_generation())
+
+        self.env.db_transaction("""
+            DELETE FROM system WHERE name='trachours.write_generation'
+            """)
+        self.setup.add_write_generation()
+        self.assertEqual(0, hours.get_generation())
+        hours.bump_generation()
+        hours.bump_generation()
+        self.assertEqual(2, hours.get_generation())
+
 
 def test_suite():
     suite = unittest.TestSuite()
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+import json
+import shutil
+import tempfile
+import time
+import unittest
+
+from trac.core import TracError
+from trac.perm import PermissionSystem
+from trac.test import EnvironmentStub, MockRequest
+from trac.ticket.model import Ticket
+from trac.web.api import RequestDone
+
+from trachours.db import SetupTracHours
+from trachours.delta import TracHoursDeltaFeed
+from trachours.hours import TracHoursPlugin
+
+from trachours.tests import revert_trachours_schema_init
+
+
+class DeltaFeedTestCase(unittest.TestCase):
+    def setUp(self):
+        self.env = EnvironmentStub(default_data=True,
+                                   enable=['trac.*', 'trachours.*'])
+        self.env.path = tempfile.mkdtemp()
+        setup = SetupTracHours(self.env)
+        with self.env.db_transaction as db:
+            setup.upgrade_environment(db)
+        PermissionSystem(self.env).grant_permission('joe', 'TICKET_ADD_HOURS')
+        PermissionSystem(self.env).grant_permission('joe',
+                                                    'TICKET_VIEW_HOURS')
+        self.hours_thp = TracHoursPlugin(self.env)
+        self.feed = TracHoursDeltaFeed(self.env)
+        ticket = Ticket(self.env)
+        ticket['summary'] = 'ticket summary'
+        ticket.insert()
+        self.ticket = ticket
+        for seconds in (600, 1200, 1800):
+            self.hours_thp.add_ticket_hours(ticket.id, 'joe', seconds)
+        self._settle()
+
+    def tearDown(self):
+        self.env.reset_db()
+        revert_trachours_schema_init(self.env)
+        shutil.rmtree(self.env.path)
+
+    def _settle(self):
+        self.env.db_transaction("UPDATE ticket_time_changes SET time=0")
+
+    def _changes(self, **args):
+        req = MockRequest(self.env, authname='joe',
+                          path_info='/hours/changes', args=args)
+        self.assertTrue(self.feed.match_request(req))
+        self.assertRaises(RequestDone, self.feed.process_request, req)
+        return json.loads(req.response_sent.getvalue())
+
+    def _edit(self, **args):
+        req = MockRequest(self.env, authname='joe', method='POST',
+                          path_info='/hours/%s' % self.ticket.id, args=args)
+        self.assertRaises(RequestDone, self.hours_thp.edit_ticket_hours,
+                          req, self.ticket)
+
+    def test_initial(self):
+        delta = self._changes()
+        self.assertEqual([1, 2, 3], [r['id'] for r in delta['records']])
+        self.assertEqual(1200, delta['records'][1]['seconds_worked'])
+        self.assertEqual([], delta['deleted'])
+        self.assertEqual('3', delta['cursor'])
+        self.assertFalse(delta['more'])
+
+    def test_incremental(self):
+        cursor = self._changes()['cursor']
+        self.assertEqual([], self._changes(since=cursor)['records'])
+        self._edit(hours_2='1:00', rm_3='on')
+        # SQLite reuses the id of the deleted record
+        self.hours_thp.add_ticket_hours(self.ticket.id, 'joe', 60)
+        self._settle()
+        delta = self._changes(since=cursor)
+        self.assertEqual([(2, 3600), (3, 60)],
+                         [(r['id'], r['seconds_worked'])
+                          for r in delta['records']])
+        self.assertEqual([{'id': 3, 'ticket': self.ticket.id,
+                           'worker': 'joe'}], delta['deleted'])
+        self.assertEqual('6', delta['cursor'])
+        self.assertEqual([], self._changes(since='6')['records'])
+
+    def test_delete_ticket_hours(self):
+        self.hours_thp.delete_ticket_hours(self.ticket.id)
+        self._settle()
+        delta = self._changes(since='3')
+        self.assertEqual([1, 2, 3], [d['id'] for d in delta['deleted']])
+        self.assertEqual([], delta['records'])
+        self.assertEqual('6', delta['cursor'])
+
+    def test_paging(self):
+        delta = self._changes(limit='2')
+        self.assertEqual([1, 2], [r['id'] for r in delta['records']])
+        self.assertEqual('3.2', delta['cursor'])
+        self.assertTrue(delta['more'])
+        self._edit(hours_1='0:20')
+        self._settle()
+        delta = self._changes(since=delta['cursor'], limit='2')
+        self.assertEqual([3], [r['id'] for r in delta['records']])
+        self.assertEqual('3', delta['cursor'])
+        self.assertTrue(delta['more'])
+        delta = self._changes(since=delta['cursor'], limit='2')
+        self.assertEqual([(1, 1200)], [(r['id'], r['seconds_worked'])
+                                       for r in delta['records']])
+        self.assertFalse(delta['more'])
+
+    def test_now(self):
+        self._edit(hours_1='0:20')
+        self._settle()
+        delta = self._changes(since='now')
+        self.assertEqual([], delta['records'])
+        self.assertEqual('4', delta['cursor'])
+
+    def test_pruned(self):
+        self.env.db_transaction("""
+            UPDATE ticket_time_changes SET time=0 WHERE seq < 3""")
+        self.hours_thp.prune_changes()
+        self.assertEqual([3], [r['id'] for r in
+                               self._changes(since='2')['records']])
+        req = MockRequest(self.env, authname='joe',
+                          path_info='/hours/changes', args={'since': '1'})
+        self.assertRaises(RequestDone, self.feed.process_request, req)
+        self.assertEqual('410 Gone', req.status_sent[0])
+        self.assertEqual({'reset': True},
+                         json.loads(req.response_sent.getvalue()))
+
+    def test_late_change(self):
+        # the change 4 is logged by a transaction still open
+        self.env.db_transaction("""
+            INSERT INTO ticket_time_changes (seq, operation, entry, ticket,
+              worker, old_seconds, new_seconds, time)
+            VALUES (5, 'update', 2, %s, 'joe', 1200, 1200, %s)
+            """, (self.ticket.id, int(time.time())))
+        delta = self._changes(since='3')
+        self.assertEqual([2], [r['id'] for r in delta['records']])
+        self.assertEqual('3', delta['cursor'])
+        self.assertFalse(delta['more'])
+        self.env.db_transaction("""
+            UPDATE ticket_time SET seconds_worked=60 WHERE id=1""")
+        self.env.db_transaction("""
+            INSERT INTO ticket_time_changes (seq, operation, entry, ticket,
+              worker, old_seconds, new_seconds, time)
+            VALUES (4, 'update', 1, %s, 'joe', 600, 60, %s)
+            """, (self.ticket.id, int(time.time())))
+        delta = self._changes(since=delta['cursor'])
+        self.assertEqual([(1, 60), (2, 1200)],
+                         [(r['id'], r['seconds_worked'])
+                          for r in delta['records']])
+        self.assertEqual('3', delta['cursor'])
+        self._settle()
+        delta = self._changes(since=delta['cursor'])
+        self.assertEqual([1, 2], [r['id'] for r in delta['records']])
+        self.assertEqual('5', delta['cursor'])
+        self.assertEqual([], self._changes(since='5')['records'])
+
+    def test_invalid_cursor(self):
+        self.assertRaises(TracError, self._changes, since='3.x')
+        self.assertRaises(TracError, self._changes, since='a')
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(DeltaFeedTestCase, 'test'))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
@@ -11,10 +11,14 @@ import tempfile
 import unittest
 from datetime import datetime
 
-from trac.test import EnvironmentStub, Mock
+from trac.notification.api import NotificationSystem
+from trac.perm import PermissionError, PermissionSystem
+from trac.test import EnvironmentStub, Mock, MockRequest
 from trac.ticket.model import Ticket
+from trac.web.api import RequestDone
 from trac.util.translation import _
 
+from trachours.api import ChangesPrunedError
 from trachours.hours import TracHoursPlugin
 from trachours.db import SetupTracHours
 
@@ -63,6 +67,133 @@ class HoursTicketManipulatorTestCase(unittest.TestCase):
         hours = self.hours_thp.get_ticket_hours(tid)
         self.assertEqual([], hours)
 
+    def test_edit_ticket_hours(self):
+        ticket = Ticket(self.env)
+        ticket['summary'] = 'ticket summary'
+        ticket.insert()
+        PermissionSystem(self.env).grant_permission('joe', 'TICKET_ADD_HOURS')
+        self.hours_thp.add_ticket_hours(ticket.id, 'joe', 1800)
+        self.hours_thp.add_ticket_hours(ticket.id, 'joe', 3600)
+        self.hours_thp.add_ticket_hours(ticket.id, 'jim', 600)
+        req = MockRequest(self.env, authname='joe', method='POST',
+                          path_info='/hours/%s' % ticket.id,
+                          args={'hours_1': '1:00', 'hours_2': '1:00',
+                                'hours_3': '0:10', 'rm_2': 'on'})
+
+        self.assertRaises(RequestDone, self.hours_thp.edit_ticket_hours,
+                          req, ticket)
+        hours = self.hours_thp.get_ticket_hours(ticket.id)
+        self.assertEqual([(1, 3600), (3, 600)],
+                         sorted((h['id'], h['seconds_worked'])
+                                for h in hours))
+        self.assertEqual(1.17, float(Ticket(self.env, ticket.id)['totalhours']))
+
+    def test_edit_others_ticket_hours_requires_admin(self):
+        ticket = Ticket(self.env)
+        ticket['summary'] = 'ticket summary'
+        ticket.insert()
+        PermissionSystem(self.env).grant_permission('joe', 'TICKET_ADD_HOURS')
+        self.hours_thp.add_ticket_hours(ticket.id, 'jim', 600)
+        req = MockRequest(self.env, authname='joe', method='POST',
+                          path_info='/hours/%s' % ticket.id,
+                          args={'rm_1': 'on'})
+
+        self.assertRaises(PermissionError, self.hours_thp.edit_ticket_hours,
+                          req, ticket)
+        self.assertEqual(1, len(self.hours_thp.get_ticket_hours(ticket.id)))
+
+    def test_hours_rss(self):
+        ticket = Ticket(self.env)
+        ticket['summary'] = 'ticket summary'
+        ticket.insert()
+        self.hours_thp.add_ticket_hours(ticket.id, 'joe', 5400,
+                                        time_started=datetime(2026, 5, 29))
+        req = MockRequest(self.env, path_info='/hours',
+                          args={'format': 'rss', 'worker_filter': '*any',
+                                'from_date': '05/01/26',
+                                'to_date': '05/31/26'})
+        template, data, content_type = self.hours_thp.process_request(req)
+        self.assertEqual('hours.rss', template)
+        self.assertEqual(['1:30 hours worked by joe'],
+                         [item['title'] for item in data['items']])
+        self.assertTrue(data['items'][0]['date'].startswith(
+            'Fri, 29 May 2026 '))
+
+    def test_group_by_worker(self):
+        ids = []
+        for summary in ('first', 'second'):
+            ticket = Ticket(self.env)
+            ticket['summary'] = summary
+            ticket['estimatedhours'] = '2'
+            ticket.insert()
+            ids.append(ticket.id)
+        started = datetime(2026, 5, 29)
+        for tid, worker, seconds in [(ids[0], 'joe', 1800),
+                                     (ids[1], 'jim', 3600),
+                                     (ids[1], 'joe', 5400),
+                                     (ids[0], 'jim', 900)]:
+            self.hours_thp.add_ticket_hours(tid, worker, seconds,
+                                            time_started=started)
+        req = MockRequest(self.env, path_info='/hours',
+                          args={'group': 'worker', 'order': 'seconds_worked',
+                                'desc': '1', 'status': '!closed',
+                                'worker_filter': '*any',
+                                'from_date': '05/01/26',
+                                'to_date': '05/31/26'})
+        template, data, content_type = self.hours_thp.process_request(req)
+
+        self.assertEqual([('jim', [(ids[1], 3600), (ids[0], 900)]),
+                          ('joe', [(ids[1], 5400), (ids[0], 1800)])],
+                         [(key, [(r.ticket, r.seconds_worked)
+                                 for r in records])
+                          for key, records in data['groups']])
+        self.assertEqual('second', data['groups'][0][1][0]['summary'])
+        self.assertEqual({'jim': '1.25', 'joe': '2.0'}, data['total_times'])
+        self.assertEqual({'jim': '4.0', 'joe': '4.0'},
+                         data['total_estimated_times'])
+
+    def test_estimated_hours_totals(self):
+        ids = []
+        for estimate in ('2', '0.5'):
+            ticket = Ticket(self.env)
+            ticket['summary'] = 'ticket summary'
+            ticket['estimatedhours'] = estimate
+            ticket.insert()
+            ids.append(ticket.id)
+        for tid, worker in [(ids[0], 'joe'), (ids[0], 'jim'),
+                            (ids[0], 'joe'), (ids[1], 'joe')]:
+            self.hours_thp.add_ticket_hours(tid, worker, 600)
+        self.assertEqual({'joe': 9000, 'jim': 7200},
+                         self.hours_thp.get_estimated_hours_totals(
+                             ids, 'worker'))
+        self.assertEqual({ids[0]: 7200, ids[1]: 1800},
+                         self.hours_thp.get_estimated_hours_totals(
+                             ids, 'ticket'))
+
+    def test_estimated_hours(self):
+        ticket = Ticket(self.env)
+        ticket['summary'] = 'ticket summary'
+        ticket['estimatedhours'] = '1.5'
+        ticket.insert()
+        other = Ticket(self.env)
+        other['summary'] = 'other summary'
+        other['estimatedhours'] = '2'
+        other.insert()
+        self.assertEqual({ticket.id: 5400, other.id: 7200},
+                         self.hours_thp.get_estimated_hours([ticket.id,
+                                                             other.id]))
+
+        ticket['estimatedhours'] = 'not a number'
+        ticket.save_changes('joe')
+        other['estimatedhours'] = '0.25'
+        other.save_changes('joe')
+        self.assertEqual({other.id: 900},
+                         self.hours_thp.get_estimated_hours([ticket.id,
+                                                             other.id]))
+
+        other.delete()
+        self.assertEqual({}, self.hours_thp.get_estimated_hours([other.id]))
+
     def test_prepare_ticket_exists(self):
         req = ticket = fields = actions = {}
         self.assertEquals(None,
@@ -104,9 +235,190 @@ class HoursTicketManipulatorTestCase(unittest.TestCase):
                           self.hours_thp.validate_ticket(req, ticket)[0][1])
 
 
+class ChangeLogTestCase(unittest.TestCase):
+    def setUp(self):
+        self.env = EnvironmentStub(default_data=True,
+                                   enable=['trac.*', 'trachours.*'])
+        self.env.path = tempfile.mkdtemp()
+        setup = SetupTracHours(self.env)
+        with self.env.db_transaction as db:
+            setup.upgrade_environment(db=db)
+        self.hours_thp = TracHoursPlugin(self.env)
+        PermissionSystem(self.env).grant_permission('joe', 'TICKET_ADD_HOURS')
+        self.ticket = Ticket(self.env)
+        self.ticket['summary'] = 'ticket summary'
+        self.ticket.insert()
+
+    def tearDown(self):
+        self.env.reset_db()
+        revert_trachours_schema_init(self.env)
+        shutil.rmtree(self.env.path)
+
+    def _changes(self, since=0, limit=None):
+        return [(change['seq'], change['operation'], change['entry'],
+                 change['worker'], change['old_seconds'],
+                 change['new_seconds'])
+                for change in self.hours_thp.get_changes(since, limit)]
+
+    def test_log(self):
+        self.hours_thp.add_many_ticket_hours(self.ticket.id, 'joe',
+                                             [(600, ''), (1200, '')])
+        req = MockRequest(self.env, authname='joe', method='POST',
+                          path_info='/hours/%s' % self.ticket.id,
+                          args={'hours_1': '0:20', 'rm_2': 'on'})
+        self.assertRaises(RequestDone, self.hours_thp.edit_ticket_hours,
+                          req, self.ticket)
+        self.hours_thp.add_ticket_hours(self.ticket.id, 'jim', 60)
+        self.hours_thp.delete_ticket_hours(self.ticket.id)
+        self.assertEqual([(1, 'insert', 1, 'joe', None, 600),
+                          (2, 'insert', 2, 'joe', None, 1200),
+                          (3, 'update', 1, 'joe', 600, 1200),
+                          (4, 'delete', 2, 'joe', 1200, None),
+                          (5, 'insert', 2, 'jim', None, 60),
+                          (6, 'delete', 1, 'joe', 1200, None),
+                          (7, 'delete', 2, 'jim', 60, None)],
+                         self._changes())
+        self.assertEqual([5, 6], [change[0]
+                                  for change in self._changes(4, 2)])
+
+    def test_insert_records(self):
+        rows = [(self.ticket.id, 0, 'joe', 'joe', 0, seconds, '')
+                for seconds in (60, 120, 180, 240, 300)]
+        ids = self.hours_thp.insert_records(rows[:2])
+        # a record added by another connection is not logged
+        self.env.db_transaction("""
+            INSERT INTO ticket_time (ticket, time_submitted, worker,
+              submitter, time_started, seconds_worked, comments)
+            VALUES (%s, 0, 'jim', 'jim', 0, 60, '')
+            """, (self.ticket.id,))
+        ids += self.hours_thp.insert_records(rows[2:], chunk_size=2)
+        self.hours_thp.log_inserts(ids, rows)
+        self.assertEqual([1, 2, 4, 5, 6], ids)
+        self.assertEqual([(1, 60), (2, 120), (4, 180), (5, 240), (6, 300)],
+                         self.env.db_query("""
+            SELECT id, seconds_worked FROM ticket_time WHERE worker='joe'
+            ORDER BY id"""))
+        self.assertEqual([(seq + 1, 'insert', id_, 'joe', None, row[5])
+                          for seq, (id_, row) in enumerate(zip(ids, rows))],
+                         self._changes())
+
+    def test_prune(self):
+        for seconds in (60, 120, 180):
+            self.hours_thp.add_ticket_hours(self.ticket.id, 'joe', seconds)
+        self.env.db_transaction("""
+            UPDATE ticket_time_changes SET time=0 WHERE seq < 3""")
+        self.assertEqual(2, self.hours_thp.prune_changes())
+        self.assertEqual([3], [change[0] for change in self._changes(2)])
+        self.assertRaises(ChangesPrunedError, self.hours_thp.get_changes, 1)
+
+        # the last change is kept
+        self.env.db_transaction("UPDATE ticket_time_changes SET time=0")
+        self.assertEqual(0, self.hours_thp.prune_changes())
+        self.hours_thp.add_ticket_hours(self.ticket.id, 'joe', 240)
+        self.assertEqual([(4, 'insert', 4, 'joe', None, 240)],
+                         self._changes(3))
+
+        self.env.config.set('trachours', 'changes_retention_days', '0')
+        self.env.db_transaction("UPDATE ticket_time_changes SET time=0")
+        self.assertEqual(0, self.hours_thp.prune_changes())
+
+
+class CommentDigestTestCase(unittest.TestCase):
+    def setUp(self):
+        self.env = EnvironmentStub(default_data=True,
+                                   enable=['trac.*', 'trachours.*'])
+        self.env.path = tempfile.mkdtemp()
+        setup = SetupTracHours(self.env)
+        with self.env.db_transaction as db:
+            setup.upgrade_environment(db=db)
+        self.env.config.set('trachours', 'comment_digest', 'enabled')
+        self.hours_thp = TracHoursPlugin(self.env)
+        for worker in ('joe', 'jim'):
+            PermissionSystem(self.env).grant_permission(worker,
+                                                        'TICKET_ADD_HOURS')
+        self.ticket = Ticket(self.env)
+        self.ticket['summary'] = 'ticket summary'
+        self.ticket.insert()
+
+    def tearDown(self):
+        self.env.reset_db()
+        revert_trachours_schema_init(self.env)
+        shutil.rmtree(self.env.path)
+
+    def _log(self, worker, hours, comments):
+        req = MockRequest(self.env, authname=worker, method='POST',
+                          path_info='/hours/%s' % self.ticket.id,
+                          args={'hours': hours, 'comments': comments})
+        self.assertRaises(RequestDone, self.hours_thp.do_ticket_change,
+                          req, self.ticket)
+
+    def _comments(self):
+        return [(author, newvalue) for author, newvalue in self.env.db_query("""
+            SELECT author, newvalue FROM ticket_change
+            WHERE ticket=%s AND field='comment' ORDER BY time
+            """, (self.ticket.id,))]
+
+    def test_digest(self):
+        self._log('joe', '1:30', 'design')
+        self._log('jim', '0:15', 'review')
+        self._log('joe', '0:30', 'fix')
+        self.assertEqual([], self._comments())
+        self.assertEqual(2, self.hours_thp.post_digests())
+        comments = self._comments()
+        self.assertEqual(['jim', 'joe'], [row[0] for row in comments])
+        self.assertIn('review', comments[0][1])
+        lines = comments[1][1].split('\n')
+        self.assertEqual(2, len(lines))
+        self.assertIn('design', lines[0])
+        self.assertIn('fix', lines[1])
+        # the hours of the digest are not logged again
+        self.assertEqual(3, len(self.hours_thp.get_ticket_hours(
+            self.ticket.id)))
+        self.assertEqual(0, self.hours_thp.post_digests())
+
+    def test_notify(self):
+        events = []
+        notification = NotificationSystem(self.env)
+        notification.notify = events.append
+        self._log('joe', '1:30', 'design')
+        self._log('jim', '0:15', 'review')
+        self.hours_thp.post_digests()
+        self.assertEqual([], events)
+
+        self.env.config.set('trachours', 'comment_digest_notify', 'enabled')
+        self._log('joe', '0:30', 'fix')
+        self.hours_thp.post_digests()
+        self.assertEqual([('changed', self.ticket.id, 'joe')],
+                         [(event.category, event.target.id, event.author)
+                          for event in events])
+        self.assertIn('fix', events[0].comment)
+
+    def test_interval(self):
+        self._log('joe', '1:30', 'design')
+        self.assertEqual(0, self.hours_thp.post_digests(3600))
+        self.env.config.set('trachours', 'comment_digest_interval', '0')
+        self._log('joe', '0:15', 'review')
+        self.assertEqual(1, len(self._comments()))
+        self.assertEqual(2, len(self._comments()[0][1].split('\n')))
+
+    def test_disabled(self):
+        self.env.config.set('trachours', 'comment_digest', 'disabled')
+        self._log('joe', '1:30', 'design')
+        self._log('joe', '0:15', 'review')
+        self.assertEqual(2, len(self._comments()))
+        self.assertEqual(0, self.hours_thp.post_digests())
+
+    def test_ticket_deleted(self):
+        self._log('joe', '1:30', 'design')
+        self.ticket.delete()
+        self.assertEqual(0, self.hours_thp.post_digests())
+
+
 def test_suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(HoursTicketManipulatorTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(ChangeLogTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(CommentDigestTestCase, 'test'))
     return suite
 
 
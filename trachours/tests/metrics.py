@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from trac.perm import PermissionError, PermissionSystem
+from trac.test import EnvironmentStub, MockRequest
+from trac.web.api import RequestDone
+
+from trachours import metrics
+from trachours.db import SetupTracHours
+from trachours.hours import TracHoursPlugin
+from trachours.metrics import TracHoursMetrics, format_metrics, snapshot
+
+from trachours.tests import revert_trachours_schema_init
+
+
+class MetricsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.env = EnvironmentStub(default_data=True,
+                                   enable=['trac.*', 'trachours.*'])
+        self.env.path = tempfile.mkdtemp()
+        setup = SetupTracHours(self.env)
+        with self.env.db_transaction as db:
+            setup.upgrade_environment(db)
+        self.hours_thp = TracHoursPlugin(self.env)
+        self.metrics = TracHoursMetrics(self.env)
+        PermissionSystem(self.env).grant_permission('joe',
+                                                    'HOURS_METRICS_VIEW')
+
+    def tearDown(self):
+        self.env.reset_db()
+        revert_trachours_schema_init(self.env)
+        shutil.rmtree(self.env.path)
+
+    def _get(self, authname='joe'):
+        req = MockRequest(self.env, authname=authname,
+                          path_info='/hours/metrics')
+        self.assertTrue(self.metrics.match_request(req))
+        self.assertRaises(RequestDone, self.metrics.process_request, req)
+        return req.response_sent.getvalue()
+
+    def _sample(self, output, line):
+        for sample in output.splitlines():
+            if sample.startswith(line + ' '):
+                return float(sample.split()[-1])
+
+    def test_format(self):
+        counter = metrics.Counter('test_total', 'Test counter.', 'name')
+        histogram = metrics.Histogram('test_seconds', 'Test histogram.')
+        try:
+            counter.inc(name='a"b')
+            counter.inc(2, name='a"b')
+            histogram.observe(0.02)
+            histogram.observe(3)
+            output = format_metrics([snapshot(), snapshot()])
+        finally:
+            del metrics._metrics[-2:]
+        self.assertIn('# TYPE test_total counter\n'
+                      'test_total{name="a\\"b"} 6\n', output)
+        self.assertIn('test_seconds_bucket{le="0.01"} 0\n'
+                      'test_seconds_bucket{le="0.025"} 2\n', output)
+        self.assertIn('test_seconds_bucket{le="+Inf"} 4\n'
+                      'test_seconds_sum 6.04\n'
+                      'test_seconds_count 4\n', output)
+
+    def test_write_paths(self):
+        line = 'trachours_entries_written_total{operation="add"}'
+        before = self._sample(self._get(), line) or 0
+        self.hours_thp.add_ticket_hours(1, 'joe', 60)
+        self.assertEqual(before + 1, self._sample(self._get(), line))
+
+    def test_requires_permission(self):
+        req = MockRequest(self.env, authname='jim',
+                          path_info='/hours/metrics')
+        self.assertRaises(PermissionError, self.metrics.process_request, req)
+
+    def test_post_process_request(self):
+        req = MockRequest(self.env, path_info='/hours')
+        self.assertEqual(('hours_timeline.html', {}, None, 'xhtml'),
+                         self.metrics.post_process_request(
+                             req, 'hours_timeline.html', {}, None, 'xhtml'))
+
+    def test_shared_metrics_dir(self):
+        metrics_dir = os.path.join(self.env.path, 'metrics')
+        self.env.config.set('trachours', 'metrics_dir', metrics_dir)
+        line = 'trachours_entries_written_total{operation="add"}'
+        own = self._sample(self._get(), line) or 0
+        # the parent process is running, the exited child is not, and
+        # the process of the other host is not checked
+        child = subprocess.Popen([sys.executable, '-c', ''])
+        child.wait()
+        host = socket.gethostname()
+        files = [('%s-%d-1.json' % (host, os.getppid()), 5),
+                 ('%s-%d-1.json' % (host, child.pid), 7),
+                 ('other-host-%d-1.json' % child.pid, 11)]
+        for name, count in files:
+            with open(os.path.join(metrics_dir, name), 'w') as f:
+                json.dump({'trachours_entries_written_total':
+                           [[['add'], count]]}, f)
+        self.assertEqual(own + 23, self._sample(self._get(), line))
+        self.assertEqual([True, False, True],
+                         [os.path.exists(os.path.join(metrics_dir, name))
+                          for name, count in files])
+        # the counters of the exited process are kept
+        self.assertEqual(own + 23, self._sample(self._get(), line))
+        with open(os.path.join(metrics_dir, 'aggregate.json')) as f:
+            self.assertEqual({'trachours_entries_written_total':
+                              [[['add'], 7]]},
+                             dict((name, samples) for name, samples
+                                  in json.load(f).iteritems() if samples))
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(MetricsTestCase, 'test'))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
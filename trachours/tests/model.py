@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+import unittest
+
+from trachours.model import TimeRecord
+
+
+class TimeRecordTestCase(unittest.TestCase):
+    def setUp(self):
+        self.record = TimeRecord(7, 3, 1000, 'joe', 'jim', 900, 3600,
+                                 'comment')
+
+    def test_columns(self):
+        record = self.record
+        self.assertEqual(7, record['id'])
+        self.assertEqual('joe', record.worker)
+        self.assertEqual('jim', record['submitter'])
+        self.assertIn('comments', record)
+        self.assertNotIn('summary', record)
+        self.assertRaises(KeyError, lambda: record['summary'])
+        self.assertRaises(AttributeError, lambda: record.summary)
+        self.assertEqual('none', record.get('summary', 'none'))
+        self.assertRaises(AttributeError, setattr, record, 'summary', 'x')
+
+    def test_ticket_row(self):
+        row = {'id': 3, 'summary': 'ticket summary', 'priority_value': 2}
+        record = self.record
+        record.row = row
+        self.assertEqual(3, record['id'])
+        self.assertEqual(7, record.id)
+        self.assertEqual('ticket summary', record['summary'])
+        self.assertEqual(2, record.priority_value)
+        self.assertIn('summary', record)
+        self.assertNotIn('added', record)
+        self.assertEqual(None, record.get('estimatedhours'))
+        record['seconds_worked'] = '1.0'
+        self.assertEqual('1.0', record.seconds_worked)
+        self.assertRaises(KeyError, record.__setitem__, 'summary', 'changed')
+        self.assertEqual('ticket summary', row['summary'])
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TimeRecordTestCase, 'test'))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
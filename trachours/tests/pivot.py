@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+import json
+import shutil
+import tempfile
+import unittest
+from datetime import date, datetime
+
+from trac.core import TracError
+from trac.perm import PermissionSystem
+from trac.test import EnvironmentStub, MockRequest
+from trac.ticket.model import Ticket
+from trac.util.datefmt import to_timestamp, utc
+from trac.web.api import RequestDone
+
+from trachours import pivot
+from trachours.db import SetupTracHours
+from trachours.hours import TracHoursPlugin
+from trachours.pivot import TracHoursPivot
+from trachours.utils import period_buckets
+
+from trachours.tests import revert_trachours_schema_init
+
+
+class PivotTestCase(unittest.TestCase):
+    def setUp(self):
+        self.env = EnvironmentStub(default_data=True,
+                                   enable=['trac.*', 'trachours.*'])
+        self.env.path = tempfile.mkdtemp()
+        self.env.config.set('ticket-custom', 'customer', 'text')
+        setup = SetupTracHours(self.env)
+        with self.env.db_transaction as db:
+            setup.upgrade_environment(db)
+        PermissionSystem(self.env).grant_permission('joe',
+                                                    'TICKET_VIEW_HOURS')
+        self.pivot = TracHoursPivot(self.env)
+        self.tickets = []
+        for component, customer in (('component1', 'acme'),
+                                    ('component2', None)):
+            ticket = Ticket(self.env)
+            ticket['summary'] = 'ticket summary'
+            ticket['component'] = component
+            if customer:
+                ticket['customer'] = customer
+            ticket.insert()
+            self.tickets.append(ticket.id)
+        self.add_hours(self.tickets[0], 'joe', datetime(2018, 1, 1, 9), 3600)
+        self.add_hours(self.tickets[0], 'jim', datetime(2018, 1, 9, 9), 1800)
+        self.add_hours(self.tickets[1], 'joe', datetime(2018, 1, 10, 23),
+                       7200)
+        self.add_hours(self.tickets[1], 'joe', datetime(2018, 2, 1, 9), 60)
+
+    def tearDown(self):
+        self.env.reset_db()
+        revert_trachours_schema_init(self.env)
+        shutil.rmtree(self.env.path)
+
+    def add_hours(self, ticket, worker, started, seconds):
+        started = to_timestamp(started.replace(tzinfo=utc))
+        self.env.db_transaction("""
+            INSERT INTO ticket_time (ticket, time_submitted, worker,
+              submitter, time_started, seconds_worked, comments)
+            VALUES (%s, %s, %s, %s, %s, %s, '')
+            """, (ticket, started, worker, worker, started, seconds))
+
+    def _pivot(self, **args):
+        args.setdefault('from_date', '01/01/18')
+        args.setdefault('to_date', '01/31/18')
+        req = MockRequest(self.env, authname='joe', path_info='/hours/pivot',
+                          args=args, tz=utc)
+        self.assertTrue(self.pivot.match_request(req))
+        if args.get('format'):
+            self.assertRaises(RequestDone, self.pivot.process_request, req)
+            return req.response_sent.getvalue()
+        return self.pivot.process_request(req)[1]
+
+    def test_worker_by_week(self):
+        data = self._pivot()
+        self.assertEqual(['2018-W01', '2018-W02', '2018-W03', '2018-W04',
+                          '2018-W05'], data['columns'])
+        self.assertEqual([('jim', [0, 1800, 0, 0, 0]),
+                          ('joe', [3600, 7200, 0, 0, 60])], data['rows'])
+        self.assertEqual([3600, 9000, 0, 0, 60], data['totals'])
+        self.assertEqual(12660, data['total'])
+
+    def test_ticket_field_by_month(self):
+        data = self._pivot(row='component', period='month',
+                           to_date='02/28/18')
+        self.assertEqual(['2018-01', '2018-02'], data['columns'])
+        self.assertEqual([('component1', [5400, 0]),
+                          ('component2', [7200, 60])], data['rows'])
+
+    def test_custom_field(self):
+        data = self._pivot(row='customer', period='year')
+        # the whole year is shown
+        self.assertEqual([('', [7260]), ('acme', [5400])], data['rows'])
+
+    def test_timezone(self):
+        from trac.util.datefmt import timezone
+        req = MockRequest(self.env, authname='joe', path_info='/hours/pivot',
+                          args={'period': 'day', 'from_date': '01/10/18',
+                                'to_date': '01/11/18'},
+                          tz=timezone('Asia/Tokyo'))
+        data = self.pivot.process_request(req)[1]
+        self.assertEqual([('joe', [0, 7200])], data['rows'])
+
+    def test_invalid_dimensions(self):
+        self.assertRaises(TracError, self._pivot, row='description')
+        self.assertRaises(TracError, self._pivot, period='quarter')
+        self.assertRaises(TracError, self._pivot, period='day',
+                          from_date='01/01/16')
+
+    def test_csv(self):
+        lines = self._pivot(row='component', period='month',
+                            format='csv').splitlines()
+        self.assertEqual(['Component,2018-01,Total',
+                          'component1,1.50,1.50',
+                          'component2,2.00,2.00',
+                          'Total,3.50,3.50'], lines)
+
+    def test_csv_unicode(self):
+        ticket = Ticket(self.env, self.tickets[1])
+        ticket['customer'] = u'caf\xe9'
+        ticket.save_changes('joe')
+        # a translation of the total
+        gettext = pivot._
+        pivot._ = lambda msg, **kwargs: \
+            u'Tot\xe1l' if msg == 'Total' else gettext(msg, **kwargs)
+        try:
+            lines = self._pivot(row='customer', period='year',
+                                format='csv').splitlines()
+        finally:
+            pivot._ = gettext
+        self.assertEqual(['Customer,2018,Tot\xc3\xa1l',
+                          'acme,1.50,1.50',
+                          'caf\xc3\xa9,2.02,2.02',
+                          'Tot\xc3\xa1l,3.52,3.52'], lines)
+
+    def test_json(self):
+        result = json.loads(self._pivot(period='month', format='json'))
+        self.assertEqual([{'label': '2018-01', 'start': 1514764800}],
+                         result['columns'])
+        self.assertEqual([{'value': 'jim', 'seconds': [1800],
+                           'total': 1800},
+                          {'value': 'joe', 'seconds': [10800],
+                           'total': 10800}], result['rows'])
+
+    def test_cache(self):
+        data = self._pivot()
+        self.add_hours(self.tickets[0], 'joe', datetime(2018, 1, 2), 60)
+        self.assertEqual(data['rows'], self._pivot()['rows'])
+        self.env.config.set('trachours', 'pivot_cache_ttl', '0')
+        self.assertEqual(('joe', [3660, 7200, 0, 0, 60]),
+                         self._pivot()['rows'][1])
+
+    def test_cache_invalidation(self):
+        self._pivot()
+        TracHoursPlugin(self.env).add_ticket_hours(
+            self.tickets[0], 'jim', 60,
+            time_started=datetime(2018, 1, 20, 12))
+        self.assertEqual(('jim', [0, 1800, 60, 0, 0]),
+                         self._pivot()['rows'][0])
+
+    def test_period_buckets(self):
+        buckets, end = period_buckets(date(2017, 12, 31), date(2018, 1, 1),
+                                      'week', utc)
+        self.assertEqual([('2017-W52', 1514160000), ('2018-W01', 1514764800)],
+                         buckets)
+        self.assertEqual(1514764800 + 7 * 86400, end)
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(PivotTestCase, 'test'))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
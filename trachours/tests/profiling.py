@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from trac.perm import PermissionSystem
+from trac.test import EnvironmentStub, MockRequest
+from trac.ticket.model import Ticket
+from trac.web.api import RequestDone
+
+from trachours.db import SetupTracHours
+from trachours.hours import TracHoursPlugin
+from trachours.profiling import (
+    AllocationProfile, ProfiledHandler, TracHoursProfiler, tracemalloc
+)
+
+from trachours.tests import revert_trachours_schema_init
+
+
+class ProfilingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.env = EnvironmentStub(default_data=True,
+                                   enable=['trac.*', 'trachours.*'])
+        self.env.path = tempfile.mkdtemp()
+        setup = SetupTracHours(self.env)
+        with self.env.db_transaction as db:
+            setup.upgrade_environment(db)
+        self.env.config.set('trachours', 'profiling', 'enabled')
+        self.hours_thp = TracHoursPlugin(self.env)
+        self.profiler = TracHoursProfiler(self.env)
+        TracHoursProfiler._last_capture = 0
+        PermissionSystem(self.env).grant_permission('admin', 'TRAC_ADMIN')
+        ticket = Ticket(self.env)
+        ticket['summary'] = 'ticket summary'
+        ticket.insert()
+        self.hours_thp.add_ticket_hours(ticket.id, 'joe', 3600)
+
+    def tearDown(self):
+        self.env.reset_db()
+        revert_trachours_schema_init(self.env)
+        shutil.rmtree(self.env.path)
+
+    def _handler(self, authname='admin', **args):
+        req = MockRequest(self.env, authname=authname, path_info='/hours',
+                          args=args)
+        return req, self.profiler.pre_process_request(req, self.hours_thp)
+
+    def test_profile(self):
+        self.env.config.set('trachours', 'profiling_limit', '10000')
+        req, handler = self._handler(hours_profile='1',
+                                     hours_profile_sort='name')
+        self.assertIsInstance(handler, ProfiledHandler)
+        self.assertRaises(RequestDone, handler.process_request, req)
+        output = req.response_sent.getvalue()
+        self.assertIn('function calls', output)
+        self.assertIn('Ordered by: function name', output)
+        self.assertIn('(process_request)', output)
+
+    def test_save(self):
+        req, handler = self._handler(hours_profile='save')
+        self.assertRaises(RequestDone, handler.process_request, req)
+        self.assertIn('<html', req.response_sent.getvalue())
+        files = os.listdir(self.env.log_dir)
+        self.assertEqual(1, len(files))
+        self.assertTrue(files[0].startswith('hours-TracHoursPlugin-'))
+
+    def test_memory(self):
+        req, handler = self._handler(hours_profile='memory')
+        self.assertRaises(RequestDone, handler.process_request, req)
+        phases = [line.split(':')[0]
+                  for line in req.response_sent.getvalue().splitlines()
+                  if not line.startswith(' ')]
+        self.assertEqual(['request', 'fetch', 'merge', 'group', 'render'],
+                         phases)
+
+    def test_allocation_profile(self):
+        profile = AllocationProfile(top=3)
+        profile.start('alloc')
+        records = [{'id': i} for i in xrange(10000)]
+        profile.mark('free')
+        del records[:]
+        profile.stop()
+        self.assertEqual(['alloc', 'free'],
+                         [phase[0] for phase in profile.phases])
+        name, size, peak, sites = profile.phases[0]
+        if tracemalloc:
+            self.assertTrue(size > 10000 * 100)
+            self.assertTrue(sites[0][2] >= 10000)
+            self.assertTrue(profile.phases[1][1] < 0)
+        else:
+            self.assertEqual((None, []), (size, sites))
+            self.assertTrue(peak >= 0)
+        self.assertIn('alloc: ', profile.format())
+
+    def test_not_profiled(self):
+        self.assertIs(self.hours_thp, self._handler()[1])
+        self.assertIs(self.hours_thp,
+                      self._handler('joe', hours_profile='1')[1])
+        self.env.config.set('trachours', 'profiling', 'disabled')
+        self.assertIs(self.hours_thp,
+                      self._handler(hours_profile='1')[1])
+
+    def test_rate_limit(self):
+        self.assertIsInstance(self._handler(hours_profile='1')[1],
+                              ProfiledHandler)
+        self.assertIs(self.hours_thp, self._handler(hours_profile='1')[1])
+        self.env.config.set('trachours', 'profiling_interval', '0')
+        self.assertIsInstance(self._handler(hours_profile='1')[1],
+                              ProfiledHandler)
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(ProfilingTestCase, 'test'))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
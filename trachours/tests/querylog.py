@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+import shutil
+import tempfile
+import unittest
+
+from trac.test import EnvironmentStub, Mock, MockRequest
+from trac.ticket.model import Ticket
+from trac.web.api import RequestDone
+
+from trachours.admin import TracHoursAdmin
+from trachours.archive import TracHoursArchive
+from trachours.db import SetupTracHours
+from trachours.hours import TracHoursPlugin
+from trachours.querylog import (
+    TracHoursQueryLog, fingerprint, start_log, stop_log
+)
+
+from trachours.tests import revert_trachours_schema_init
+
+
+class QueryLogTestCase(unittest.TestCase):
+    def setUp(self):
+        self.env = EnvironmentStub(default_data=True,
+                                   enable=['trac.*', 'trachours.*'])
+        self.env.path = tempfile.mkdtemp()
+        setup = SetupTracHours(self.env)
+        with self.env.db_transaction as db:
+            setup.upgrade_environment(db)
+        self.hours_thp = TracHoursPlugin(self.env)
+        # read once by the process
+        self.hours_thp.archived_before
+        self.querylog = TracHoursQueryLog(self.env)
+        self.warnings = []
+        self.querylog.log = Mock(
+            warning=lambda msg, *args: self.warnings.append(msg % args))
+
+    def tearDown(self):
+        stop_log()
+        self.env.reset_db()
+        revert_trachours_schema_init(self.env)
+        shutil.rmtree(self.env.path)
+
+    def test_fingerprint(self):
+        self.assertEqual("SELECT * FROM ticket_time WHERE ticket IN (...) "
+                         "AND worker=? AND comments=%s",
+                         fingerprint("""
+            SELECT * FROM ticket_time
+            WHERE ticket IN (1, 23,4) AND worker='it''s' AND comments=%s
+            """))
+
+    def test_records_plugin_queries(self):
+        log = start_log('test')
+        for tid in range(3):
+            self.hours_thp.get_total_hours(tid + 1)
+        self.assertEqual(log, stop_log())
+
+        statements = log.statements()
+        self.assertEqual(1, len(statements))
+        sql, count, duration, rows, callers = statements[0]
+        self.assertEqual("SELECT SUM(seconds_worked) FROM ticket_time "
+                         "WHERE ticket=%s", sql)
+        self.assertEqual(3, count)
+        self.assertEqual(['hours.py'],
+                         [site.split(':')[0] for site in callers])
+
+    def test_no_log_outside_requests(self):
+        self.hours_thp.get_total_hours(1)
+        self.assertIsNone(stop_log())
+
+    def test_post_process_request(self):
+        req = MockRequest(self.env, path_info='/roadmap')
+        self.assertEqual(('roadmap.html', {}, None, 'xhtml'),
+                         self.querylog.post_process_request(
+                             req, 'roadmap.html', {}, None, 'xhtml'))
+        self.assertEqual((None, None, None, None),
+                         self.querylog.post_process_request(
+                             req, None, None, None))
+
+    def test_report_repeated_statements(self):
+        self.env.config.set('trachours', 'query_log', 'enabled')
+        self.env.config.set('trachours', 'query_log_repeated', 3)
+        req = MockRequest(self.env, path_info='/roadmap')
+        self.querylog.pre_process_request(req, self.hours_thp)
+        for tid in range(2):
+            self.hours_thp.get_total_hours(tid + 1)
+        self.querylog.post_process_request(req, None, None, None)
+        self.assertEqual([], self.warnings)
+
+        self.querylog.pre_process_request(req, self.hours_thp)
+        for tid in range(3):
+            self.hours_thp.get_total_hours(tid + 1)
+        self.querylog.post_process_request(req, None, None, None)
+        self.assertEqual("TracHoursPlugin /roadmap: 3 queries",
+                         self.warnings[0].split(' in ')[0])
+        self.assertIn("repeated 3 times from hours.py:", self.warnings[-1])
+
+    def test_report_sent_requests(self):
+        self.env.config.set('trachours', 'query_log', 'enabled')
+        self.env.config.set('trachours', 'query_log_repeated', 2)
+        req = MockRequest(self.env, path_info='/hours')
+        self.querylog.pre_process_request(req, self.hours_thp)
+        for tid in range(2):
+            self.hours_thp.get_total_hours(tid + 1)
+        self.assertRaises(RequestDone, req.send, 'hours', 'text/plain')
+        self.assertEqual("TracHoursPlugin /hours: 2 queries",
+                         self.warnings[0].split(' in ')[0])
+        self.assertIsNone(stop_log())
+
+    def test_admin_queries(self):
+        ticket = Ticket(self.env)
+        ticket['summary'] = 'ticket summary'
+        ticket.insert()
+        log = start_log('test')
+        TracHoursAdmin(self.env).recalc_tickets([ticket.id])
+        TracHoursArchive(self.env).archive(0)
+        stop_log()
+        self.assertEqual(set(['admin.py', 'archive.py', 'hours.py']),
+                         set(site.split(':')[0]
+                             for statement in log.statements()
+                             for site in statement[4]))
+        self.assertTrue(any(sql.startswith('INSERT INTO ticket_custom')
+                            for sql, count, duration, rows, callers
+                            in log.statements()))
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(QueryLogTestCase, 'test'))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+import shutil
+import tempfile
+import unittest
+
+from trac.perm import PermissionSystem
+from trac.test import EnvironmentStub, MockRequest
+from trac.ticket.model import Ticket
+
+from trachours.db import SetupTracHours
+from trachours.hours import TracHoursPlugin
+from trachours.search import TracHoursSearch
+
+from trachours.tests import revert_trachours_schema_init
+
+
+class HoursSearchTestCase(unittest.TestCase):
+    def setUp(self):
+        self.env = EnvironmentStub(default_data=True,
+                                   enable=['trac.*', 'trachours.*'])
+        self.env.path = tempfile.mkdtemp()
+        setup = SetupTracHours(self.env)
+        with self.env.db_transaction as db:
+            setup.upgrade_environment(db)
+        PermissionSystem(self.env).grant_permission('joe',
+                                                    'TICKET_VIEW_HOURS')
+        self.hours_thp = TracHoursPlugin(self.env)
+        self.search = TracHoursSearch(self.env)
+        ticket = Ticket(self.env)
+        ticket['summary'] = 'ticket summary'
+        ticket.insert()
+        self.ticket = ticket.id
+        self.hours_thp.add_many_ticket_hours(self.ticket, 'joe', [
+            (3600, 'investigated the outage of the mail server'),
+            (1800, 'code review'),
+            (900, 'outage: outage report'),
+        ])
+
+    def tearDown(self):
+        self.env.reset_db()
+        revert_trachours_schema_init(self.env)
+        shutil.rmtree(self.env.path)
+
+    def _search(self, *terms):
+        req = MockRequest(self.env, authname='joe')
+        return list(self.search.get_search_results(req, list(terms),
+                                                   ['hours']))
+
+    def _ids(self, *terms):
+        return [row[0] for row in self.search.search(list(terms))]
+
+    def test_filters(self):
+        req = MockRequest(self.env, authname='joe')
+        self.assertEqual([('hours', 'Hours')],
+                         list(self.search.get_search_filters(req)))
+        req = MockRequest(self.env, authname='anonymous')
+        self.assertEqual([], list(self.search.get_search_filters(req)))
+        self.assertEqual([], list(self.search.get_search_results(
+            req, ['outage'], ['hours'])))
+
+    def test_fts(self):
+        self.assertEqual('fts5', self.search.get_index())
+        # ranked by relevance
+        self.assertEqual([3, 1], self._ids('outage'))
+        self.assertEqual([1], self._ids('mail', 'outa'))
+        results = self._search('review')
+        self.assertEqual(1, len(results))
+        href, title, date, author, excerpt = results[0]
+        self.assertEqual('/trac.cgi/hours/%d' % self.ticket, href)
+        self.assertEqual('00:30 hours on #1: ticket summary', title)
+        self.assertEqual('joe', author)
+
+    def test_sync(self):
+        self.hours_thp.update_time_records('joe',
+                                           updates=[(2, 1800, 'outage')],
+                                           deletes=[3])
+        self.assertEqual([1, 2], sorted(self._ids('outage')))
+        self.assertEqual([], self._ids('review'))
+        self.hours_thp.delete_ticket_hours(self.ticket)
+        self.assertEqual([], self._ids('outage'))
+
+    def test_like(self):
+        with self.env.db_transaction as db:
+            for operation in ('insert', 'delete', 'update'):
+                db("DROP TRIGGER ticket_time_fts_%s" % operation)
+            db("DROP TABLE ticket_time_fts")
+        self.search._index = None
+        self.assertEqual('', self.search.get_index())
+        self.assertEqual([3, 1], self._ids('outage'))
+        self.assertEqual([1], self._ids('mail', 'outa'))
+
+
+    def _set_module(self, old, new):
+        with self.env.db_transaction as db:
+            cursor = db.cursor()
+            cursor.execute("PRAGMA schema_version")
+            version = cursor.fetchone()[0]
+            cursor.execute("PRAGMA writable_schema=ON")
+            cursor.execute("""
+                UPDATE sqlite_master SET sql=replace(sql, %s, %s)
+                WHERE name='ticket_time_fts'""", (old, new))
+            cursor.execute("PRAGMA schema_version=%d" % (version + 1))
+            cursor.execute("PRAGMA writable_schema=OFF")
+
+    def test_missing_module(self):
+        # an environment indexed by a SQLite providing another module
+        self._set_module('fts5', 'fts0')
+        try:
+            self.assertRaises(self.env.db_exc.OperationalError,
+                              self.hours_thp.add_ticket_hours, self.ticket,
+                              'joe', 60, comments='outage')
+            self.search._index = None
+            self.assertEqual('', self.search.get_index())
+            self.hours_thp.add_ticket_hours(self.ticket, 'joe', 60,
+                                            comments='outage')
+            self.assertEqual([4, 3, 1], self._ids('outage'))
+        finally:
+            self._set_module('fts0', 'fts5')
+        # the stale index is not used once the module is available again
+        self.search._index = None
+        self.assertEqual('', self.search.get_index())
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(HoursSearchTestCase, 'test'))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
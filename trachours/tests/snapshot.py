@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+from datetime import datetime
+
+from trac.perm import PermissionSystem
+from trac.test import EnvironmentStub, MockRequest
+from trac.ticket.model import Ticket
+from trac.util.datefmt import to_timestamp, utc
+
+from trachours.db import SetupTracHours
+from trachours.hours import TracHoursPlugin
+from trachours.snapshot import TracHoursSnapshot
+from trachours.web_ui import TracUserHours
+
+from trachours.tests import revert_trachours_schema_init
+
+
+class SnapshotTestCase(unittest.TestCase):
+    def setUp(self):
+        self.env = EnvironmentStub(default_data=True,
+                                   enable=['trac.*', 'trachours.*'])
+        self.env.path = tempfile.mkdtemp()
+        setup = SetupTracHours(self.env)
+        with self.env.db_transaction as db:
+            setup.upgrade_environment(db)
+        self.hours_thp = TracHoursPlugin(self.env)
+        self.snapshot = TracHoursSnapshot(self.env)
+        ticket = Ticket(self.env)
+        ticket['summary'] = 'ticket summary'
+        ticket.insert()
+        self.ticket = ticket.id
+        self.add_hours('joe', datetime(2018, 1, 1, 9), 3600)
+        self.add_hours('jim', datetime(2018, 1, 2, 9), 1800)
+        self.add_hours('joe', datetime(2018, 2, 1, 9), 900)
+
+    def tearDown(self):
+        self.env.reset_db()
+        revert_trachours_schema_init(self.env)
+        shutil.rmtree(self.env.path)
+
+    def add_hours(self, worker, started, seconds):
+        self.hours_thp.add_ticket_hours(self.ticket, worker, seconds,
+                                        time_started=started.replace(
+                                            tzinfo=utc))
+
+    def _sums(self, start=None, end=None):
+        reader = self.snapshot.open()
+        with reader:
+            return reader.sum_seconds(start, end)
+
+    def _path(self):
+        with open(os.path.join(self.snapshot.directory, 'CURRENT')) as f:
+            return os.path.join(self.snapshot.directory, f.read().strip())
+
+    def test_build(self):
+        self.assertEqual(None, self.snapshot.open())
+        self.assertEqual(3, self.snapshot.build())
+        reader = self.snapshot.open()
+        with reader:
+            self.assertEqual(3, reader.count)
+            self.assertEqual(['joe', 'jim'], reader.workers)
+            self.assertEqual([1, 2, 3], list(reader.column('id')))
+            self.assertEqual([0, 1, 0], list(reader.column('worker')))
+        self.assertEqual({'joe': 4500, 'jim': 1800}, self._sums())
+        self.assertEqual({'joe': 3600, 'jim': 1800}, self._sums(
+            to_timestamp(datetime(2018, 1, 1, tzinfo=utc)),
+            to_timestamp(datetime(2018, 2, 1, tzinfo=utc))))
+
+    def test_refresh(self):
+        self.snapshot.build()
+        self.add_hours('jack', datetime(2018, 1, 3, 9), 600)
+        self.hours_thp.update_time_records('joe', updates=[(1, 7200, None)])
+        self.assertEqual({'joe': 8100, 'jim': 1800, 'jack': 600},
+                         self._sums())
+        # SQLite reuses the id of the deleted record
+        self.hours_thp.update_time_records('jack', deletes=[4])
+        self.add_hours('jill', datetime(2018, 1, 4, 9), 300)
+        self.assertEqual({'joe': 8100, 'jim': 1800, 'jill': 300},
+                         self._sums())
+        reader = self.snapshot.open()
+        with reader:
+            self.assertEqual(4, reader.count)
+        self.hours_thp.delete_ticket_hours(self.ticket)
+        self.assertEqual({}, self._sums())
+
+    def test_update_on_write(self):
+        self.snapshot.build()
+        self.env.config.set('trachours', 'snapshot', 'enabled')
+        self.add_hours('jim', datetime(2018, 1, 3, 9), 600)
+        reader = self.snapshot.open()
+        with reader:
+            self.assertEqual(4, reader.count)
+
+    def test_pruned(self):
+        self.snapshot.build()
+        self.add_hours('jim', datetime(2018, 1, 3, 9), 600)
+        self.env.db_transaction("UPDATE ticket_time_changes SET time=0")
+        self.add_hours('jim', datetime(2018, 1, 4, 9), 60)
+        self.hours_thp.prune_changes()
+        self.assertEqual({'joe': 4500, 'jim': 2460}, self._sums())
+
+    def test_failed_update(self):
+        self.snapshot.build()
+        # the rows of an update which failed before its meta was written
+        for name in ('id', 'ticket', 'worker', 'time_started',
+                     'seconds_worked'):
+            with open(os.path.join(self._path(), name), 'ab') as f:
+                f.write('\xff' * 24)
+        self.add_hours('jack', datetime(2018, 1, 3, 9), 600)
+        reader = self.snapshot.open()
+        with reader:
+            self.assertEqual([1, 2, 3, 4], list(reader.column('id')))
+        self.assertEqual({'joe': 4500, 'jim': 1800, 'jack': 600},
+                         self._sums())
+
+    def test_other_format(self):
+        self.snapshot.build()
+        path = self._path()
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        meta['byteorder'] = 'big' if sys.byteorder == 'little' else 'little'
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        self.assertEqual({'joe': 4500, 'jim': 1800}, self._sums())
+        self.assertNotEqual(path, self._path())
+        with open(os.path.join(self._path(), 'meta.json')) as f:
+            self.assertEqual(sys.byteorder, json.load(f)['byteorder'])
+
+    def test_late_change(self):
+        self.env.db_transaction("UPDATE ticket_time_changes SET time=0")
+        # the change 4 is logged by a transaction still open
+        self.env.db_transaction("""
+            INSERT INTO ticket_time_changes (seq, operation, entry, ticket,
+              worker, old_seconds, new_seconds, time)
+            VALUES (5, 'update', 2, %s, 'jim', 1800, 1800, %s)
+            """, (self.ticket, int(time.time())))
+        self.snapshot.build()
+        self.env.db_transaction("""
+            UPDATE ticket_time SET seconds_worked=60 WHERE id=1""")
+        self.env.db_transaction("""
+            INSERT INTO ticket_time_changes (seq, operation, entry, ticket,
+              worker, old_seconds, new_seconds, time)
+            VALUES (4, 'update', 1, %s, 'joe', 3600, 60, %s)
+            """, (self.ticket, int(time.time())))
+        self.assertEqual({'joe': 960, 'jim': 1800}, self._sums())
+
+    def test_users(self):
+        PermissionSystem(self.env).grant_permission('joe',
+                                                    'TICKET_VIEW_HOURS')
+        # a worker without hours in the range is listed by both paths
+        self.add_hours('jack', datetime(2018, 1, 3, 9), 0)
+        args = {'from_date': '01/01/18', 'to_date': '01/31/18'}
+
+        def users():
+            req = MockRequest(self.env, authname='joe',
+                              path_info='/hours/user', args=args, tz=utc)
+            return TracUserHours(self.env).process_request(req)[1]
+
+        data = users()
+        self.snapshot.build()
+        self.env.config.set('trachours', 'snapshot', 'enabled')
+        self.assertEqual(data['worker_hours'], users()['worker_hours'])
+        self.assertEqual([('jack', 0.0), ('jim', 0.5), ('joe', 1.0)],
+                         data['worker_hours'])
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(SnapshotTestCase, 'test'))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
@@ -50,6 +50,33 @@ class TracHoursByCommentTestCase(unittest.TestCase):
         hours = self.hours_thp.get_ticket_hours(ticket.id)
         self.assertEqual([], hours)
 
+    def test_munge_comment(self):
+        ticket = Ticket(self.env)
+        ticket['summary'] = 'ticket summary'
+        ticket.insert()
+        comment = self.hours_thbc.munge_comment(
+            "1.5 hours, 0:30 hours and 1 hour. 12:75 hours", ticket)
+        self.assertEqual("[/hours/1 1.5 hours], [/hours/1 0:30 hours] and "
+                         "[/hours/1 1 hour]. 12:75 hours", comment)
+        self.assertEqual(comment,
+                         self.hours_thbc.munge_comment(comment, ticket))
+        self.assertEqual("no time", self.hours_thbc.munge_comment("no time",
+                                                                  ticket))
+
+    def test_add_hours_by_comment(self):
+        ticket = Ticket(self.env)
+        ticket['summary'] = 'ticket summary'
+        ticket.insert()
+        self.hours_thbc.add_hours_by_comment(
+            "[/hours/1 2 hours] then [/hours/1 0:15 hours]", ticket.id, 'joe')
+        hours = self.hours_thp.get_ticket_hours(ticket.id)
+        self.assertEqual([7200, 900],
+                         sorted([h['seconds_worked'] for h in hours],
+                                reverse=True))
+        self.assertEqual(["2 hours then 0:15 hours"] * 2,
+                         [h['comments'] for h in hours])
+        self.assertEqual(2.25, float(Ticket(self.env, ticket.id)['totalhours']))
+
 
 def test_suite():
     suite = unittest.TestSuite()
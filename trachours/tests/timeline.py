@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+
+from trac.perm import PermissionSystem
+from trac.test import EnvironmentStub, MockRequest
+from trac.ticket.model import Ticket
+from trac.util.datefmt import FixedOffset, to_timestamp, utc
+from trac.web.chrome import web_context
+
+from trachours.db import SetupTracHours
+from trachours.timeline import TracHoursTimeline
+
+from trachours.tests import revert_trachours_schema_init
+
+
+class HoursTimelineTestCase(unittest.TestCase):
+    def setUp(self):
+        self.env = EnvironmentStub(default_data=True,
+                                   enable=['trac.*', 'trachours.*'])
+        self.env.path = tempfile.mkdtemp()
+        setup = SetupTracHours(self.env)
+        with self.env.db_transaction as db:
+            setup.upgrade_environment(db)
+        PermissionSystem(self.env).grant_permission('joe',
+                                                    'TICKET_VIEW_HOURS')
+        self.timeline = TracHoursTimeline(self.env)
+        self.tickets = []
+        for summary in ('first', 'second'):
+            ticket = Ticket(self.env)
+            ticket['summary'] = summary
+            ticket.insert()
+            self.tickets.append(ticket.id)
+        self.add_hours('joe', 1, datetime(2018, 1, 1, 9), 3600)
+        self.add_hours('joe', 1, datetime(2018, 1, 1, 22), 1800)
+        self.add_hours('joe', 2, datetime(2018, 1, 1, 10), 900)
+        self.add_hours('jim', 1, datetime(2018, 1, 1, 11), 600)
+        self.add_hours('joe', 1, datetime(2018, 1, 2, 9), 300)
+        self.add_hours('joe', 1, datetime(2018, 1, 5, 9), 300)
+
+    def tearDown(self):
+        self.env.reset_db()
+        revert_trachours_schema_init(self.env)
+        shutil.rmtree(self.env.path)
+
+    def add_hours(self, worker, ticket, submitted, seconds):
+        submitted = to_timestamp(submitted.replace(tzinfo=utc))
+        self.env.db_transaction("""
+            INSERT INTO ticket_time (ticket, time_submitted, worker,
+              submitter, time_started, seconds_worked, comments)
+            VALUES (%s, %s, %s, %s, %s, %s, '')
+            """, (ticket, submitted, worker, worker, submitted, seconds))
+
+    def _events(self, tz=utc, authname='joe'):
+        req = MockRequest(self.env, authname=authname, tz=tz)
+        events = self.timeline.get_timeline_events(
+            req, datetime(2018, 1, 1, tzinfo=utc),
+            datetime(2018, 1, 3, tzinfo=utc), ['hours'])
+        return req, sorted((event[1], event[2], event[3][0].id,
+                            event[3][1], event[3][2]) for event in events)
+
+    def test_events(self):
+        req, events = self._events()
+        self.assertEqual([
+            (datetime(2018, 1, 1, 10, tzinfo=utc), 'joe', 2, 900, 1),
+            (datetime(2018, 1, 1, 11, tzinfo=utc), 'jim', 1, 600, 1),
+            (datetime(2018, 1, 1, 22, tzinfo=utc), 'joe', 1, 5400, 2),
+            (datetime(2018, 1, 2, 9, tzinfo=utc), 'joe', 1, 300, 1),
+        ], events)
+
+    def test_timezone(self):
+        # 22:00 UTC is on the next day in UTC+3
+        req, events = self._events(tz=FixedOffset(180, 'UTC+3'))
+        self.assertEqual([
+            (datetime(2018, 1, 1, 9, tzinfo=utc), 'joe', 1, 3600, 1),
+            (datetime(2018, 1, 1, 10, tzinfo=utc), 'joe', 2, 900, 1),
+            (datetime(2018, 1, 1, 11, tzinfo=utc), 'jim', 1, 600, 1),
+            (datetime(2018, 1, 2, 9, tzinfo=utc), 'joe', 1, 2100, 2),
+        ], events)
+
+    def test_render(self):
+        req = MockRequest(self.env, authname='joe', tz=utc)
+        event = [event for event in self.timeline.get_timeline_events(
+                     req, datetime(2018, 1, 1, tzinfo=utc),
+                     datetime(2018, 1, 2, tzinfo=utc), ['hours'])
+                 if event[3][0].id == 1 and event[2] == 'joe'][0]
+        context = web_context(req)
+        self.assertEqual('/trac.cgi/hours/1', self.timeline
+                         .render_timeline_event(context, 'url', event))
+        self.assertIn('01:30 hours logged on', unicode(
+            self.timeline.render_timeline_event(context, 'title', event)))
+        self.assertEqual('2 entries', self.timeline.render_timeline_event(
+            context, 'description', event))
+
+    def test_permission(self):
+        req = MockRequest(self.env, authname='anonymous')
+        self.assertEqual([], list(self.timeline.get_timeline_filters(req)))
+        self.assertEqual([], self._events(authname='anonymous')[1])
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(HoursTimelineTestCase, 'test'))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
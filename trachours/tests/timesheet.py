@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+import shutil
+import tempfile
+import unittest
+from datetime import date, datetime
+
+from trac.perm import PermissionError, PermissionSystem
+from trac.test import EnvironmentStub, MockRequest
+from trac.ticket.model import Ticket
+from trac.util.datefmt import to_timestamp, utc
+from trac.web.api import RequestDone
+
+from trachours.archive import TracHoursArchive
+from trachours.db import SetupTracHours
+from trachours.hours import TracHoursPlugin
+from trachours.sqlhelper import get_all, get_scalar
+from trachours.timesheet import TracHoursTimesheet, parse_duration
+
+from trachours.tests import revert_trachours_schema_init
+
+
+class TimesheetTestCase(unittest.TestCase):
+    def setUp(self):
+        self.env = EnvironmentStub(default_data=True,
+                                   enable=['trac.*', 'trachours.*'])
+        self.env.path = tempfile.mkdtemp()
+        setup = SetupTracHours(self.env)
+        with self.env.db_transaction as db:
+            setup.upgrade_environment(db)
+        for action in ('TICKET_VIEW_HOURS', 'TICKET_ADD_HOURS'):
+            PermissionSystem(self.env).grant_permission('joe', action)
+        self.timesheet = TracHoursTimesheet(self.env)
+        self.tickets = []
+        for owner in ('joe', 'joe', 'jim'):
+            ticket = Ticket(self.env)
+            ticket['summary'] = 'ticket summary'
+            ticket['owner'] = owner
+            ticket.insert()
+            self.tickets.append(ticket.id)
+        # 2018 starts on a Monday
+        self.add_hours(1, datetime(2018, 1, 1, 9), 3600, 'design')
+        self.add_hours(1, datetime(2018, 1, 1, 14), 1800, 'review')
+        self.add_hours(3, datetime(2018, 1, 3, 9), 1800)
+        self.add_hours(3, datetime(2018, 1, 8, 9), 900)
+
+    def tearDown(self):
+        self.env.reset_db()
+        revert_trachours_schema_init(self.env)
+        shutil.rmtree(self.env.path)
+
+    def add_hours(self, ticket, started, seconds, comments=''):
+        TracHoursPlugin(self.env).add_ticket_hours(
+            ticket, 'joe', seconds, time_started=started.replace(tzinfo=utc),
+            comments=comments)
+
+    def _timesheet(self, method='GET', authname='joe', **args):
+        args.setdefault('week', '2018-01-03')
+        req = MockRequest(self.env, authname=authname, method=method,
+                          path_info='/hours/timesheet', args=args, tz=utc)
+        self.assertTrue(self.timesheet.match_request(req))
+        return req, self.timesheet.process_request(req)[1]
+
+    def test_parse_duration(self):
+        self.assertEqual(0, parse_duration(''))
+        self.assertEqual(5400, parse_duration('1:30'))
+        self.assertEqual(5400, parse_duration(' 1.5 '))
+        self.assertEqual(900, parse_duration('.25'))
+        self.assertRaises(ValueError, parse_duration, '1:75')
+        self.assertRaises(ValueError, parse_duration, 'one')
+
+    def test_grid(self):
+        data = self._timesheet()[1]
+        self.assertEqual(date(2018, 1, 1), data['days'][0])
+        self.assertEqual([1, 2, 3], [t for t, summary in data['tickets']])
+        self.assertEqual({(1, 0): 5400, (3, 2): 1800}, data['cells'])
+        self.assertEqual(5400, data['row_totals'][1])
+        self.assertEqual([5400, 0, 1800, 0, 0, 0, 0], data['day_totals'])
+        self.assertEqual(7200, data['total'])
+        self.assertTrue(data['can_edit'])
+        # the next week, with the open tickets of the worker
+        data = self._timesheet(week='2018-01-08')[1]
+        self.assertEqual([1, 2, 3], [t for t, summary in data['tickets']])
+        self.assertEqual({(3, 0): 900}, data['cells'])
+
+    def test_save(self):
+        self.assertRaises(RequestDone, self._timesheet, method='POST',
+                          save='Save', cell_1_0='2:00', cell_2_4='0.5',
+                          cell_3_2='', cell_3_3='')
+        # the records of a cell are merged
+        self.assertEqual([
+            (1, 1, to_timestamp(datetime(2018, 1, 1, 9, tzinfo=utc)), 7200,
+             'design; review'),
+            (4, 3, to_timestamp(datetime(2018, 1, 8, 9, tzinfo=utc)), 900,
+             ''),
+            (5, 2, to_timestamp(datetime(2018, 1, 5, 12, tzinfo=utc)), 1800,
+             ''),
+        ], get_all(self.env, """
+            SELECT id, ticket, time_started, seconds_worked, comments
+            FROM ticket_time ORDER BY id"""))
+        self.assertEqual([2.0, 0.5, 0.25],
+                         [float(Ticket(self.env, tid)['totalhours'])
+                          for tid in self.tickets])
+        self.assertEqual([('insert', 5), ('update', 1), ('delete', 2),
+                          ('delete', 3)],
+                         get_all(self.env, """
+                            SELECT operation, entry FROM ticket_time_changes
+                            WHERE seq > 4 ORDER BY seq"""))
+
+    def test_save_invalid(self):
+        req, data = self._timesheet(method='POST', save='Save',
+                                    cell_1_0='', cell_2_0='1:99')
+        self.assertEqual(1, len(req.chrome['warnings']))
+        self.assertEqual('1:99', data['values']['cell_2_0'])
+        self.assertEqual(4, get_scalar(self.env, """
+            SELECT COUNT(*) FROM ticket_time"""))
+
+    def test_save_archived(self):
+        self.env.db_transaction("UPDATE ticket_time SET time_submitted=0")
+        TracHoursArchive(self.env).archive(
+            to_timestamp(datetime(2018, 1, 2, tzinfo=utc)))
+        req = MockRequest(self.env, authname='joe', method='POST',
+                          path_info='/hours/timesheet', tz=utc,
+                          args={'week': '2018-01-03', 'save': 'Save',
+                                'cell_1_0': '2:00', 'cell_2_4': '0.5'})
+        self.assertRaises(RequestDone, self.timesheet.process_request, req)
+        self.assertEqual(1, len(req.chrome['warnings']))
+        self.assertIn('#1', unicode(req.chrome['warnings'][0]))
+        self.assertEqual(['Saved 1 changed cells'],
+                         map(unicode, req.chrome['notices']))
+        self.assertEqual([(1, 3600), (2, 1800)], get_all(self.env, """
+            SELECT id, seconds_worked FROM ticket_time_archive
+            ORDER BY id"""))
+        self.assertEqual([(3, 1800), (4, 900), (5, 1800)],
+                         get_all(self.env, """
+                            SELECT id, seconds_worked FROM ticket_time
+                            ORDER BY id"""))
+
+    def test_edit_other_worker(self):
+        self.assertRaises(PermissionError, self._timesheet, method='POST',
+                          worker='jim', save='Save', cell_3_0='1')
+        data = self._timesheet(worker='jim')[1]
+        self.assertFalse(data['can_edit'])
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TimesheetTestCase, 'test'))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
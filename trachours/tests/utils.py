@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+import unittest
+from datetime import datetime
+
+from trac.test import EnvironmentStub, MockRequest
+from trac.util.datefmt import format_date, timezone, to_timestamp, user_time
+
+from trachours.utils import HoursFormatter, format_hours
+
+
+class HoursFormatterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.env = EnvironmentStub()
+
+    def _formatter(self, tz):
+        req = MockRequest(self.env, tz=timezone(tz))
+        return req, HoursFormatter(req)
+
+    def test_date(self):
+        for tz in ('UTC', 'Europe/Paris', 'Asia/Kathmandu',
+                   'America/St_Johns'):
+            req, formatter = self._formatter(tz)
+            # around the end of the daylight saving time in Europe
+            start = to_timestamp(datetime(2026, 10, 24, tzinfo=timezone(tz)))
+            dates = set()
+            for ts in xrange(start, start + 4 * 86400, 599):
+                date = user_time(req, format_date, ts)
+                dates.add(date)
+                self.assertEqual(date, formatter.date(ts))
+                self.assertEqual(datetime.fromtimestamp(ts, req.tz).date(),
+                                 formatter.day(ts))
+            # each day is formatted once
+            self.assertEqual(len(dates), len(formatter._dates))
+
+    def test_hours(self):
+        req, formatter = self._formatter('UTC')
+        self.assertEqual('1.5', formatter.hours(5400))
+        self.assertEqual('01:30', formatter.hours_and_minutes(5400))
+        self.assertEqual(format_hours(5400),
+                         formatter.field('seconds_worked', 5400))
+        self.assertEqual(formatter.date(5400),
+                         formatter.field('time_started', 5400))
+        self.assertEqual('joe', formatter.field('worker', 'joe'))
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(HoursFormatterTestCase, 'test'))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
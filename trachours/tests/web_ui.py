@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+import shutil
+import tempfile
+import unittest
+from datetime import date, datetime
+
+from trac.core import TracError
+from trac.perm import PermissionSystem
+from trac.test import EnvironmentStub, MockRequest
+from trac.ticket.model import Ticket
+from trac.util.datefmt import format_date, parse_date, to_timestamp, utc
+from trac.web.api import RequestDone
+
+from trachours.db import SetupTracHours
+from trachours.hours import TracHoursPlugin
+from trachours.web_ui import TracUserHours
+
+from trachours.tests import revert_trachours_schema_init
+
+
+class UserHoursTestCaseBase(unittest.TestCase):
+    def setUp(self):
+        self.env = EnvironmentStub(default_data=True,
+                                   enable=['trac.*', 'trachours.*'])
+        self.env.path = tempfile.mkdtemp()
+        setup = SetupTracHours(self.env)
+        with self.env.db_transaction as db:
+            setup.upgrade_environment(db)
+        PermissionSystem(self.env).grant_permission('joe',
+                                                    'TICKET_VIEW_HOURS')
+        self.user_hours = TracUserHours(self.env)
+        ticket = Ticket(self.env)
+        ticket['summary'] = 'ticket summary'
+        ticket.insert()
+        self.ticket = ticket.id
+        # 2018 starts on a Monday
+        self.add_hours('joe', datetime(2018, 1, 1, 9), 3600)
+        self.add_hours('joe', datetime(2018, 1, 1, 14), 3600)
+        self.add_hours('jim', datetime(2018, 1, 3, 9), 1800)
+        self.add_hours('joe', datetime(2018, 12, 31, 9), 900)
+        self.add_hours('joe', datetime(2019, 1, 1, 9), 900)
+
+    def tearDown(self):
+        self.env.reset_db()
+        revert_trachours_schema_init(self.env)
+        shutil.rmtree(self.env.path)
+
+    def add_hours(self, worker, started, seconds):
+        started = to_timestamp(started.replace(tzinfo=utc))
+        self.env.db_transaction("""
+            INSERT INTO ticket_time (ticket, time_submitted, worker,
+              submitter, time_started, seconds_worked, comments)
+            VALUES (%s, %s, %s, %s, %s, %s, '')
+            """, (self.ticket, started, worker, worker, started, seconds))
+
+
+class UserHeatmapTestCase(UserHoursTestCaseBase):
+    def _heatmap(self, **args):
+        args.setdefault('year', '2018')
+        req = MockRequest(self.env, authname='joe',
+                          path_info='/hours/user/heatmap', args=args, tz=utc)
+        self.assertTrue(self.user_hours.match_request(req))
+        return self.user_hours.process_request(req)[1]
+
+    def test_worker(self):
+        data = self._heatmap()
+        self.assertEqual(['joe'], data['workers'])
+        self.assertEqual(53, len(data['weeks']))
+        self.assertEqual((date(2018, 1, 1), 7200, 4), data['weeks'][0][0])
+        self.assertEqual((date(2018, 1, 3), 0, 0), data['weeks'][0][2])
+        self.assertEqual([(date(2018, 12, 31), 900, 1)], data['weeks'][-1])
+        self.assertEqual(2.25, data['total_hours'])
+        self.assertEqual(2, data['days_worked'])
+
+    def test_team(self):
+        data = self._heatmap(worker='joe,jim')
+        self.assertEqual(['jim', 'joe'], data['workers'])
+        self.assertEqual((date(2018, 1, 3), 1800, 1), data['weeks'][0][2])
+        self.assertEqual([('jim', 0.5), ('joe', 2.25)], data['worker_hours'])
+
+    def test_invalid_year(self):
+        for year in ('0', '1', '9999', '10000', 'next'):
+            self.assertRaises(TracError, self._heatmap, year=year)
+        self.assertEqual(0, self._heatmap(year='2')['total_hours'])
+        self.assertEqual(0, self._heatmap(year='9998')['total_hours'])
+
+    def test_cache_invalidation(self):
+        self._heatmap(worker='joe,jim')
+        self.add_hours('jim', datetime(2018, 1, 4, 9), 3600)
+        self.assertEqual(0.5, self._heatmap(worker='jim')['total_hours'])
+        TracHoursPlugin(self.env).add_ticket_hours(
+            self.ticket, 'jim', 60, time_started=datetime(2018, 6, 1, 12))
+        self.assertEqual(1.5 + 60 / 3600.,
+                         self._heatmap(worker='jim')['total_hours'])
+        self.assertEqual(2.25, self._heatmap()['total_hours'])
+
+
+class UserHoursTestCase(UserHoursTestCaseBase):
+    def _process(self, path_info, **args):
+        args.setdefault('from_date', '01/01/18')
+        args.setdefault('to_date', '12/31/18')
+        req = MockRequest(self.env, authname='joe', path_info=path_info,
+                          args=args, tz=utc)
+        self.assertTrue(self.user_hours.match_request(req))
+        return self.user_hours.process_request(req)[1]
+
+    def test_users(self):
+        data = self._process('/hours/user')
+        self.assertEqual([('jim', 0.5), ('joe', 2.25)], data['worker_hours'])
+        self.assertEqual(2.75, data['total_hours'])
+
+    def test_users_by_date(self):
+        data = self._process('/hours/user', details='date')
+        self.assertEqual([('01/01/18', 'joe', 2.0),
+                          ('01/03/18', 'jim', 0.5),
+                          ('12/31/18', 'joe', 0.25)],
+                         sorted((format_date(parse_date(row[0], utc), '%x'),
+                                 row[1], row[2])
+                                for row in data['worker_hours']))
+
+    def test_users_milestone(self):
+        ticket = Ticket(self.env)
+        ticket['summary'] = 'other ticket'
+        ticket['milestone'] = 'milestone1'
+        ticket.insert()
+        self.ticket = ticket.id
+        self.add_hours('jim', datetime(2018, 2, 1, 9), 900)
+        data = self._process('/hours/user', milestone='milestone1')
+        self.assertEqual([('jim', 0.25), ('joe', 0.0)], data['worker_hours'])
+
+    def test_users_csv(self):
+        req = MockRequest(self.env, authname='joe', path_info='/hours/user',
+                          args={'from_date': '01/01/18',
+                                'to_date': '12/31/18', 'format': 'csv'},
+                          tz=utc)
+        self.assertRaises(RequestDone, self.user_hours.process_request, req)
+        self.assertEqual('text/csv;charset=utf-8',
+                         req.headers_sent['Content-Type'])
+        lines = req.response_sent.getvalue().splitlines()
+        self.assertEqual(['Worker,Hours', 'jim,0.5', 'joe,2.25'], lines[-3:])
+
+    def test_by_ticket(self):
+        data = self._process('/hours/user/tickets/joe')
+        self.assertEqual([(self.ticket, 2.25)], data['worker_hours'])
+
+    def test_by_date(self):
+        first = self.ticket
+        ticket = Ticket(self.env)
+        ticket['summary'] = 'other ticket'
+        ticket.insert()
+        self.ticket = ticket.id
+        self.add_hours('joe', datetime(2018, 1, 1, 16), 1800)
+        data = self._process('/hours/user/dates/joe')
+        self.assertEqual(
+            [('01/01/18', [first, ticket.id], 2.5),
+             ('12/31/18', [first], 0.25)],
+            sorted((format_date(parse_date(row[0], utc), '%x'),
+                    row[1], row[2]) for row in data['worker_hours']))
+        self.assertEqual(set([first, ticket.id]), set(data['tickets']))
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(UserHeatmapTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(UserHoursTestCase, 'test'))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
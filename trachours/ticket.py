@@ -17,6 +17,7 @@ from genshi.builder import tag
 from genshi.filters.transform import Transformer
 
 from hours import TracHoursPlugin, _
+from metrics import comment_seconds, comments_parsed
 
 try:
     from mail2trac.email2ticket import ReplyToTicket
@@ -35,11 +36,18 @@ class TracHoursByComment(Component):
         implements(ITicketChangeListener, ITicketManipulator,
                    ITemplateStreamFilter)
 
-    # for ticket comments: 1.5 hours or 1:30 hours
-    hours_regex = r'(([0-9]+(\.[0-9]+)?)|([0-9]+:[0-5][0-9])) *hours'
-
-    # for singular hours: 1 hour
-    singular_hour_regex = r'((^)|(\s*))1 *hour((\W)|($))'
+    # for ticket comments: 1.5 hours, 1:30 hours or 1 hour, possibly
+    # already marked up as a link to the hours of the ticket
+    hours_re = re.compile(r"""
+        (?P<link>\[/hours/[0-9]+\ )?
+        (?<![\w.:])
+        (?P<hours>
+            (?P<amount>[0-9]+:[0-5][0-9]|[0-9]+(?:\.[0-9]+)?)\ *hours
+          | 1\ *hour
+        )
+        (?!\w)
+        (?(link)\])
+        """, re.VERBOSE)
 
     # ITemplateStreamFilter methods
 
@@ -77,17 +85,20 @@ class TracHoursByComment(Component):
 
         return []
 
+    @comment_seconds.timed(operation='munge')
     def munge_comment(self, comment, ticket):
+        if 'hour' not in comment:
+            return comment
+
         def replace(match, ticket=ticket):
             """
             callback for re.sub; this will markup the hours link
             """
+            if match.group('link'):
+                return match.group()
             return u'[%s %s]' % (('/hours/%s' % ticket.id), match.group())
 
-        comment = re.sub(self.hours_regex, replace, comment)
-        comment = re.sub(self.singular_hour_regex, u' [/hours/%s 1 hour]'
-                                                   % ticket.id, comment)
-        return comment
+        return self.hours_re.sub(replace, comment)
 
     # IEmailHandler methods
 
@@ -136,20 +147,38 @@ class TracHoursByComment(Component):
         * ticket : the id of the ticket
         * worker : who worked the hours
         """
-        trachours = TracHoursPlugin(self.env)
-        for match in re.finditer(self.hours_regex, comment):
-            hours = match.groups()[0]
-            if ':' in hours:
-                hours, minutes = hours.split(':')
-                seconds = 3600.0*float(hours) + 60.0*float(minutes)
+        seconds, comment = self.scan_hours(comment)
+        if seconds:
+            TracHoursPlugin(self.env).add_many_ticket_hours(
+                ticket, worker, [(s, comment) for s in seconds])
+
+    @comment_seconds.timed(operation='scan')
+    def scan_hours(self, comment):
+        """
+        return the list of seconds for each hours mention in a comment,
+        along with the comment stripped of its hours links
+        """
+        if not comment or 'hour' not in comment:
+            comments_parsed.inc(result='skipped')
+            return [], comment
+        seconds = []
+        pieces = []
+        pos = 0
+        for match in self.hours_re.finditer(comment):
+            amount = match.group('amount')
+            if amount is None:
+                seconds.append(3600)
+            elif ':' in amount:
+                hours, minutes = amount.split(':')
+                seconds.append(3600 * int(hours) + 60 * int(minutes))
             else:
-                seconds = 3600.0*float(hours)
-            _comment = re.sub('\[/hours/[0-9]+ ' + self.hours_regex + '\]',
-                              match.group(), comment)
-            trachours.add_ticket_hours(ticket, worker, seconds,
-                                       comments=_comment)
-
-        for match in re.finditer(self.singular_hour_regex, comment):
-            _comment = re.sub('\[/hours/[0-9]+ 1 hour\]', '1 hour', comment)
-            trachours.add_ticket_hours(ticket, worker, 3600.0,
-                                       comments=_comment)
+                seconds.append(int(3600 * float(amount)))
+            pieces.append(comment[pos:match.start()])
+            pieces.append(match.group('hours'))
+            pos = match.end()
+        if not seconds:
+            comments_parsed.inc(result='none')
+            return [], comment
+        comments_parsed.inc(result='found')
+        pieces.append(comment[pos:])
+        return seconds, ''.join(pieces)
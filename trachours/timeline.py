@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+"""Hours logged on the timeline.
+
+The hours logged by a worker on a ticket are shown as a single event
+per day of the user, at the time of the last record of the day. The
+events are summed by a single range query on `time_submitted`, and the
+summaries of their tickets are read by a single query.
+"""
+
+from trac.core import Component, implements
+from trac.resource import Resource, get_resource_shortname
+from trac.timeline.api import ITimelineEventProvider
+from trac.util.datefmt import to_datetime, to_timestamp, utc
+from trac.util.html import html as tag
+
+from hours import TracHoursPlugin, _, ngettext, tag_
+from sqlhelper import get_all
+from utils import format_hours_and_minutes, period_buckets, period_case
+
+
+class TracHoursTimeline(Component):
+    """Show the hours logged on the timeline."""
+
+    implements(ITimelineEventProvider)
+
+    # ITimelineEventProvider methods
+
+    def get_timeline_filters(self, req):
+        if 'TICKET_VIEW_HOURS' in req.perm:
+            yield ('hours', _('Hours logged'))
+
+    def get_timeline_events(self, req, start, stop, filters):
+        if 'hours' not in filters or 'TICKET_VIEW_HOURS' not in req.perm:
+            return
+        buckets = period_buckets(to_datetime(start, req.tz).date(),
+                                 to_datetime(stop, req.tz).date(),
+                                 'day', req.tz)[0]
+        days = [day for label, day in buckets]
+        events = self.get_events(days, to_timestamp(start),
+                                 to_timestamp(stop))
+        tickets = self.get_tickets(set(event[1] for event in events))
+        for worker, ticket, time_submitted, seconds, count in events:
+            resource = Resource('ticket', ticket)
+            if ticket not in tickets or \
+                    'TICKET_VIEW' not in req.perm(resource):
+                continue
+            yield ('hours', to_datetime(time_submitted, utc), worker,
+                   (resource, seconds, count) + tickets[ticket])
+
+    def render_timeline_event(self, context, field, event):
+        resource, seconds, count, summary, status, resolution, type_ = \
+            event[3]
+        if field == 'url':
+            return context.href.hours(resource.id)
+        elif field == 'title':
+            return tag_("%(hours)s hours logged on %(ticket)s",
+                        hours=format_hours_and_minutes(seconds),
+                        ticket=tag.em(get_resource_shortname(self.env,
+                                                             resource),
+                                      title=summary))
+        elif field == 'description':
+            return ngettext("%(num)d entry", "%(num)d entries", count)
+
+    # Internal methods
+
+    def get_events(self, starts, start, stop):
+        """Return the `(worker, ticket, time_submitted, seconds, count)`
+        of the time records submitted from `start` to `stop`, summed by
+        worker, ticket and period of `starts`, where `time_submitted` is
+        the time of the last record of the sum.
+        """
+        # the bounds are integers computed by period_buckets
+        bucket = period_case('time_submitted', starts)
+        return get_all(self.env, """
+            SELECT worker, ticket, MAX(time_submitted), SUM(seconds_worked),
+                   COUNT(*)
+            FROM %s
+            WHERE time_submitted >= %%s AND time_submitted <= %%s
+            GROUP BY worker, ticket, %s
+            """ % (TracHoursPlugin(self.env).time_records_table(start),
+                   bucket), start, stop)
+
+    def get_tickets(self, ids):
+        """Return the `(summary, status, resolution, type)` of the tickets
+        `ids` by id.
+        """
+        if not ids:
+            return {}
+        return dict((row[0], tuple(row[1:])) for row in get_all(self.env, """
+            SELECT id, summary, status, resolution, type FROM ticket
+            WHERE id IN (%s)
+            """ % ','.join(map(str, sorted(ids)))))
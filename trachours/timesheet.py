@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+"""Weekly timesheet of a worker.
+
+`/hours/timesheet` shows the hours of a worker as a grid of tickets by
+days of a week, loaded with a single query, and saves all the changed
+cells of the grid at once: the time records are added, changed and
+deleted and the total hours of the tickets are updated in a single
+transaction.
+"""
+
+import re
+from bisect import bisect_right
+from datetime import timedelta
+
+from trac.core import Component, TracError, implements
+from trac.util.datefmt import (
+    format_date, parse_date, to_datetime, user_time
+)
+from trac.web.api import IRequestHandler
+from trac.web.chrome import (
+    ITemplateProvider, add_ctxtnav, add_notice, add_stylesheet,
+    add_warning
+)
+
+from hours import TracHoursPlugin, _
+from metrics import request_seconds
+from sqlhelper import get_all
+from utils import format_hours_and_minutes, period_buckets, period_start
+
+# hours and minutes, or decimal hours
+_duration_re = re.compile(r'^\s*(?:(\d+):([0-5]\d)|(\d*\.?\d+))\s*$')
+
+
+def parse_duration(value):
+    """Return the seconds of a cell of the timesheet, given as `H:MM` or
+    as decimal hours. An empty cell is 0. Raise `ValueError` for an
+    invalid duration.
+    """
+    if not value or not value.strip():
+        return 0
+    match = _duration_re.match(value)
+    if not match:
+        raise ValueError(value)
+    hours, minutes, decimal = match.groups()
+    if decimal is not None:
+        return int(round(float(decimal) * 3600))
+    return int(hours) * 3600 + int(minutes) * 60
+
+
+class TracHoursTimesheet(Component):
+    """Serve the weekly timesheet of a worker at `/hours/timesheet`."""
+
+    implements(IRequestHandler, ITemplateProvider)
+
+    # the records added from the timesheet start at noon
+    start_hour = 12
+
+    # IRequestHandler methods
+
+    def match_request(self, req):
+        return req.path_info.rstrip('/') == '/hours/timesheet'
+
+    @request_seconds.timed(handler='timesheet')
+    def process_request(self, req):
+        req.perm.require('TICKET_VIEW_HOURS')
+        worker = req.args.get('worker') or req.authname
+        if req.args.get('week'):
+            day = user_time(req, parse_date, req.args['week']).date()
+        else:
+            day = to_datetime(None, req.tz).date()
+        first = period_start(day, 'week')
+        days = [first + timedelta(days=idx) for idx in xrange(7)]
+        buckets, end = period_buckets(first, days[-1], 'day', req.tz)
+        starts = [start for label, start in buckets]
+
+        extra = set()
+        for arg in req.args.getlist('add_ticket'):
+            for value in arg.replace('#', ' ').replace(',', ' ').split():
+                try:
+                    extra.add(int(value))
+                except ValueError:
+                    add_warning(req, _("Invalid ticket: {ticket}").format(
+                        ticket=value))
+        for arg in req.args.getlist('tickets'):
+            extra.update(int(value) for value in arg.split(',')
+                         if value.isdigit())
+
+        cells = self.get_cells(worker, starts, end)
+        if req.method == 'POST' and 'save' in req.args:
+            req.perm.require('TICKET_ADD_HOURS')
+            if worker != req.authname:
+                req.perm.require('TRAC_ADMIN')
+            if self.save(req, worker, cells, starts):
+                req.redirect(req.href.hours('timesheet', worker=worker,
+                                            week=first.isoformat()))
+            extra.update(ticket for ticket, idx in cells)
+
+        tickets = self.get_tickets(worker, set(ticket for ticket, idx
+                                               in cells) | extra)
+        data = {
+            'worker': worker,
+            'week': first.isoformat(),
+            'days': days,
+            'tickets': tickets,
+            'cells': dict((key, sum(entry[1] for entry in entries))
+                          for key, entries in cells.iteritems()),
+            'values': req.args if req.method == 'POST' else {},
+            'format_hours': format_hours_and_minutes,
+            'can_edit': 'TICKET_ADD_HOURS' in req.perm and
+                        (worker == req.authname or 'TRAC_ADMIN' in req.perm),
+        }
+        data['row_totals'] = dict(
+            (ticket, sum(data['cells'].get((ticket, idx), 0)
+                         for idx in xrange(7)))
+            for ticket, summary in tickets)
+        data['day_totals'] = [sum(seconds for (ticket, idx), seconds
+                                  in data['cells'].iteritems() if idx == day)
+                              for day in xrange(7)]
+        data['total'] = sum(data['day_totals'])
+
+        add_stylesheet(req, 'common/css/report.css')
+        add_ctxtnav(req, _('Previous week'),
+                    req.href.hours('timesheet', worker=worker,
+                                   week=(first - timedelta(days=7))
+                                   .isoformat()))
+        add_ctxtnav(req, _('Next week'),
+                    req.href.hours('timesheet', worker=worker,
+                                   week=(first + timedelta(days=7))
+                                   .isoformat()))
+        add_ctxtnav(req, _('Hours by date'),
+                    req.href.hours('user', 'dates', worker,
+                                   from_date=days[0].isoformat(),
+                                   to_date=days[-1].isoformat()))
+        return 'hours_timesheet.html', data, 'text/html'
+
+    # ITemplateProvider methods
+
+    def get_htdocs_dirs(self):
+        return []
+
+    def get_templates_dirs(self):
+        from pkg_resources import resource_filename
+        return [resource_filename(__name__, 'templates')]
+
+    # Internal methods
+
+    def get_cells(self, worker, starts, end):
+        """Return the `(id, seconds_worked, comments)` of the time records
+        of `worker` started from `starts[0]` to `end`, by `(ticket, day)`,
+        where `day` is the index of the day starting at `starts`.
+        """
+        cells = {}
+        for id_, ticket, time_started, seconds_worked, comments \
+                in get_all(self.env, """
+                    SELECT id, ticket, time_started, seconds_worked, comments
+                    FROM %s
+                    WHERE worker=%%s AND time_started >= %%s
+                      AND time_started < %%s
+                    ORDER BY id
+                    """ % TracHoursPlugin(self.env).time_records_table(
+                        starts[0]), worker, starts[0], end):
+            key = (ticket, bisect_right(starts, time_started) - 1)
+            cells.setdefault(key, []).append((id_, seconds_worked, comments))
+        return cells
+
+    def get_tickets(self, worker, ids):
+        """Return the `(id, summary)` of the tickets `ids` and of the open
+        tickets owned by `worker`, ordered by id.
+        """
+        where = "owner=%s AND COALESCE(status, '')<>'closed'"
+        if ids:
+            where += " OR id IN (%s)" % ','.join(map(str, sorted(ids)))
+        return get_all(self.env, """
+            SELECT id, summary FROM ticket WHERE %s ORDER BY id
+            """ % where, worker)
+
+    def save(self, req, worker, cells, starts):
+        """Save the cells of the submitted timesheet which changed, except
+        the cells of archived records, and return whether they were valid.
+        """
+        changes = {}
+        for name, value in req.args.iteritems():
+            match = re.match(r'cell_(\d+)_([0-6])$', name)
+            if not match:
+                continue
+            key = (int(match.group(1)), int(match.group(2)))
+            try:
+                seconds = parse_duration(value)
+            except ValueError:
+                add_warning(req, _("Invalid hours for #{ticket}: "
+                                   "{value}").format(ticket=key[0],
+                                                     value=value))
+                continue
+            if seconds != sum(entry[1] for entry in cells.get(key, [])):
+                changes[key] = seconds
+        if req.chrome['warnings']:
+            return False
+
+        # the archived records are read-only
+        hours = TracHoursPlugin(self.env)
+        archived = hours.get_archived_ids(entry[0] for key in changes
+                                          for entry in cells.get(key, []))
+        for ticket, idx in sorted(changes):
+            if any(entry[0] in archived
+                   for entry in cells.get((ticket, idx), [])):
+                add_warning(req, _("The hours of #{ticket} on {day} are "
+                                   "archived and were not changed").format(
+                    ticket=ticket, day=user_time(req, format_date,
+                                                 to_datetime(starts[idx],
+                                                             req.tz))))
+                del changes[(ticket, idx)]
+
+        existing = set(id_ for id_, in get_all(self.env, """
+            SELECT id FROM ticket WHERE id IN (%s)
+            """ % ','.join(map(str, set(ticket for ticket, idx
+                                        in changes)) or ['0'])))
+        inserts = []
+        updates = []
+        deletes = []
+        for (ticket, idx), seconds in sorted(changes.iteritems()):
+            entries = cells.get((ticket, idx), [])
+            if ticket not in existing:
+                raise TracError(_("Ticket #{ticket} does not exist")
+                                .format(ticket=ticket))
+            if not seconds:
+                deletes.extend(entry[0] for entry in entries)
+            elif not entries:
+                inserts.append((ticket, starts[idx] + self.start_hour * 3600,
+                                seconds, ''))
+            elif len(entries) == 1:
+                updates.append((entries[0][0], seconds, None))
+            else:
+                # the records of the cell are merged
+                comments = '; '.join(entry[2] for entry in entries
+                                     if entry[2])
+                updates.append((entries[0][0], seconds, comments))
+                deletes.extend(entry[0] for entry in entries[1:])
+        hours.update_time_records(
+            worker, inserts, updates, deletes, submitter=req.authname)
+        if changes:
+            add_notice(req, _("Saved {count} changed cells").format(
+                count=len(changes)))
+        return True
@@ -10,9 +10,166 @@
 import calendar
 import datetime
 
+from trac.util.datefmt import (
+    format_date, to_datetime, to_timestamp, user_time
+)
+
 hours_format = '%.2f'
 
 
+def parse_estimated_hours(value):
+    """Return the seconds of the `estimatedhours` field value `value`,
+    0 for the values which are not a positive number.
+    """
+    try:
+        hours = float(value)
+    except (ValueError, TypeError):
+        return 0
+    if hours != hours or hours < 0 or hours == float('inf'):
+        return 0
+    return int(round(hours * 3600))
+
+
+def format_hours(seconds):
+    """returns a formatted string of the number of hours"""
+    precision = 2
+    return str(round(seconds / 3600., precision))
+
+
+def format_hours_and_minutes(seconds):
+    """returns a formatted string of the number of hours"""
+    return '{hours:02}:{minutes:02}'.format(hours=seconds / 3600,
+                                            minutes=(seconds % 3600) / 60)
+
+
+class HoursFormatter(object):
+    """Format the dates and durations of the time records of a request.
+
+    The records of a report fall on a few days and have a few distinct
+    durations, so the timestamps are bucketed by day in the timezone of
+    the request and each day and each duration is only formatted once.
+    The formatter is passed to the templates, which format the records
+    as they are output.
+    """
+
+    # local days start on a quarter of an hour UTC in all the timezones,
+    # so all the timestamps of a slot are on the same day
+    slot = 900
+
+    def __init__(self, req):
+        self.req = req
+        self._slots = {}
+        self._dates = {}
+        self._hours = {}
+        self._hours_and_minutes = {}
+
+    def day(self, ts):
+        """Return the day of the timestamp `ts` in the timezone of the
+        request.
+        """
+        slot = ts // self.slot
+        day = self._slots.get(slot)
+        if day is None:
+            day = self._slots[slot] = datetime.datetime.fromtimestamp(
+                slot * self.slot, self.req.tz).date()
+        return day
+
+    def date(self, ts):
+        """Return `user_time(req, format_date, ts)`."""
+        day = self.day(ts)
+        date = self._dates.get(day)
+        if date is None:
+            date = self._dates[day] = user_time(self.req, format_date, ts)
+        return date
+
+    def hours(self, seconds):
+        """Return `format_hours(seconds)`."""
+        hours = self._hours.get(seconds)
+        if hours is None:
+            hours = self._hours[seconds] = format_hours(seconds)
+        return hours
+
+    def hours_and_minutes(self, seconds):
+        """Return `format_hours_and_minutes(seconds)`."""
+        hours = self._hours_and_minutes.get(seconds)
+        if hours is None:
+            hours = self._hours_and_minutes[seconds] = \
+                format_hours_and_minutes(seconds)
+        return hours
+
+    def field(self, name, value):
+        """Format the value of the column `name` of a time record."""
+        if name == 'seconds_worked':
+            return self.hours(value)
+        if name in ('time_started', 'time_submitted'):
+            return self.date(value)
+        return value
+
+
+periods = ('day', 'week', 'month', 'year')
+
+
+def period_start(day, period):
+    """Return the first day of the `period` containing `day`."""
+    if period == 'week':
+        return day - datetime.timedelta(days=day.weekday())
+    if period == 'month':
+        return day.replace(day=1)
+    if period == 'year':
+        return day.replace(month=1, day=1)
+    return day
+
+
+def next_period(day, period):
+    """Return the first day of the `period` following the one starting
+    on `day`.
+    """
+    if period == 'week':
+        return day + datetime.timedelta(days=7)
+    if period == 'month':
+        if day.month == 12:
+            return day.replace(year=day.year + 1, month=1)
+        return day.replace(month=day.month + 1)
+    if period == 'year':
+        return day.replace(year=day.year + 1)
+    return day + datetime.timedelta(days=1)
+
+
+def period_label(day, period):
+    if period == 'week':
+        year, week, weekday = day.isocalendar()
+        return '%d-W%02d' % (year, week)
+    if period == 'month':
+        return day.strftime('%Y-%m')
+    if period == 'year':
+        return day.strftime('%Y')
+    return day.isoformat()
+
+
+def period_buckets(first, last, period, tz):
+    """Return the `(label, start)` of the periods covering the days from
+    `first` to `last`, and the end of the last period. The start and end
+    are timestamps of midnight in `tz`.
+    """
+    buckets = []
+    day = period_start(first, period)
+    while day <= last:
+        buckets.append((period_label(day, period),
+                        to_timestamp(to_datetime(day, tz))))
+        day = next_period(day, period)
+    return buckets, to_timestamp(to_datetime(day, tz))
+
+
+def period_case(column, starts):
+    """Return an SQL expression of the index of the period of `starts`
+    containing the timestamp `column`, which is at least `starts[0]`.
+    """
+    # the bounds are integers, so are inlined
+    return 'CASE %s END' % ' '.join(
+        'WHEN %s >= %d THEN %d' % (column, starts[idx], idx)
+        for idx in xrange(len(starts) - 1, -1, -1))
+
+
 def get_all_users(env):
     """return the names of all known users in the trac environment"""
     return [i[0] for i in env.get_known_users()]
@@ -11,17 +11,20 @@ import re
 import calendar
 import csv
 import time
+from itertools import izip
 from StringIO import StringIO
-from datetime import datetime, timedelta
+from datetime import MAXYEAR, MINYEAR, date, datetime, timedelta
 from pkg_resources import parse_version
 
 from genshi.filters import Transformer
 from genshi.filters.transform import StreamBuffer
 from trac import __version__ as TRAC_VERSION
+from trac.config import IntOption
 from trac.core import *
-from trac.ticket import Ticket
 from trac.ticket.model import Milestone
-from trac.util.datefmt import format_date, parse_date, user_time
+from trac.util.datefmt import (
+    format_date, from_utimestamp, parse_date, to_datetime, user_time
+)
 from trac.util.html import html as tag
 from trac.util.translation import _
 from trac.web.api import IRequestHandler, ITemplateStreamFilter
@@ -29,15 +32,30 @@ from trac.web.chrome import (
     Chrome, ITemplateProvider, add_ctxtnav, add_link, add_stylesheet
 )
 
+from aggregate import get_backend, group_sum
+from cache import SharedCache
 from hours import TracHoursPlugin, _
-from sqlhelper import get_all_dict
-from utils import hours_format
+from metrics import request_seconds
+from profiling import memory_phase
+from snapshot import TracHoursSnapshot
+from sqlhelper import get_all, get_ticket
+from utils import HoursFormatter, hours_format, period_buckets, period_case
 
 
 class TracHoursRoadmapFilter(Component):
 
     implements(ITemplateStreamFilter)
 
+    cache_ttl = IntOption('trachours', 'milestone_cache_ttl', 300,
+        """Number of seconds the hours of a milestone, shown by the
+        roadmap and the milestone views, are cached, in files shared by
+        the processes. The cached hours are dropped when hours are logged
+        or edited, or tickets changed, in any process. `0` disables the
+        cache.""")
+
+    def __init__(self):
+        self._cache = SharedCache(self.env, 'milestone')
+
     # ITemplateStreamFilter methods
 
     def filter_stream(self, req, method, filename, stream, data):
@@ -48,10 +66,6 @@ class TracHoursRoadmapFilter(Component):
 
         if filename in ('roadmap.html', 'milestone_view.html') and \
                 'TICKET_VIEW_HOURS' in req.perm:
-            trac_hours = TracHoursPlugin(self.env)
-
-            hours = {}
-
             milestones = data.get('milestones')
             this_milestone = None
 
@@ -66,35 +80,9 @@ class TracHoursRoadmapFilter(Component):
                 find_xpath = "//*[@class='milestone']//h2/a"
                 xpath = "//*[@class='milestone']/div[1]"
 
-            for milestone in milestones:
-                hours[milestone.name] = dict(totalhours=0.,
-                                             estimatedhours=0., )
-
-                tickets = [tid for tid, in self.env.db_query("""
-                    SELECT id FROM ticket WHERE milestone=%s
-                    """, (milestone.name,))]
-
-                if tickets:
-                    hours[milestone.name]['date'] = \
-                        Ticket(self.env, tickets[0])['time']
-                for ticket in tickets:
-                    ticket = Ticket(self.env, ticket)
-
-                    # estimated hours for the ticket
-                    try:
-                        estimated_hours = float(ticket['estimatedhours'])
-                    except (ValueError, TypeError):
-                        estimated_hours = 0.
-                    hours[milestone.name]['estimatedhours'] += estimated_hours
-
-                    # total hours for the ticket (seconds -> hours)
-                    total_hours = trac_hours.get_total_hours(
-                        ticket.id) / 3600.0
-                    hours[milestone.name]['totalhours'] += total_hours
-
-                    # update date for oldest ticket
-                    if ticket['time'] < hours[milestone.name]['date']:
-                        hours[milestone.name]['date'] = ticket['time']
+            names = [milestone.name for milestone in milestones]
+            hours = self._cache.get_many(names, self.get_milestone_hours,
+                                         self.cache_ttl)
 
             b = StreamBuffer()
             stream |= Transformer(find_xpath).copy(b).end().select(xpath). \
@@ -103,6 +91,37 @@ class TracHoursRoadmapFilter(Component):
 
         return stream
 
+    # Internal methods
+
+    def get_milestone_hours(self, names):
+        """Return the estimated and total hours of the milestones `names`,
+        and the date of their oldest ticket, by name.
+        """
+        hours = {}
+        for name in names:
+            hours[name] = dict(totalhours=0., estimatedhours=0., )
+        if names:
+            hours_thp = TracHoursPlugin(self.env)
+            # estimated hours and date of the oldest ticket
+            for name, oldest, estimated in get_all(self.env, """
+                    SELECT t.milestone, MIN(t.time), SUM(e.seconds)
+                    FROM ticket t
+                    LEFT JOIN ticket_time_estimate e ON e.ticket = t.id
+                    WHERE t.milestone IN (%s) GROUP BY t.milestone
+                    """ % ','.join(['%s'] * len(names)), *names):
+                hours[name]['date'] = from_utimestamp(oldest)
+                hours[name]['estimatedhours'] = (estimated or 0) / 3600.0
+
+            # total hours (seconds -> hours)
+            for name, total in get_all(self.env, """
+                    SELECT t.milestone, SUM(tt.seconds_worked)
+                    FROM ticket t JOIN %s ON tt.ticket = t.id
+                    WHERE t.milestone IN (%s) GROUP BY t.milestone
+                    """ % (hours_thp.ticket_seconds_table('tt'),
+                           ','.join(['%s'] * len(names))), *names):
+                hours[name]['totalhours'] = (total or 0) / 3600.0
+        return hours
+
     class MilestoneMarkup(object):
         """Iterator for Transformer markup injection"""
 
@@ -154,6 +173,21 @@ class TracUserHours(Component):
 
     implements(ITemplateProvider, IRequestHandler)
 
+    heatmap_cache_ttl = IntOption('trachours', 'heatmap_cache_ttl', 3600,
+        """Number of seconds the hours per day of a worker for a year,
+        shown by `/hours/user/heatmap`, are cached, in files shared by
+        the processes. The cached hours of all the workers are dropped
+        whenever hours are logged or edited for any worker, or tickets
+        changed, in any process, so the cache mostly helps when the
+        heatmaps are viewed more often than hours are logged. `0`
+        disables the cache.""")
+
+    # levels of the cells of the heatmap
+    heatmap_levels = 4
+
+    def __init__(self):
+        self._heatmaps = SharedCache(self.env, 'heatmap')
+
     # ITemplateProvider methods
 
     def get_htdocs_dirs(self):
@@ -166,13 +200,16 @@ class TracUserHours(Component):
     # IRequestHandler methods
 
     def match_request(self, req):
-        return req.path_info == '/hours/user' or \
+        return req.path_info in ('/hours/user', '/hours/user/heatmap') or \
                re.match(r'/hours/user/(?:tickets|dates)/(?:\w+)', req.path_info) is not None
 
+    @request_seconds.timed(handler='user')
     def process_request(self, req):
         req.perm.require('TICKET_VIEW_HOURS')
         if req.path_info.rstrip('/') == '/hours/user':
             return self.users(req)
+        if req.path_info == '/hours/user/heatmap':
+            return self.user_heatmap(req)
         m = re.match(r'/hours/user/(?P<field>\w+)/(?P<user>\w+)',
                      req.path_info)
         field = m.group('field')
@@ -229,49 +266,37 @@ class TracUserHours(Component):
         # get the hours
         # trachours = TracHoursPlugin(self.env)
         # tickets = trachours.tickets_with_hours()
-        hours = get_all_dict(self.env, """
-            SELECT * FROM ticket_time
-            WHERE time_started >= %s AND time_started < %s
-            """, *[int(time.mktime(data[i].timetuple()))
-                   for i in ('from_date_raw', 'to_date_raw')])
+        memory_phase('fetch')
+        start, end = [int(time.mktime(data[i].timetuple()))
+                      for i in ('from_date_raw', 'to_date_raw')]
         details = req.args.get('details')
-        worker_hours = {}
-        if details != 'date':
-            for entry in hours:
-                worker = entry['worker']
-                if worker not in worker_hours:
-                    worker_hours[worker] = 0
-
-                if milestone and milestone != \
-                        Ticket(self.env, entry['ticket']).values.get('milestone'):
-                    continue
-
-                worker_hours[worker] += entry['seconds_worked']
-
+        snapshot = TracHoursSnapshot(self.env)
+        reader = None
+        if details != 'date' and not milestone and snapshot.enabled:
+            reader = snapshot.open()
+        if reader is not None:
+            # summed from the snapshot, without reading the records
+            with reader:
+                sums = reader.sum_seconds(start, end)
             worker_hours = [(worker, seconds / 3600.)
-                            for worker, seconds in sorted(worker_hours.items())]
+                            for worker, seconds in sorted(sums.iteritems())]
         else:
-            for entry in hours:
-                date = user_time(req, format_date, entry['time_started'])
-                worker = entry['worker']
-                key = (date, worker)
-                if key not in worker_hours:
-                    worker_hours[key] = 0
-
-                if milestone and milestone != \
-                        Ticket(self.env, entry['ticket']).values.get('milestone'):
-                    continue
-
-                worker_hours[key] += entry['seconds_worked']
-
-            worker_hours = [(key[0], key[1], seconds / 3600.)
-                            for key, seconds in sorted(worker_hours.items())]
+            rows = get_all(self.env, """
+                SELECT worker, ticket, time_started, seconds_worked
+                FROM %s
+                WHERE time_started >= %%s AND time_started < %%s
+                """ % TracHoursPlugin(self.env).time_records_table(start),
+                start, end)
+            memory_phase('group')
+            worker_hours = self.sum_user_hours(req, rows, details,
+                                               milestone)
         data['details'] = details
+        data['milestone'] = milestone
         data['worker_hours'] = worker_hours
         data['total_hours'] = sum(hours[-1] for hours in worker_hours)
 
         if req.args.get('format') == 'csv':
-            req.send(self.export_csv(req, data))
+            req.send(*self.export_csv(req, data))
 
         add_stylesheet(req, 'common/css/report.css')
         if details == 'date':
@@ -296,6 +321,37 @@ class TracUserHours(Component):
 
         return 'hours_users.html', data, 'text/html'
 
+    def sum_user_hours(self, req, rows, details, milestone):
+        """Return the hours of `/hours/user` summed from the `worker`,
+        `ticket`, `time_started` and `seconds_worked` of the records
+        `rows`, by worker or, with `details` set to `date`, by date and
+        worker. With `milestone`, only the hours of its tickets are
+        counted.
+        """
+        backend = TracHoursPlugin(self.env).aggregate_backend
+        workers, tickets, times, seconds = zip(*rows) or ([], [], [], [])
+        if milestone:
+            # the workers without hours on the milestone are listed
+            ids = set(id_ for id_, in get_all(self.env, """
+                SELECT id FROM ticket WHERE milestone=%s
+                """, milestone))
+            seconds = [value if ticket in ids else 0
+                       for ticket, value in izip(tickets, seconds)]
+        if details != 'date':
+            return [(worker, total / 3600.) for worker, total
+                    in sorted(group_sum(seconds, workers, backend=backend))]
+
+        # the records are summed by slot, of which the dates are formatted
+        formatter = HoursFormatter(req)
+        slots = get_backend(backend).floor_divide(times, formatter.slot)
+        worker_hours = {}
+        for (slot, worker), total in group_sum(seconds, slots, workers,
+                                               backend=backend):
+            key = (formatter.date(slot * formatter.slot), worker)
+            worker_hours[key] = worker_hours.get(key, 0) + total
+        return [(key[0], key[1], total / 3600.)
+                for key, total in sorted(worker_hours.items())]
+
     def user_by_ticket(self, req, user):
         """hours page for a single user"""
         data = {'hours_format': hours_format,
@@ -304,18 +360,20 @@ class TracUserHours(Component):
         args = [user]
         args += [int(time.mktime(data[i].timetuple()))
                  for i in ('from_date_raw', 'to_date_raw')]
-        hours = get_all_dict(self.env, """
-            SELECT * FROM ticket_time
-            WHERE worker=%s AND time_started >= %s AND time_started < %s
-            """, *args)
-        worker_hours = {}
-        for entry in hours:
-            ticket = entry['ticket']
-            if ticket not in worker_hours:
-                worker_hours[ticket] = 0
-            worker_hours[ticket] += entry['seconds_worked']
-
-        data['tickets'] = dict([(i, Ticket(self.env, i))
+        memory_phase('fetch')
+        rows = get_all(self.env, """
+            SELECT ticket, seconds_worked FROM %s
+            WHERE worker=%%s AND time_started >= %%s AND time_started < %%s
+            """ % TracHoursPlugin(self.env).time_records_table(args[1]),
+            *args)
+        memory_phase('group')
+        tickets, seconds = zip(*rows) or ([], [])
+        worker_hours = dict(group_sum(
+            seconds, tickets,
+            backend=TracHoursPlugin(self.env).aggregate_backend))
+
+        memory_phase('merge')
+        data['tickets'] = dict([(i, get_ticket(self.env, i))
                                 for i in worker_hours.keys()])
 
         # sort by ticket number and convert to hours
@@ -367,25 +425,35 @@ class TracUserHours(Component):
         args = [user]
         args += [int(time.mktime(data[i].timetuple()))
                  for i in ('from_date_raw', 'to_date_raw')]
-        hours = get_all_dict(self.env, """
-            SELECT * FROM ticket_time
-            WHERE worker=%s AND time_started >= %s AND time_started < %s
-            """, *args)
+        memory_phase('fetch')
+        rows = get_all(self.env, """
+            SELECT ticket, time_started, seconds_worked FROM %s
+            WHERE worker=%%s AND time_started >= %%s AND time_started < %%s
+            """ % TracHoursPlugin(self.env).time_records_table(args[1]),
+            *args)
+        memory_phase('group')
+        tickets, times, seconds = zip(*rows) or ([], [], [])
+        backend = TracHoursPlugin(self.env).aggregate_backend
+        # the records are summed by slot and ticket, in the order of the
+        # records, and the dates of the slots are formatted
+        formatter = HoursFormatter(req)
+        slots = get_backend(backend).floor_divide(times, formatter.slot)
         worker_hours = {}
-        for entry in hours:
-            date = user_time(req, format_date, entry['time_started'])
-            ticket = entry['ticket']
+        for (slot, ticket), total in group_sum(seconds, slots, tickets,
+                                               backend=backend):
+            date = formatter.date(slot * formatter.slot)
             if date not in worker_hours:
                 worker_hours[date] = {
                     'seconds': 0,
                     'tickets': [],
                 }
-            worker_hours[date]['seconds'] += entry['seconds_worked']
+            worker_hours[date]['seconds'] += total
             if ticket not in worker_hours[date]['tickets']:
                 worker_hours[date]['tickets'].append(ticket)
 
-        data['tickets'] = dict([(entry['ticket'], Ticket(self.env, entry['ticket']))
-                                for entry in hours])
+        memory_phase('merge')
+        data['tickets'] = dict([(ticket, get_ticket(self.env, ticket))
+                                for ticket in set(tickets)])
 
         # sort by ticket number and convert to hours
         worker_hours = [(date, details['tickets'], details['seconds'] / 3600.)
@@ -423,6 +491,9 @@ class TracUserHours(Component):
                     req.href.hours('user/tickets/{}'.format(user),
                                    from_date=data['from_date'],
                                    to_date=data['to_date']))
+        add_ctxtnav(req, _('Heatmap'),
+                    req.href.hours('user/heatmap', worker=user,
+                                   year=data['from_date_raw'].year))
         add_link(req, 'alternate', req.href(req.path_info,
                                             format='csv',
                                             from_date=data['from_date'],
@@ -432,6 +503,95 @@ class TracUserHours(Component):
 
         return 'hours_user_by_date.html', data, 'text/html'
 
+    def user_heatmap(self, req):
+        """hours per day of a year for a worker or a team of workers"""
+        workers = sorted(set(worker.strip()
+                             for arg in req.args.getlist('worker')
+                             for worker in arg.split(',') if worker.strip()))
+        if not workers:
+            workers = [req.authname]
+        today = to_datetime(None, req.tz).date()
+        try:
+            year = int(req.args.get('year', today.year))
+            # the days before and after the year are dates too
+            if not MINYEAR < year < MAXYEAR:
+                raise ValueError
+            first = date(year, 1, 1)
+        except ValueError:
+            raise TracError(_("Invalid year: {year}").format(
+                year=req.args.get('year')))
+
+        memory_phase('fetch')
+        buckets, end = period_buckets(first, date(year, 12, 31), 'day',
+                                      req.tz)
+        hours = self.get_day_hours(workers, year, [start for label, start
+                                                   in buckets], end, req.tz)
+
+        memory_phase('group')
+        seconds = [0] * len(buckets)
+        for days in hours.itervalues():
+            for idx, value in days.iteritems():
+                seconds[idx] += value
+        highest = max(seconds)
+        # the weeks start on Monday
+        cells = [None] * first.weekday()
+        for idx, value in enumerate(seconds):
+            level = -(-value * self.heatmap_levels // highest) if value else 0
+            cells.append((first + timedelta(days=idx), value, level))
+        weeks = [cells[idx:idx + 7] for idx in xrange(0, len(cells), 7)]
+
+        data = {
+            'hours_format': hours_format,
+            'workers': workers,
+            'year': year,
+            'weeks': weeks,
+            'weekdays': [calendar.day_abbr[idx] for idx in xrange(7)],
+            'worker_hours': [(worker, sum(hours[worker].itervalues()) / 3600.)
+                             for worker in workers],
+            'total_hours': sum(seconds) / 3600.,
+            'days_worked': len([value for value in seconds if value]),
+        }
+
+        args = dict(worker=','.join(workers))
+        add_stylesheet(req, 'common/css/report.css')
+        add_ctxtnav(req, _('Previous year'),
+                    req.href.hours('user/heatmap', year=year - 1, **args))
+        add_ctxtnav(req, _('Next year'),
+                    req.href.hours('user/heatmap', year=year + 1, **args))
+        add_ctxtnav(req, _('Hours by User'), req.href.hours('user'))
+        return 'hours_heatmap.html', data, 'text/html'
+
+    def get_day_hours(self, workers, year, starts, end, tz):
+        """Return the seconds worked by each of `workers` on the days of
+        `year` starting at `starts`, as dictionaries of seconds by index of
+        day. The days of a worker are cached for each year and timezone,
+        and the days of the workers which are not cached are summed by a
+        single query.
+        """
+        zone = getattr(tz, 'zone', None) or str(tz)
+
+        def compute(keys):
+            hours = dict((key, {}) for key in keys)
+            bucket = period_case('time_started', starts)
+            for worker, idx, seconds in get_all(self.env, """
+                    SELECT worker, %(bucket)s, SUM(seconds_worked)
+                    FROM %(table)s
+                    WHERE worker IN (%(workers)s)
+                      AND time_started >= %%s AND time_started < %%s
+                    GROUP BY worker, %(bucket)s
+                    """ % {'bucket': bucket,
+                           'table': TracHoursPlugin(self.env)
+                                    .time_records_table(starts[0]),
+                           'workers': ','.join(['%s'] * len(keys))},
+                    *([key[0] for key in keys] + [starts[0], end])):
+                hours[(worker, year, zone)][idx] = seconds or 0
+            return hours
+
+        hours = self._heatmaps.get_many([(worker, year, zone)
+                                         for worker in workers],
+                                        compute, self.heatmap_cache_ttl)
+        return dict((key[0], days) for key, days in hours.iteritems())
+
     def export_csv(self, req, data, sep=',', mimetype='text/csv'):
         content = StringIO()
         content.write('\xef\xbb\xbf')  # BOM
@@ -445,8 +605,13 @@ class TracUserHours(Component):
         if data['milestone']:
             writer.writerow(['Milestone', data['milestone']])
         writer.writerow([])
-        writer.writerow(['Worker', 'Hours'])
-        for worker, hours in data['worker_hours']:
-            writer.writerow([worker, hours])
+        if data['details'] == 'date':
+            writer.writerow(['Date', 'Worker', 'Hours'])
+        else:
+            writer.writerow(['Worker', 'Hours'])
+        for row in data['worker_hours']:
+            writer.writerow([value.encode('utf-8')
+                             if isinstance(value, unicode) else value
+                             for value in row])
 
-        return content.getvalue(), '%s;text/csv' % mimetype
+        return content.getvalue(), mimetype